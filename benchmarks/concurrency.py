@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Concurrent-writer check: several processes add memories to one store at the
+same time, then every memory must own exactly one vector row holding the
+embedding of its own content.
+
+Runs in a fresh temporary CLAUDE_MEMORY_DIR with the hashed fake model from
+synthetic.py. Reports and exits 1 if the memory count is off, a memory has
+no vector, a row belongs to no memory or to two, a row holds some other
+text's vector, or a temp file was left behind.
+
+Usage:
+  python benchmarks/concurrency.py [--workers 4] [--adds 150] [--backend json|sqlite]
+                                   [--ann-threshold 100] [--quant none|int8|binary]
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+HERE = Path(__file__).resolve().parent
+REPO = HERE.parent
+
+
+def load_memory():
+    sys.path.insert(0, str(REPO / "remember"))
+    sys.path.insert(0, str(HERE))
+    import memory
+    from synthetic import install_fake_model
+    install_fake_model(memory)
+    return memory
+
+
+def content(worker: int, i: int) -> str:
+    """Distinct text per (worker, i), so deduplication never merges two of them."""
+    words = [hashlib.md5(f"{worker}-{i}-{j}".encode()).hexdigest()[:8] for j in range(24)]
+    return f"worker {worker} note {i}: " + " ".join(words)
+
+
+def worker(index: int, adds: int):
+    memory = load_memory()
+    memory.AUTO_FORGET = False
+    store = memory.MemoryStore()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(adds):
+            store.add(content(index, i), "state", key=f"w{index}_{i}")
+            if i % 10 == 0:
+                store.search(content(index, i // 2), top_k=3)
+
+
+def check(memory, expected: int) -> list:
+    problems = []
+    memory.reset_caches()
+    items = {f"{layer}/{key}": data["content"] for layer, key, data in memory.get_backend().items()}
+    if len(items) != expected:
+        problems.append(f"{len(items)} memories, expected {expected}")
+    store = memory.get_vector_store()
+    rows = store.rows
+    if len(set(rows.values())) != len(rows):
+        problems.append(f"{len(rows) - len(set(rows.values()))} rows shared by two memories")
+    free = set(store.meta["free"]) & set(rows.values())
+    if free:
+        problems.append(f"{len(free)} rows both used and free")
+    missing = sorted(set(items) - set(rows))
+    orphans = sorted(set(rows) - set(items))
+    if missing:
+        problems.append(f"{len(missing)} memories without a vector, e.g. {missing[:3]}")
+    if orphans:
+        problems.append(f"{len(orphans)} vectors without a memory, e.g. {orphans[:3]}")
+    ids = [item_id for item_id in items if item_id in rows]
+    if ids:
+        wanted = memory.model.encode([items[i] for i in ids])
+        wanted /= np.maximum(np.linalg.norm(wanted, axis=1, keepdims=True), 1e-12)
+        stored = np.asarray(store.matrix()[[rows[i] for i in ids]], dtype=np.float32)
+        wrong = [item_id for item_id, ok in zip(ids, np.isclose(wanted, stored, atol=1e-3).all(axis=1))
+                 if not ok]
+        if wrong:
+            problems.append(f"{len(wrong)} rows hold another text's vector, e.g. {wrong[:3]}")
+    leftovers = [p.name for p in memory.MEMORY_DIR.rglob("*.tmp*")]
+    if leftovers:
+        problems.append(f"temp files left behind: {leftovers[:5]}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--adds", type=int, default=150, help="memories added by each worker")
+    parser.add_argument("--backend", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--ann-threshold", type=int, default=100,
+                        help="store size at which searches build and use the ANN index")
+    parser.add_argument("--quant", default="none", choices=["none", "int8", "binary"])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({
+            "CLAUDE_MEMORY_DIR": tmp,
+            "CLAUDE_MEMORY_DAEMON": "0",
+            "CLAUDE_MEMORY_BACKEND": args.backend,
+            "CLAUDE_MEMORY_ANN_THRESHOLD": str(args.ann_threshold),
+            "CLAUDE_MEMORY_VECTOR_QUANT": args.quant,
+        })
+        ctx = multiprocessing.get_context("spawn")  # each worker imports memory.py with the env above
+        procs = [ctx.Process(target=worker, args=(w, args.adds)) for w in range(args.workers)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        failed = [p.exitcode for p in procs if p.exitcode]
+        memory = load_memory()
+        problems = check(memory, args.workers * args.adds)
+        if failed:
+            problems.insert(0, f"{len(failed)} workers exited with errors")
+
+    label = f"{args.workers} workers x {args.adds} adds ({args.backend}, quant {args.quant})"
+    if problems:
+        print(f"[Concurrency] FAILED {label}")
+        for problem in problems:
+            print(f"  - {problem}")
+        sys.exit(1)
+    print(f"[Concurrency] OK {label}: every memory has its own vector")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Search benchmark: per-item cosine loop vs. vectorized VectorStore.search
+
+The loop baseline reproduces the old search_memories path (one cos_sim call
+per memory). It uses sentence_transformers.util.cos_sim when installed and an
+equivalent per-item NumPy computation otherwise.
+
+Usage:
+  python benchmarks/search_bench.py [--sizes 1000 10000 100000] [--dim 1024]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+# memory.py reads these at import: keep its lock file out of the real memory directory
+MEMORY_DIR = tempfile.TemporaryDirectory()  # removed at exit
+os.environ.update({"CLAUDE_MEMORY_DIR": MEMORY_DIR.name, "CLAUDE_MEMORY_DAEMON": "0"})
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "remember"))
+from memory import VectorStore  # noqa: E402
+
+
+def make_cos_sim():
+    try:
+        from sentence_transformers import util
+        return lambda q, v: util.cos_sim(q, v).item()
+    except ImportError:
+        return lambda q, v: float(np.dot(q, v) / (np.linalg.norm(q) * np.linalg.norm(v)))
+
+
+def loop_search(query, vectors, top_k, cos_sim):
+    candidates = []
+    for i, vec in enumerate(vectors):
+        candidates.append((cos_sim(query, vec), i))
+    candidates.sort(key=lambda x: x[0], reverse=True)
+    return candidates[:top_k]
+
+
+def bench(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark memory search")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-loop-above", type=int, default=100000,
+                        help="Skip the slow loop baseline above this size")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    cos_sim = make_cos_sim()
+
+    for n in args.sizes:
+        vectors = rng.standard_normal((n, args.dim)).astype(np.float32)
+        query = rng.standard_normal(args.dim).astype(np.float32)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            store = VectorStore(Path(tmp) / "vectors.npy", Path(tmp) / "vectors.json")
+            with store.writing():
+                for i, vec in enumerate(vectors):
+                    store.set("cognitive", f"m{i}", vec)
+            store = VectorStore(Path(tmp) / "vectors.npy", Path(tmp) / "vectors.json")
+            store.search(query, args.top_k)  # warm the page cache and row map
+
+            row = {"n": n, "dim": args.dim}
+            row["vectorized_ms"] = bench(lambda: store.search(query, args.top_k), args.repeat) * 1000
+            if n <= args.skip_loop_above:
+                row["loop_ms"] = bench(lambda: loop_search(query, vectors, args.top_k, cos_sim), 1) * 1000
+                row["speedup"] = row["loop_ms"] / row["vectorized_ms"]
+            print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite: core memory operations on synthetic banks at several sizes
+
+Each size runs in a fresh child process with its own CLAUDE_MEMORY_DIR, so
+caches and module state never leak between scales. Embeddings come from the
+hashed fake model in synthetic.py: the numbers measure storage, indexing and
+search overhead, not the real model's encode time.
+
+Stages (milliseconds):
+  save / load            save_memories / load_memories of the whole bank
+  reindex_full           reindex_memories(force=True)
+  reindex_noop           reindex_memories() with nothing changed
+  add                    add_memory, mean of --adds calls
+  search_semantic        search_memories, mean and p95 over --queries
+  search_keyword         the same with the model disabled (BM25 only)
+  search_int8/binary     search_semantic with quantized first-pass codes
+  split                  split_into_memories on a --doc-kb markdown document
+
+Usage:
+  python benchmarks/suite.py [--sizes 1000 10000] [--output results.json]
+  python benchmarks/suite.py --compare baseline.json   # print ratios vs. a saved run
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+REPO = HERE.parent
+
+
+def timed(fn, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn(*args, **kwargs)
+    return (time.perf_counter() - start) * 1000
+
+
+def run_scale(n: int, args) -> list:
+    """Benchmark one bank size in this process (CLAUDE_MEMORY_DIR is already private)."""
+    sys.path.insert(0, str(REPO / "remember"))
+    sys.path.insert(0, str(HERE))
+    import memory
+    from synthetic import Generator, install_fake_model
+
+    install_fake_model(memory, args.dim)
+    memory.AUTO_FORGET = False  # synthetic banks exceed the layer capacities on purpose
+    gen = Generator(args.seed)
+    bank = gen.bank(n)
+    rows = []
+
+    def record(stage, ms, **extra):
+        rows.append({"n": n, "stage": stage, "ms": round(ms, 3), **extra})
+
+    record("save", timed(memory.save_memories, bank))
+    record("load", timed(memory.load_memories))
+    record("reindex_full", timed(memory.reindex_memories, force=True))
+    record("reindex_noop", timed(memory.reindex_memories))
+
+    adds = [gen.content() for _ in range(args.adds)]
+    total = sum(timed(memory.add_memory, content, "contextual") for content in adds)
+    record("add", total / max(1, len(adds)), calls=len(adds))
+
+    queries = gen.queries(args.queries)
+    timed(memory.search_memories, queries[0])  # warm up (first search loads the indexes)
+    for stage in ("search_semantic", "search_keyword"):
+        if stage == "search_keyword":
+            memory.HAS_SEMANTIC = False
+        times = sorted(timed(memory.search_memories, q) for q in queries)
+        record(stage, sum(times) / len(times), p95=round(times[int(0.95 * (len(times) - 1))], 3),
+               queries=len(times))
+    memory.HAS_SEMANTIC = True
+    store = memory.get_vector_store()
+    for mode in store.QUANT_MODES:
+        store.quant = mode
+        timed(memory.search_memories, queries[0])  # builds the codes
+        times = sorted(timed(memory.search_memories, q) for q in queries)
+        record(f"search_{mode}", sum(times) / len(times), p95=round(times[int(0.95 * (len(times) - 1))], 3),
+               queries=len(times))
+    store.quant = "none"
+
+    document = gen.document(args.doc_kb)
+    chunks = []
+    ms = timed(lambda: chunks.extend(memory.split_into_memories(document)))
+    record("split", ms, doc_kb=args.doc_kb, chunks=len(chunks))
+    return rows
+
+
+def metadata(args) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    import numpy
+    return {"commit": commit, "python": platform.python_version(), "numpy": numpy.__version__,
+            "platform": platform.platform(), "dim": args.dim, "seed": args.seed,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def compare(current: dict, baseline_path: str):
+    """Print current/baseline ratios per (n, stage) to stderr."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    old = {(r["n"], r["stage"]): r["ms"] for r in baseline["results"]}
+    print(f"\n{'n':>8} {'stage':<16} {'baseline':>10} {'current':>10} {'ratio':>7}", file=sys.stderr)
+    for row in current["results"]:
+        before = old.get((row["n"], row["stage"]))
+        if before:
+            flag = "  <- slower" if row["ms"] > before * 1.2 else ""
+            print(f"{row['n']:>8} {row['stage']:<16} {before:>10.2f} {row['ms']:>10.2f} "
+                  f"{row['ms'] / before:>7.2f}{flag}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark memory operations on synthetic banks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--dim", type=int, default=256, help="Fake embedding dimension")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--adds", type=int, default=20)
+    parser.add_argument("--doc-kb", type=int, default=512, help="Size of the document for the split stage")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", metavar="FILE", help="Baseline report to compare against")
+    parser.add_argument("--one", type=int, help=argparse.SUPPRESS)  # child process: one size
+    args = parser.parse_args()
+
+    if args.one:
+        print(json.dumps(run_scale(args.one, args)))
+        return
+
+    child_args = [f"--dim={args.dim}", f"--seed={args.seed}", f"--queries={args.queries}",
+                  f"--adds={args.adds}", f"--doc-kb={args.doc_kb}"]
+    results = []
+    for n in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, CLAUDE_MEMORY_DIR=tmp, CLAUDE_MEMORY_DAEMON="0")
+            env.pop("CLAUDE_MEMORY_NO_SEMANTIC", None)
+            proc = subprocess.run([sys.executable, __file__, f"--one={n}", *child_args],
+                                  env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            sys.exit(f"[Bench] n={n} failed:\n{proc.stderr}")
+        results.extend(json.loads(proc.stdout.strip().splitlines()[-1]))
+        print(f"[Bench] n={n} done", file=sys.stderr)
+
+    report = {"meta": metadata(args), "results": results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
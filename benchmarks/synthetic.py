@@ -0,0 +1,134 @@
+"""
+Deterministic synthetic memory banks and a fake embedding model for benchmarks.
+
+Everything is derived from a seed, so two runs (or two commits) see exactly
+the same memories, queries and vectors. The fake model hashes words into a
+fixed-size vector, which keeps related texts close without downloading the
+real embedding model.
+"""
+
+import hashlib
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+
+LAYERS = {  # layer -> share of the bank, roughly following references/layers.md
+    "core": 0.02,
+    "cognitive": 0.25,
+    "behavioral": 0.13,
+    "contextual": 0.25,
+    "state": 0.35,
+}
+TOPICS = ["python", "database", "design", "travel", "finance", "health", "music", "search",
+          "deployment", "testing", "cooking", "planning", "城市规划", "机器学习", "数据分析"]
+
+
+class FakeModel:
+    """
+    Stands in for SentenceTransformer: encode() returns feature-hashed
+    bag-of-words vectors (each word adds +-1 to two hashed dimensions).
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self._cache = {}
+
+    def _word(self, word: str) -> tuple:
+        hashed = self._cache.get(word)
+        if hashed is None:
+            h = int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:8], "little")
+            hashed = self._cache[word] = (h % self.dim, (h >> 20) % self.dim, 1.0 if h & (1 << 40) else -1.0)
+        return hashed
+
+    def encode(self, texts, convert_to_tensor=False, batch_size=32, **kwargs):
+        single = isinstance(texts, str)
+        out = np.zeros((1 if single else len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate([texts] if single else texts):
+            for a, b, sign in map(self._word, text.lower().split()[:512]):
+                out[i, a] += sign
+                out[i, b] += 1.0
+        return out[0] if single else out
+
+
+def install_fake_model(memory, dim: int = 256):
+    """Make `memory` (the imported remember/memory.py module) use FakeModel."""
+    memory.model = FakeModel(dim)
+    memory.HAS_SEMANTIC = True
+    memory.MODEL_NAME = f"fake-{dim}"
+
+
+class Generator:
+    """Seeded source of memories, queries and documents."""
+
+    def __init__(self, seed: int = 0, vocab_size: int = 5000):
+        self.rng = random.Random(seed)
+        self.vocab = [self._word(i) for i in range(vocab_size)]
+        # Zipf-like word frequencies, like real text
+        self.weights = [1.0 / (rank + 1) for rank in range(vocab_size)]
+
+    def _word(self, i: int) -> str:
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        word, n = "", i + 26
+        while n:
+            n, r = divmod(n, 26)
+            word += letters[r]
+        return word
+
+    def sentence(self, min_words: int = 6, max_words: int = 20) -> str:
+        words = self.rng.choices(self.vocab, self.weights, k=self.rng.randint(min_words, max_words))
+        words.insert(self.rng.randrange(len(words)), self.rng.choice(TOPICS))
+        return " ".join(words).capitalize() + "."
+
+    def content(self) -> str:
+        # Log-normal lengths: mostly short notes, some long document chunks
+        target = min(4000, max(40, int(self.rng.lognormvariate(5.5, 0.9))))
+        parts, size = [], 0
+        while size < target:
+            parts.append(self.sentence())
+            size += len(parts[-1]) + 1
+        return " ".join(parts)
+
+    def memory(self, layer: str, when: datetime) -> dict:
+        stamp = when.isoformat()
+        return {
+            "content": self.content(),
+            "layer": layer,
+            "tags": self.rng.sample(TOPICS, self.rng.randint(0, 3)),
+            "source": self.rng.choice(["", "", "notes.md", "slides.pptx", "report.pdf"]),
+            "created": stamp,
+            "updated": stamp,
+            "accessed": int(self.rng.expovariate(0.3)),
+        }
+
+    def bank(self, n: int) -> dict:
+        """{layer: {key: data}} with n memories spread over the five layers."""
+        start = datetime(2025, 1, 1)
+        memories = {layer: {} for layer in LAYERS}
+        layers, shares = zip(*LAYERS.items())
+        for i in range(n):
+            layer = self.rng.choices(layers, shares)[0]
+            when = start + timedelta(minutes=self.rng.randrange(60 * 24 * 365))
+            memories[layer][f"mem_{i:07d}"] = self.memory(layer, when)
+        return memories
+
+    def queries(self, n: int) -> list:
+        return [" ".join(self.rng.sample(self.vocab[:500], 2) + [self.rng.choice(TOPICS)])
+                for _ in range(n)]
+
+    def document(self, kb: int) -> str:
+        """A markdown document of about `kb` kilobytes with headers, lists and paragraphs."""
+        parts, size, section = [], 0, 0
+        while size < kb * 1024:
+            section += 1
+            block = [f"## Section {section}: {self.rng.choice(TOPICS)}", ""]
+            for _ in range(self.rng.randint(1, 4)):
+                block.append(" ".join(self.sentence() for _ in range(self.rng.randint(2, 8))))
+                block.append("")
+            if self.rng.random() < 0.3:
+                block.extend(f"- {self.sentence(3, 8)}" for _ in range(self.rng.randint(2, 6)))
+                block.append("")
+            text = "\n".join(block)
+            parts.append(text)
+            size += len(text)
+        return "\n".join(parts)
@@ -12,93 +12,2501 @@ Full capabilities: See SKILL.md
 """
 
 import argparse
+import atexit
+import glob
+import hashlib
+import heapq
+import importlib.util
+import io
 import json
+import multiprocessing
 import os
 import re
+import socket
+import socketserver
 import subprocess
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
 from pathlib import Path
 import shutil
 import sys
+import tempfile
 import numpy as np
 
-try:
-    from sentence_transformers import SentenceTransformer, util
-    # Using Qwen2.5/Qwen3 series for better multilingual performance
-    # Note: Qwen/Qwen3-Embedding-0.6B is a great balance of size and performance
-    print("[Init] Loading Qwen3 embedding model... (This may take a while first time)")
-    model = SentenceTransformer('Qwen/Qwen3-Embedding-0.6B', trust_remote_code=True)
-    HAS_SEMANTIC = True
-except ImportError:
-    HAS_SEMANTIC = False
-    model = None
-    print("[Warning] sentence-transformers not found or model failed. Semantic search disabled.")
-except Exception as e:
+_T0 = time.perf_counter()
+
+
+# ==================== TIMING ====================
+# Collected during a single CLI run: wall-clock seconds per stage (TIMINGS),
+# how often each stage ran (CALLS), event counters (COUNTS) and, when
+# profiling, the process's peak RSS as of the end of each stage (PEAK_RSS).
+# --timing prints them; --profile appends them to a file (see write_profile).
+# Under the daemon, commands running at the same time share these counters.
+TIMINGS = {}
+CALLS = {}
+COUNTS = {}
+PEAK_RSS = {}
+_stats_lock = threading.Lock()
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes (0 where unsupported)."""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports KiB
+
+
+@contextmanager
+def timed(stage: str):
+    """Accumulate wall-clock time spent in `stage` into TIMINGS."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _stats_lock:
+            TIMINGS[stage] = TIMINGS.get(stage, 0.0) + elapsed
+            CALLS[stage] = CALLS.get(stage, 0) + 1
+            if PROFILING:
+                PEAK_RSS[stage] = peak_rss()
+
+
+def tally(name: str, n: int = 1):
+    """Add `n` to the event counter `name` (items loaded, vectors scored, ...)."""
+    with _stats_lock:
+        COUNTS[name] = COUNTS.get(name, 0) + n
+
+
+def reset_stats():
+    with _stats_lock:
+        for stats in (TIMINGS, CALLS, COUNTS, PEAK_RSS):
+            stats.clear()
+
+
+def print_timings():
+    parts = [f"{stage} {secs * 1000:.0f}ms" + (f" x{CALLS[stage]}" if CALLS.get(stage, 1) > 1 else "")
+             for stage, secs in TIMINGS.items()]
+    print(f"[Timing] {' | '.join(parts)}")
+    if COUNTS:
+        print(f"[Timing] {' | '.join(f'{name} {n}' for name, n in COUNTS.items())}")
+
+
+# ==================== EMBEDDING MODEL ====================
+# The model is loaded lazily on first use: --list/--get/--delete/--index never
+# encode anything and should not pay the model startup cost.
+# Using Qwen2.5/Qwen3 series for better multilingual performance
+# Note: Qwen/Qwen3-Embedding-0.6B is a great balance of size and performance
+MODEL_NAME = os.environ.get("CLAUDE_MEMORY_MODEL", "Qwen/Qwen3-Embedding-0.6B")
+HAS_SEMANTIC = (
+    not os.environ.get("CLAUDE_MEMORY_NO_SEMANTIC")
+    and importlib.util.find_spec("sentence_transformers") is not None
+)
+model = None
+# Guards lazy initialization and the embedding cache when the daemon serves
+# several requests at once
+_state_lock = threading.RLock()
+
+
+def disable_semantic():
+    """Turn off semantic features for this process (--no-semantic)."""
+    global HAS_SEMANTIC
     HAS_SEMANTIC = False
-    model = None
-    print(f"[Warning] Failed to load embedding model: {e}")
 
 
-# Config
-MEMORY_DIR = Path(os.environ.get("CLAUDE_MEMORY_DIR",
-    os.path.expanduser("~/.claude/memory")))
-MEMORY_FILE = MEMORY_DIR / "memories.json"
-INDEX_FILE = MEMORY_DIR / "index.json"
+def get_model():
+    """Return the embedding model, loading it on first call. None if unavailable."""
+    if not HAS_SEMANTIC:
+        return None
+    if model is not None:
+        return model
+    with _state_lock:
+        return _load_model()
+
+
+def _load_model():
+    global model, HAS_SEMANTIC
+    if model is not None:
+        return model
+    try:
+        with timed("model_import"):
+            from sentence_transformers import SentenceTransformer
+    except ImportError:
+        HAS_SEMANTIC = False
+        print("[Warning] sentence-transformers not found. Semantic search disabled.")
+        return None
+
+    print("[Init] Loading Qwen3 embedding model... (This may take a while first time)")
+    try:
+        with timed("model_load"):
+            model = SentenceTransformer(MODEL_NAME, trust_remote_code=True)
+    except Exception as e:
+        HAS_SEMANTIC = False
+        print(f"[Warning] Failed to load embedding model: {e}")
+        return None
+    return model
+
+
+# Config
+MEMORY_DIR = Path(os.environ.get("CLAUDE_MEMORY_DIR",
+    os.path.expanduser("~/.claude/memory")))
+MEMORY_FILE = MEMORY_DIR / "memories.json"
+INDEX_FILE = MEMORY_DIR / "index.json"
+SQLITE_FILE = MEMORY_DIR / "memories.db"
+KEYWORD_INDEX_FILE = MEMORY_DIR / "keyword_index.json"
+STORAGE_BACKEND = os.environ.get("CLAUDE_MEMORY_BACKEND", "json")  # json | sqlite
+JOURNAL_FILE = MEMORY_DIR / "memories.log"
+JOURNAL_COMPACT_BYTES = 1 << 20
+LOCK_FILE = MEMORY_DIR / "memories.lock"
+VECTOR_FILE = MEMORY_DIR / "vectors.npy"
+VECTOR_MAP_FILE = MEMORY_DIR / "vectors.json"
+VECTOR_LOG_FILE = MEMORY_DIR / "vectors.log"  # row-map ops since the vectors.json snapshot
+VECTOR_DTYPE = os.environ.get("CLAUDE_MEMORY_VECTOR_DTYPE", "float32")  # or float16
+VECTOR_QUANT = os.environ.get("CLAUDE_MEMORY_VECTOR_QUANT", "none")  # none | int8 | binary first-pass scan
+QUANT_RERANK = int(os.environ.get("CLAUDE_MEMORY_QUANT_RERANK", "10"))  # shortlist = QUANT_RERANK * top_k
+EXTRACT_CACHE_DIR = MEMORY_DIR / "extract_cache"
+EXTRACT_ISOLATED = bool(os.environ.get("CLAUDE_MEMORY_EXTRACT_ISOLATED"))
+SPLIT_VERSION = 2  # bump when split_into_memories output changes, to invalidate cached chunks
+CHUNK_MAX_TOKENS = int(os.environ.get("CLAUDE_MEMORY_CHUNK_TOKENS", "800"))
+CHUNK_MIN_TOKENS = 100
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CLAUDE_MEMORY_CHUNK_OVERLAP", "60"))
+EMBED_CACHE_DIR = MEMORY_DIR / "embed_cache"
+EMBED_CACHE_SIZE = int(os.environ.get("CLAUDE_MEMORY_EMBED_CACHE_SIZE", "20000"))
+REINDEX_CHECKPOINT_EVERY = 500
+PROFILE_FILE = os.environ.get("CLAUDE_MEMORY_PROFILE")  # "1" = MEMORY_DIR/profile.<format>, or a path
+PROFILE_FORMAT = os.environ.get("CLAUDE_MEMORY_PROFILE_FORMAT", "jsonl")  # jsonl | prom
+CPROFILE_FILE = os.environ.get("CLAUDE_MEMORY_CPROFILE")
+PROFILING = bool(PROFILE_FILE)
+SOCKET_FILE = MEMORY_DIR / "memory.sock"
+DAEMON_ENABLED = os.environ.get("CLAUDE_MEMORY_DAEMON", "1") != "0"
+DAEMON_IDLE_TIMEOUT = int(os.environ.get("CLAUDE_MEMORY_DAEMON_IDLE", "1800"))
+IN_DAEMON = False
+ANN_FILE = MEMORY_DIR / "ann_index.npz"
+ANN_THRESHOLD = int(os.environ.get("CLAUDE_MEMORY_ANN_THRESHOLD", "50000"))
+ANN_NPROBE = int(os.environ.get("CLAUDE_MEMORY_ANN_NPROBE", "8"))
+# Hybrid ranking: reciprocal-rank fusion of dense + BM25 lists, then boosts
+RRF_K = 60
+SEARCH_DEPTH = 50  # candidates taken from each retriever (at least 4 * top_k)
+LAYER_WEIGHTS = {"core": 1.3, "cognitive": 1.15, "behavioral": 1.1, "contextual": 1.0, "state": 0.9}
+LAYER_WEIGHTS.update({layer: float(w) for layer, w in (
+    item.split("=") for item in os.environ.get("CLAUDE_MEMORY_LAYER_WEIGHTS", "").split(",") if "=" in item)})
+RECENCY_WEIGHT = float(os.environ.get("CLAUDE_MEMORY_RECENCY_WEIGHT", "0.2"))
+RECENCY_HALF_LIFE_DAYS = float(os.environ.get("CLAUDE_MEMORY_RECENCY_HALF_LIFE", "30"))
+ACTIVITY_WEIGHT = float(os.environ.get("CLAUDE_MEMORY_ACTIVITY_WEIGHT", "0.1"))
+# Forgetting: per-layer capacities (references/layers.md), enforced by --forget (and on add if AUTO_FORGET)
+LAYER_CAPACITY = {"core": 20, "cognitive": 100, "behavioral": 100, "contextual": 200, "state": 500}
+LAYER_CAPACITY.update({layer: int(n) for layer, n in (
+    item.split("=") for item in os.environ.get("CLAUDE_MEMORY_CAPACITY", "").split(",") if "=" in item)})
+FORGET_POLICY = os.environ.get("CLAUDE_MEMORY_FORGET_POLICY", "decay")  # lru | lfu | decay
+AUTO_FORGET = os.environ.get("CLAUDE_MEMORY_AUTO_FORGET", "0") != "0"  # opt-in: eviction deletes memories
+AUTO_FORGET_MAX = int(os.environ.get("CLAUDE_MEMORY_AUTO_FORGET_MAX", "20"))  # evictions per write, at most
+# Compression: summaries in the store, full text in COLD_DIR
+COLD_DIR = MEMORY_DIR / "cold"
+COLD_CODEC = os.environ.get("CLAUDE_MEMORY_COLD_CODEC", "zstd")  # zstd (if installed) | zlib
+SUMMARIZER = os.environ.get("CLAUDE_MEMORY_SUMMARIZER", "extractive")
+COMPRESS_MIN_CHARS = 600
+COMPRESS_LONG_CHARS = 3000
+COMPRESS_COLD_DAYS = 30
+COMPRESS_SUMMARY_CHARS = 300
+# Deduplication on ingest: MinHash/LSH for near-identical text, cosine for embeddings
+DEDUP_ON_INGEST = os.environ.get("CLAUDE_MEMORY_DEDUP", "1") != "0"
+DEDUP_JACCARD = float(os.environ.get("CLAUDE_MEMORY_DEDUP_JACCARD", "0.8"))
+DEDUP_COSINE = float(os.environ.get("CLAUDE_MEMORY_DEDUP_COSINE", "0.97"))
+DEDUP_MIN_CHARS = 80  # shorter texts (one word can flip their meaning) are only matched by MinHash
+DEDUP_INDEX_FILE = MEMORY_DIR / "dedup_index.npz"
+# Folder sync: what each synced file looked like and which memories hold its chunks
+SYNC_MANIFEST_FILE = MEMORY_DIR / "sync_manifest.json"
+SYNC_INTERVAL = float(os.environ.get("CLAUDE_MEMORY_SYNC_INTERVAL", "2"))  # --watch polling, seconds
+
+
+# ==================== LIGHTWEIGHT STORAGE ====================
+def ensure_dir():
+    MEMORY_DIR.mkdir(parents=True, exist_ok=True)
+
+
+try:
+    import fcntl
+except ImportError:  # Windows: the version counter still works, but nothing is locked
+    fcntl = None
+
+
+class StoreLock:
+    """
+    Cross-process flock on memories.lock, which also holds the store version.
+
+    Writers take the exclusive lock only to append to the journal (or compact
+    it) and bump the version; readers take the shared lock while reading the
+    snapshot and journal, so they never see a half-written entry. Processes
+    cache what they read and compare versions under the lock to find out
+    whether someone else wrote in the meantime (see JsonBackend._sync).
+
+    The flock belongs to the process: it is reentrant across the process's
+    threads (one fd, a hold count), so a worker thread reading on behalf of a
+    thread that holds the lock never waits for it. It only excludes other
+    processes; threads of one process coordinate on their own (the daemon
+    through its ReadWriteLock). Asking for the exclusive lock while only the
+    shared one is held upgrades it until the last hold is released, but
+    flock upgrades are not atomic: re-check version() afterwards.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._mutex = threading.Lock()
+        self._fd = None
+        self._holds = 0
+        self._exclusive = False
+
+    @contextmanager
+    def _hold(self, exclusive: bool):
+        with self._mutex:
+            if self._fd is None:
+                ensure_dir()
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    if fcntl:
+                        with timed("lock_wait"):
+                            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                except BaseException:
+                    os.close(fd)
+                    raise
+                self._fd, self._exclusive = fd, exclusive
+            elif exclusive and not self._exclusive:
+                if fcntl:
+                    with timed("lock_wait"):
+                        fcntl.flock(self._fd, fcntl.LOCK_EX)
+                self._exclusive = True
+            self._holds += 1
+        try:
+            yield
+        finally:
+            with self._mutex:
+                self._holds -= 1
+                if not self._holds:
+                    os.close(self._fd)  # releases the flock
+                    self._fd, self._exclusive = None, False
+
+    def shared(self):
+        return self._hold(False)
+
+    def exclusive(self):
+        return self._hold(True)
+
+    def version(self) -> int:
+        """The store version; only meaningful while the lock is held."""
+        raw = os.pread(self._fd, 32, 0).strip()
+        return int(raw) if raw.isdigit() else 0
+
+    def bump(self) -> int:
+        """Advance the version after a write (exclusive lock held)."""
+        version = self.version() + 1
+        os.pwrite(self._fd, b"%d\n" % version, 0)
+        return version
+
+
+STORE_LOCK = StoreLock(LOCK_FILE)
+
+
+def file_signature(path: Path):
+    """Identity of a file's current contents (changes whenever it is rewritten), or None."""
+    try:
+        st = path.stat()
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+    except OSError:
+        return None
+
+
+def snapshot_signature():
+    """Identity of the current memories.json (changes whenever it is rewritten)."""
+    return file_signature(MEMORY_FILE)
+
+
+def journal_size() -> int:
+    return JOURNAL_FILE.stat().st_size if JOURNAL_FILE.exists() else 0
+
+
+def temp_path(path: Path, suffix: str = ".tmp") -> Path:
+    """A fresh, uniquely named file next to `path`, to be renamed over it when complete."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, name = tempfile.mkstemp(prefix=path.name + ".", suffix=suffix, dir=path.parent)
+    os.close(fd)
+    return Path(name)
+
+
+def atomic_write_json(path: Path, data, **kwargs):
+    """Write JSON to a temp file and rename it over `path`."""
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, **kwargs)
+    os.replace(tmp, path)
+
+
+def load_memories() -> dict:
+    ensure_dir()
+    with STORE_LOCK.shared():
+        version = STORE_LOCK.version()
+        memories = read_snapshot()
+        replay_journal(memories)
+        if migrate_embeddings(memories):
+            save_memories(memories, version)
+    tally("memories_loaded", sum(len(items) for items in memories.values()))
+    return memories
+
+
+def read_snapshot() -> dict:
+    memories = {}
+    if MEMORY_FILE.exists():
+        try:
+            with timed("load"), open(MEMORY_FILE, encoding='utf-8') as f:
+                memories = json.load(f)
+        except json.JSONDecodeError:
+            print(f"[Error] Corrupted memory file: {MEMORY_FILE}")
+            # Backup corrupted file
+            backup_path = str(MEMORY_FILE) + ".bak"
+            try:
+                shutil.copy(MEMORY_FILE, backup_path)
+                print(f"[Error] Backed up to {backup_path}")
+            except Exception as e:
+                print(f"[Error] Could not backup: {e}")
+            
+            print("[Error] Exiting to prevent data loss. Please fix the file manually.")
+            sys.exit(1)
+        except Exception as e:
+            print(f"[Error] Failed to load memory file: {e}")
+            return {}
+    return memories
+
+
+def save_memories(memories: dict, version: int = None) -> bool:
+    """
+    Write a full snapshot of `memories` (atomically) and reset the journal.
+
+    With `version`, only if the store is still at that version, so a stale
+    copy never overwrites other processes' writes; returns whether it saved.
+    """
+    ensure_dir()
+    with STORE_LOCK.exclusive():
+        if version is not None and STORE_LOCK.version() != version:
+            return False
+        with timed("save"):
+            atomic_write_json(MEMORY_FILE, memories, indent=2)
+        if JOURNAL_FILE.exists():
+            JOURNAL_FILE.unlink()
+        STORE_LOCK.bump()
+    return True
+
+
+# ==================== JOURNAL ====================
+# Mutations are appended to memories.log as one JSON op per line instead of
+# rewriting memories.json, so a write costs the size of the change. Every op
+# is idempotent (put / patch / del / clear carry absolute values), which makes
+# replaying the log after a crash mid-compaction safe. Appends and
+# compactions happen under STORE_LOCK, readers hold it shared.
+def apply_op(memories: dict, op: dict):
+    kind = op["op"]
+    if kind == "put":
+        memories.setdefault(op["layer"], {})[op["key"]] = op["data"]
+    elif kind == "patch":
+        item = memories.get(op["layer"], {}).get(op["key"])
+        if item is not None:
+            item.update(op["fields"])
+    elif kind == "del":
+        memories.get(op["layer"], {}).pop(op["key"], None)
+    elif kind == "clear":
+        memories.clear()
+
+
+def read_journal(offset: int = 0):
+    """Complete ops from byte `offset` on, as (ops, offset just past the last one)."""
+    ops = []
+    if not JOURNAL_FILE.exists():
+        return ops, offset
+    with timed("journal_replay"), open(JOURNAL_FILE, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                ops.append(json.loads(line))
+            except ValueError:
+                break
+            offset += len(line)
+    tally("journal_ops_replayed", len(ops))
+    return ops, offset
+
+
+def replay_journal(memories: dict):
+    """Apply journalled ops to a loaded snapshot, dropping a torn trailing entry."""
+    ops, good = read_journal()
+    for op in ops:
+        apply_op(memories, op)
+    if good < journal_size():
+        print(f"[Recover] Discarding incomplete journal entry in {JOURNAL_FILE.name}")
+        with open(JOURNAL_FILE, 'r+b') as f:
+            f.truncate(good)
+
+
+def commit_ops(memories: dict, ops: list) -> bool:
+    """
+    Append `ops` (already applied to `memories`) to the journal.
+
+    Once the journal outgrows JOURNAL_COMPACT_BYTES and half the snapshot, it
+    is folded into memories.json with a full save; returns True when that happens.
+    """
+    ensure_dir()
+    payload = "".join(json.dumps(op, ensure_ascii=False) + "\n" for op in ops)
+    tally("journal_ops_written", len(ops))
+    with STORE_LOCK.exclusive():
+        with timed("journal_write"), open(JOURNAL_FILE, 'a', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        STORE_LOCK.bump()
+
+        snapshot_size = MEMORY_FILE.stat().st_size if MEMORY_FILE.exists() else 0
+        if journal_size() > max(JOURNAL_COMPACT_BYTES, snapshot_size // 2):
+            save_memories(memories)
+            return True
+    return False
+
+
+# ==================== KEYWORD INDEX ====================
+_CJK = "぀-ヿ㐀-䶿一-鿿가-힯豈-﫿"
+_CJK_RE = re.compile(f"[{_CJK}]+")
+_TOKEN_RE = re.compile(f"[{_CJK}]+|[^\\W{_CJK}]+")
+
+
+def tokenize(text: str) -> list:
+    """Lowercased word tokens; CJK runs (no spaces) become unigrams plus bigrams."""
+    tokens = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        run = match.group()
+        if _CJK_RE.match(run):
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class KeywordIndex:
+    """
+    Inverted index with BM25 ranking for the JSON backend's keyword search.
+
+    Queries only visit the postings of their own terms. The per-document term
+    counts are saved to keyword_index.json together with the memories.json
+    snapshot and journal offset they reflect; loading replays only the journal
+    written since, so the index is rebuilt from scratch only when it is missing
+    or out of step with the snapshot.
+    """
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.doc_terms = {}  # item_id -> {term: tf}
+        self.doc_len = {}
+        self.postings = {}   # term -> {item_id: tf}
+        self.total_len = 0
+
+    def add(self, item_id: str, text: str):
+        self.remove(item_id)
+        counts = {}
+        for token in tokenize(text):
+            counts[token] = counts.get(token, 0) + 1
+        self.doc_terms[item_id] = counts
+        length = sum(counts.values())
+        self.doc_len[item_id] = length
+        self.total_len += length
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[item_id] = tf
+
+    def remove(self, item_id: str):
+        counts = self.doc_terms.pop(item_id, None)
+        if counts is None:
+            return
+        self.total_len -= self.doc_len.pop(item_id)
+        for term in counts:
+            docs = self.postings.get(term)
+            if docs is not None:
+                docs.pop(item_id, None)
+                if not docs:
+                    del self.postings[term]
+
+    def clear(self):
+        self.doc_terms.clear()
+        self.doc_len.clear()
+        self.postings.clear()
+        self.total_len = 0
+
+    def apply_op(self, op: dict, memories: dict):
+        kind = op["op"]
+        item_id = f"{op.get('layer')}/{op.get('key')}"
+        if kind == "put":
+            self.add(item_id, f"{op['key']} {op['data'].get('content', '')}")
+        elif kind == "patch" and "content" in op["fields"]:
+            self.add(item_id, f"{op['key']} {op['fields']['content']}")
+        elif kind == "del":
+            self.remove(item_id)
+        elif kind == "clear":
+            self.clear()
+
+    def build(self, memories: dict):
+        self.clear()
+        for layer, items in memories.items():
+            for key, data in items.items():
+                self.add(f"{layer}/{key}", f"{key} {data.get('content', '')}")
+
+    def search(self, query: str) -> list:
+        """[(bm25, item_id)] for documents containing any query term, best first."""
+        n = len(self.doc_len)
+        if not n:
+            return []
+        avg_len = self.total_len / n or 1.0
+        scores = {}
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            tally("postings_visited", len(docs))
+            idf = np.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for item_id, tf in docs.items():
+                norm = tf + self.K1 * (1 - self.B + self.B * self.doc_len[item_id] / avg_len)
+                scores[item_id] = scores.get(item_id, 0.0) + idf * tf * (self.K1 + 1) / norm
+        return sorted(((float(score), item_id) for item_id, score in scores.items()), reverse=True)
+
+    def load(self, memories: dict):
+        """
+        Load the saved index and catch up with the journal, or rebuild it.
+        `memories` must be current with the store; call under STORE_LOCK.
+        """
+        saved = None
+        if self.path.exists():
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                saved = None
+        if (saved is None or saved.get("snapshot") != snapshot_signature()
+                or saved.get("journal_offset", 0) > journal_size()):
+            self.build(memories)
+            self.save()
+            return
+
+        self.clear()
+        for item_id, counts in saved["docs"].items():
+            self.doc_terms[item_id] = counts
+            length = sum(counts.values())
+            self.doc_len[item_id] = length
+            self.total_len += length
+            for term, tf in counts.items():
+                self.postings.setdefault(term, {})[item_id] = tf
+        for op in read_journal(saved["journal_offset"])[0]:
+            self.apply_op(op, memories)
+
+    def save(self):
+        """Save the index as of the current snapshot and journal (call under STORE_LOCK)."""
+        atomic_write_json(self.path, {"snapshot": snapshot_signature(),
+                                      "journal_offset": journal_size(), "docs": self.doc_terms})
+
+
+# ==================== STORAGE BACKENDS ====================
+def matches_filters(data: dict, filters: dict) -> bool:
+    """
+    Metadata filter: layer, tags (all of them), source (substring) and
+    created/updated ranges. Range bounds are ISO date(time) prefixes and
+    inclusive, so until="2026-01-08" covers that whole day.
+    """
+    if filters.get("layer") and data.get("layer") != filters["layer"]:
+        return False
+    if filters.get("tags") and not set(filters["tags"]) <= set(data.get("tags", [])):
+        return False
+    if filters.get("source") and filters["source"] not in (data.get("source") or ""):
+        return False
+    for field in ("created", "updated"):
+        value = data.get(field) or ""
+        since, until = filters.get(f"{field}_since"), filters.get(f"{field}_until")
+        if since and value < since:
+            return False
+        if until and value > until + "\uffff":
+            return False
+    return True
+
+
+class StorageBackend:
+    """
+    Interface shared by the storage backends.
+
+    Memory records are plain dicts ({"content", "layer", "tags", "source",
+    "created", "updated", "accessed", ...}) addressed by (layer, key).
+    """
+
+    name = "base"
+
+    def load_all(self) -> dict:
+        """Every memory as {layer: {key: data}}."""
+        raise NotImplementedError
+
+    def get(self, layer: str, key: str):
+        raise NotImplementedError
+
+    def find_layers(self, key: str) -> list:
+        """Layers that contain `key`."""
+        raise NotImplementedError
+
+    def put_many(self, items: list):
+        """Insert or replace [(layer, key, data), ...] in one write."""
+        raise NotImplementedError
+
+    def put(self, layer: str, key: str, data: dict):
+        self.put_many([(layer, key, data)])
+
+    def patch(self, layer: str, key: str, fields: dict):
+        raise NotImplementedError
+
+    def update(self, layer: str, key: str, change):
+        """
+        Read-modify-write without losing concurrent writes: `change(data)` gets
+        the latest stored record and returns the fields to patch. Returns the
+        updated record, or None if the memory does not exist.
+        """
+        raise NotImplementedError
+
+    def delete(self, layer: str, key: str) -> bool:
+        raise NotImplementedError
+
+    def transaction(self):
+        """
+        Context manager grouping the writes made inside it into one commit
+        (nested calls join the outer one); an exception discards them all.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def layer_counts(self) -> dict:
+        raise NotImplementedError
+
+    def items(self, layer: str = None):
+        """Iterate (layer, key, data), optionally restricted to one layer."""
+        raise NotImplementedError
+
+    def keyword_search(self, query: str, limit: int = None, item_ids=None) -> list:
+        """Keyword matches as [(score, layer, key, data)], best first, optionally within `item_ids`."""
+        raise NotImplementedError
+
+    def filter_ids(self, filters: dict) -> set:
+        """The "layer/key" ids of memories matching `filters` (see matches_filters)."""
+        raise NotImplementedError
+
+    def compact(self):
+        pass
+
+
+class JsonBackend(StorageBackend):
+    """
+    memories.json snapshot plus the memories.log journal (the default).
+
+    The loaded bank is cached together with the store version, snapshot and
+    journal offset it reflects. Writes are optimistic: under the exclusive
+    lock, a changed version means another process wrote since, so the cache
+    first catches up (replaying just the new journal entries when it can)
+    and our ops are applied on top before they are appended.
+    """
+
+    name = "json"
+
+    def __init__(self):
+        self._memories = None
+        self._keyword_index = None
+        self._tag_index = None  # tag -> {"layer/key"}, built on first filtered search
+        self._item_tags = {}
+        self._version = None
+        self._snapshot = None
+        self._journal_offset = 0
+        self._pending = None  # ops of the open transaction, appended when it ends
+
+    def _index_tags(self, item_id: str, tags):
+        for tag in self._item_tags.pop(item_id, ()):
+            ids = self._tag_index.get(tag)
+            ids.discard(item_id)
+            if not ids:
+                del self._tag_index[tag]
+        if tags is not None:
+            self._item_tags[item_id] = tuple(set(tags))
+            for tag in self._item_tags[item_id]:
+                self._tag_index.setdefault(tag, set()).add(item_id)
+
+    @property
+    def tag_index(self) -> dict:
+        if self._tag_index is None:
+            self._tag_index, self._item_tags = {}, {}
+            for layer, key, data in self.items():
+                self._index_tags(f"{layer}/{key}", data.get("tags", []))
+        return self._tag_index
+
+    @property
+    def memories(self) -> dict:
+        if self._memories is None:
+            with STORE_LOCK.shared():
+                self._memories = load_memories()
+                self._mark_synced()
+        return self._memories
+
+    @property
+    def keyword_index(self) -> KeywordIndex:
+        if self._keyword_index is None:
+            index = KeywordIndex(KEYWORD_INDEX_FILE)
+            with STORE_LOCK.shared(), timed("keyword_index_load"):
+                self._sync()
+                index.load(self.memories)
+            self._keyword_index = index
+        return self._keyword_index
+
+    def _mark_synced(self):
+        """Record the store state the cache now reflects (lock held)."""
+        self._version = STORE_LOCK.version()
+        self._snapshot = snapshot_signature()
+        self._journal_offset = journal_size()
+
+    def _sync(self) -> bool:
+        """Catch the cache up with other processes' writes (lock held). True if it had to."""
+        if self._memories is None:
+            self._memories = load_memories()
+            self._mark_synced()
+            return False
+        if STORE_LOCK.version() == self._version:
+            return False
+        tally("store_syncs")
+        if snapshot_signature() == self._snapshot and journal_size() >= self._journal_offset:
+            ops, _ = read_journal(self._journal_offset)
+            for op in ops:
+                apply_op(self._memories, op)
+            self._index_ops(ops)
+        else:
+            self._memories = load_memories()
+            self._keyword_index = None
+            self._tag_index = None
+        self._mark_synced()
+        return True
+
+    def _commit(self, ops: list):
+        if self._pending is not None:
+            self._pending.extend(ops)
+            return
+        with STORE_LOCK.exclusive():
+            if self._sync():
+                for op in ops:  # ours are newer than whatever was just replayed
+                    apply_op(self._memories, op)
+            self._index_ops(ops)
+            compacted = commit_ops(self._memories, ops)
+            self._mark_synced()
+            if compacted and self._keyword_index is not None:
+                self._keyword_index.save()
+
+    def _index_ops(self, ops: list):
+        if self._keyword_index is not None:
+            for op in ops:
+                self._keyword_index.apply_op(op, self._memories)
+        if self._tag_index is not None:
+            for op in ops:
+                item_id = f"{op.get('layer')}/{op.get('key')}"
+                if op["op"] == "put":
+                    self._index_tags(item_id, op["data"].get("tags", []))
+                elif op["op"] == "patch" and "tags" in op["fields"]:
+                    self._index_tags(item_id, op["fields"]["tags"])
+                elif op["op"] == "del":
+                    self._index_tags(item_id, None)
+                elif op["op"] == "clear":
+                    self._tag_index, self._item_tags = {}, {}
+
+    def load_all(self) -> dict:
+        return self.memories
+
+    def get(self, layer: str, key: str):
+        return self.memories.get(layer, {}).get(key)
+
+    def find_layers(self, key: str) -> list:
+        return [layer for layer, items in self.memories.items() if key in items]
+
+    def put_many(self, items: list):
+        ops = []
+        for layer, key, data in items:
+            self.memories.setdefault(layer, {})[key] = data
+            ops.append({"op": "put", "layer": layer, "key": key, "data": data})
+        if ops:
+            self._commit(ops)
+
+    def patch(self, layer: str, key: str, fields: dict):
+        item = self.get(layer, key)
+        if item is None:
+            return
+        item.update(fields)
+        self._commit([{"op": "patch", "layer": layer, "key": key, "fields": fields}])
+
+    def update(self, layer: str, key: str, change):
+        with STORE_LOCK.exclusive():
+            self._sync()
+            item = self.get(layer, key)
+            if item is None:
+                return None
+            self.patch(layer, key, change(item))
+        return item
+
+    def delete(self, layer: str, key: str) -> bool:
+        if self.memories.get(layer, {}).pop(key, None) is None:
+            return False
+        self._commit([{"op": "del", "layer": layer, "key": key}])
+        return True
+
+    @contextmanager
+    def transaction(self):
+        # The exclusive lock is held throughout, so nobody else can write in
+        # between and the ops queued by _commit are appended in one go at the end
+        if self._pending is not None:
+            yield
+            return
+        with STORE_LOCK.exclusive():
+            self._sync()
+            self._pending = []
+            try:
+                yield
+            except BaseException:
+                self._pending = None
+                self._memories = None  # drop the uncommitted changes; reloaded on next access
+                raise
+            ops, self._pending = self._pending, None
+            if ops:
+                self._commit(ops)
+
+    def clear(self):
+        if self._pending is not None:
+            self.memories.clear()
+            self._commit([{"op": "clear"}])
+            return
+        with STORE_LOCK.exclusive():
+            save_memories({})
+            self._memories = {}
+            self._tag_index = None
+            self._mark_synced()
+            if self._keyword_index is not None:
+                self._keyword_index.clear()
+                self._keyword_index.save()
+
+    def layer_counts(self) -> dict:
+        return {layer: len(items) for layer, items in self.memories.items()}
+
+    def items(self, layer: str = None):
+        for l, items in self.memories.items():
+            if layer and l != layer:
+                continue
+            for key, data in items.items():
+                yield l, key, data
+
+    def keyword_search(self, query: str, limit: int = None, item_ids=None) -> list:
+        results = []
+        matches = self.keyword_index.search(query)
+        if item_ids is not None:
+            matches = [(score, item_id) for score, item_id in matches if item_id in item_ids]
+        for score, item_id in matches[:limit]:
+            layer, key = item_id.split("/", 1)
+            data = self.get(layer, key)
+            if data is not None:
+                results.append((score, layer, key, data))
+        return results
+
+    def filter_ids(self, filters: dict) -> set:
+        layer, tags = filters.get("layer"), filters.get("tags")
+        if tags:
+            ids = set.intersection(*(self.tag_index.get(tag, set()) for tag in tags))
+            if layer:
+                ids = {i for i in ids if i.startswith(layer + "/")}
+        elif layer:
+            ids = {f"{layer}/{key}" for key in self.memories.get(layer, {})}
+        else:
+            ids = {f"{l}/{key}" for l, items in self.memories.items() for key in items}
+        rest = {k: v for k, v in filters.items() if k not in ("layer", "tags") and v}
+        if rest:
+            ids = {i for i in ids if matches_filters(self.get(*i.split("/", 1)), rest)}
+        return ids
+
+    def compact(self):
+        with STORE_LOCK.exclusive():
+            self._sync()
+            save_memories(self._memories)
+            self._mark_synced()
+            self.keyword_index.save()
+
+
+class SqliteBackend(StorageBackend):
+    """
+    SQLite store (memories.db) with indexed lookups.
+
+    (layer, key), key, tags, created, updated and accessed are indexed, so point
+    lookups never load the whole bank. Keyword search matches any query term
+    (OR, like the JSON backend's BM25) through an FTS5 trigram index ranked by
+    bm25; CJK runs are looked up by their trigrams. Only queries with no term
+    of three or more characters, or a build without FTS5, fall back to an
+    instr() scan.
+    """
+
+    name = "sqlite"
+    COLUMNS = ("content", "layer", "tags", "source", "created", "updated", "accessed")
+
+    def __init__(self, path: Path):
+        import sqlite3
+        ensure_dir()
+        fresh = not path.exists()
+        self.path = path
+        self.conn = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.has_fts = True
+        self._in_transaction = False
+        self._create_schema()
+        if fresh and (MEMORY_FILE.exists() or JOURNAL_FILE.exists()):
+            memories = load_memories()
+            self.put_many([(layer, key, data) for layer, items in memories.items()
+                           for key, data in items.items()])
+            print(f"[Migrate] Imported {sum(len(v) for v in memories.values())} memories "
+                  f"from {MEMORY_FILE.name} into {path.name}")
+
+    def _create_schema(self):
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS memories (
+                    id       INTEGER PRIMARY KEY,
+                    layer    TEXT NOT NULL,
+                    key      TEXT NOT NULL,
+                    content  TEXT NOT NULL DEFAULT '',
+                    tags     TEXT NOT NULL DEFAULT '[]',
+                    source   TEXT NOT NULL DEFAULT '',
+                    created  TEXT,
+                    updated  TEXT,
+                    accessed INTEGER NOT NULL DEFAULT 0,
+                    extra    TEXT NOT NULL DEFAULT '{}',
+                    UNIQUE (layer, key)
+                );
+                CREATE INDEX IF NOT EXISTS idx_memories_key ON memories(key);
+                CREATE INDEX IF NOT EXISTS idx_memories_created ON memories(created);
+                CREATE INDEX IF NOT EXISTS idx_memories_updated ON memories(updated);
+                CREATE INDEX IF NOT EXISTS idx_memories_accessed ON memories(accessed);
+                CREATE TABLE IF NOT EXISTS memory_tags (
+                    tag       TEXT NOT NULL,
+                    memory_id INTEGER NOT NULL,
+                    PRIMARY KEY (tag, memory_id)
+                );
+                CREATE INDEX IF NOT EXISTS idx_memory_tags_memory ON memory_tags(memory_id);
+            """)
+        try:
+            with self.conn:
+                self.conn.executescript("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(
+                        key, content, content='memories', content_rowid='id', tokenize='trigram');
+                    CREATE TRIGGER IF NOT EXISTS memories_ai AFTER INSERT ON memories BEGIN
+                        INSERT INTO memories_fts(rowid, key, content) VALUES (new.id, new.key, new.content);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS memories_ad AFTER DELETE ON memories BEGIN
+                        INSERT INTO memories_fts(memories_fts, rowid, key, content)
+                        VALUES ('delete', old.id, old.key, old.content);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS memories_au AFTER UPDATE OF key, content ON memories BEGIN
+                        INSERT INTO memories_fts(memories_fts, rowid, key, content)
+                        VALUES ('delete', old.id, old.key, old.content);
+                        INSERT INTO memories_fts(rowid, key, content) VALUES (new.id, new.key, new.content);
+                    END;
+                """)
+        except Exception as e:
+            self.has_fts = False
+            print(f"[Warning] SQLite FTS5 unavailable ({e}); keyword search uses LIKE.")
+
+    def _to_dict(self, row) -> dict:
+        data = {
+            "content": row["content"],
+            "layer": row["layer"],
+            "tags": json.loads(row["tags"]),
+            "source": row["source"],
+            "created": row["created"],
+            "updated": row["updated"],
+            "accessed": row["accessed"],
+        }
+        data.update(json.loads(row["extra"]))
+        return data
+
+    def _split(self, data: dict):
+        extra = {k: v for k, v in data.items() if k not in self.COLUMNS}
+        return (data.get("content", ""), json.dumps(data.get("tags", []), ensure_ascii=False),
+                data.get("source", "") or "", data.get("created"), data.get("updated"),
+                data.get("accessed", 0), json.dumps(extra, ensure_ascii=False))
+
+    @contextmanager
+    def _writing(self, immediate: bool = False):
+        """Commit on exit, unless a transaction() is open (it commits when it ends)."""
+        if self._in_transaction:
+            yield
+            return
+        with self.conn:
+            if immediate:
+                self.conn.execute("BEGIN IMMEDIATE")
+            yield
+
+    def _set_tags(self, memory_id: int, tags: list):
+        self.conn.execute("DELETE FROM memory_tags WHERE memory_id = ?", (memory_id,))
+        self.conn.executemany("INSERT OR IGNORE INTO memory_tags(tag, memory_id) VALUES (?, ?)",
+                              [(tag, memory_id) for tag in tags])
+
+    def load_all(self) -> dict:
+        memories = {}
+        for layer, key, data in self.items():
+            memories.setdefault(layer, {})[key] = data
+        return memories
+
+    def get(self, layer: str, key: str):
+        row = self.conn.execute("SELECT * FROM memories WHERE layer = ? AND key = ?",
+                                (layer, key)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def find_layers(self, key: str) -> list:
+        return [r[0] for r in self.conn.execute(
+            "SELECT layer FROM memories WHERE key = ? ORDER BY id", (key,))]
+
+    def put_many(self, items: list):
+        with self._writing():
+            for layer, key, data in items:
+                values = self._split(data)
+                memory_id = self.conn.execute("""
+                    INSERT INTO memories(layer, key, content, tags, source, created, updated, accessed, extra)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(layer, key) DO UPDATE SET
+                        content = excluded.content, tags = excluded.tags, source = excluded.source,
+                        created = excluded.created, updated = excluded.updated,
+                        accessed = excluded.accessed, extra = excluded.extra
+                    RETURNING id
+                """, (layer, key) + values).fetchone()[0]
+                self._set_tags(memory_id, data.get("tags", []))
+
+    def patch(self, layer: str, key: str, fields: dict):
+        self.update(layer, key, lambda data: fields)
+
+    def update(self, layer: str, key: str, change):
+        # Take the write lock before reading, so the read-modify-write is atomic
+        with self._writing(immediate=True):
+            row = self.conn.execute("SELECT * FROM memories WHERE layer = ? AND key = ?",
+                                    (layer, key)).fetchone()
+            if row is None:
+                return None
+            data = self._to_dict(row)
+            fields = change(data)
+            data.update(fields)
+            self.conn.execute("""
+                UPDATE memories SET content = ?, tags = ?, source = ?, created = ?, updated = ?,
+                    accessed = ?, extra = ? WHERE id = ?
+            """, self._split(data) + (row["id"],))
+            if "tags" in fields:
+                self._set_tags(row["id"], data["tags"])
+        return data
+
+    def delete(self, layer: str, key: str) -> bool:
+        with self._writing():
+            row = self.conn.execute("DELETE FROM memories WHERE layer = ? AND key = ? RETURNING id",
+                                    (layer, key)).fetchone()
+            if row is None:
+                return False
+            self.conn.execute("DELETE FROM memory_tags WHERE memory_id = ?", (row[0],))
+        return True
+
+    @contextmanager
+    def transaction(self):
+        if self._in_transaction:
+            yield
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        self._in_transaction = True
+        try:
+            yield
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            self._in_transaction = False
+
+    def clear(self):
+        with self._writing():
+            self.conn.execute("DELETE FROM memories")
+            self.conn.execute("DELETE FROM memory_tags")
+
+    def layer_counts(self) -> dict:
+        return {r[0]: r[1] for r in self.conn.execute(
+            "SELECT layer, COUNT(*) FROM memories GROUP BY layer ORDER BY MIN(id)")}
+
+    def items(self, layer: str = None):
+        if layer:
+            rows = self.conn.execute("SELECT * FROM memories WHERE layer = ? ORDER BY id", (layer,))
+        else:
+            rows = self.conn.execute("SELECT * FROM memories ORDER BY id")
+        for row in rows:
+            yield row["layer"], row["key"], self._to_dict(row)
+
+    def keyword_search(self, query: str, limit: int = None, item_ids=None) -> list:
+        if item_ids is not None:
+            matches = [m for m in self.keyword_search(query) if f"{m[1]}/{m[2]}" in item_ids]
+            return matches[:limit]
+        terms = []
+        for match in _TOKEN_RE.finditer(query.lower()):
+            run = match.group()
+            if _CJK_RE.match(run) and len(run) > 3:
+                terms.extend(run[i:i + 3] for i in range(len(run) - 2))  # 连续中日韩文字按三元组查
+            else:
+                terms.append(run)
+        terms = list(dict.fromkeys(terms))
+        fts_terms = [t for t in terms if len(t) >= 3] if self.has_fts else []
+        if fts_terms:
+            match = " OR ".join('"' + t.replace('"', '""') + '"' for t in fts_terms)
+            rows = self.conn.execute("""
+                SELECT m.*, bm25(memories_fts) AS rank FROM memories_fts
+                JOIN memories m ON m.id = memories_fts.rowid
+                WHERE memories_fts MATCH ? ORDER BY rank LIMIT ?
+            """, (match, -1 if limit is None else limit))
+            return [(-row["rank"], row["layer"], row["key"], self._to_dict(row)) for row in rows]
+        if not terms:
+            return []
+        # Trigrams cannot match a query made only of 1-2 character terms ("ai", "记忆")
+        hits = " + ".join("(instr(lower(key || ' ' || content), ?) > 0)" for _ in terms)
+        rows = self.conn.execute(f"""
+            SELECT * FROM (SELECT *, {hits} AS hits FROM memories)
+            WHERE hits > 0 ORDER BY hits DESC, id LIMIT ?
+        """, (*terms, -1 if limit is None else limit))
+        return [(0.5 * row["hits"], row["layer"], row["key"], self._to_dict(row)) for row in rows]
+
+    def filter_ids(self, filters: dict) -> set:
+        clauses, params = [], []
+        if filters.get("layer"):
+            clauses.append("m.layer = ?")
+            params.append(filters["layer"])
+        for tag in filters.get("tags") or []:
+            clauses.append("m.id IN (SELECT memory_id FROM memory_tags WHERE tag = ?)")
+            params.append(tag)
+        if filters.get("source"):
+            clauses.append("instr(m.source, ?) > 0")
+            params.append(filters["source"])
+        for field in ("created", "updated"):
+            if filters.get(f"{field}_since"):
+                clauses.append(f"m.{field} >= ?")
+                params.append(filters[f"{field}_since"])
+            if filters.get(f"{field}_until"):
+                clauses.append(f"m.{field} <= ?")
+                params.append(filters[f"{field}_until"] + "\uffff")
+        where = " AND ".join(clauses) or "1"
+        return {f"{layer}/{key}" for layer, key in self.conn.execute(
+            f"SELECT m.layer, m.key FROM memories m WHERE {where}", params)}
+
+    def compact(self):
+        self.conn.execute("VACUUM")
+
+
+_backend = None
+
+
+def get_backend() -> StorageBackend:
+    """The configured storage backend (CLAUDE_MEMORY_BACKEND=json|sqlite)."""
+    global _backend
+    if _backend is None:
+        if STORAGE_BACKEND == "sqlite":
+            _backend = SqliteBackend(SQLITE_FILE)
+        else:
+            _backend = JsonBackend()
+    return _backend
+
+
+def export_memories(path: str):
+    """Write every memory to `path` in the memories.json layout."""
+    memories = get_backend().load_all()
+    atomic_write_json(Path(path), memories, indent=2)
+    print(f"[Export] {sum(len(v) for v in memories.values())} memories -> {path}")
+
+
+def import_memories(path: str):
+    """Merge memories from a memories.json-style file into the current backend."""
+    with open(path, encoding='utf-8') as f:
+        memories = json.load(f)
+    migrate_embeddings(memories)
+    items = [(layer, key, data) for layer, layer_items in memories.items()
+             for key, data in layer_items.items()]
+    get_backend().put_many(items)
+    print(f"[Import] {len(items)} memories <- {path}")
+
+
+# ==================== VECTOR STORE ====================
+class VectorStore:
+    """
+    Embeddings kept out of memories.json in a memory-mapped .npy matrix.
+
+    vectors.npy holds one L2-normalized row per memory; vectors.json maps
+    "layer/key" to a row. Rows are preallocated in blocks and recycled after
+    deletes, so adding a vector writes a single row in place. Row assignments
+    made since the last snapshot are appended to vectors.log (one JSON op per
+    line, replayed on load), so a flush writes the size of the change; the
+    snapshot is only rewritten when the matrix grows, its layout changes or
+    the log gets long. Nothing is read from disk until a vector is actually
+    requested.
+
+    Changes go through writing(), which holds STORE_LOCK exclusively, first
+    catches up with what other processes wrote (sync()), then flushes and
+    bumps the store version; readers sync under the shared lock (reading()).
+    Replaced files (a grown matrix, rebuilt codes) are written to unique
+    temp names and renamed into place.
+
+    Optionally the rows also get quantized codes, kept in step by set():
+    int8 (vectors.int8.npy plus a per-row scale in vectors.scale.npy, 4x
+    smaller than float32) or sign bits of the vector minus the mean of the
+    stored vectors at build time (vectors.bits.npy, 32x smaller). With
+    `quant`, search() scans only the codes for a shortlist of QUANT_RERANK *
+    top_k rows and rescores those at full precision.
+    """
+
+    GROWTH = 256
+    SCAN_BLOCK = 65536
+    CODE_BLOCK = 4096  # int8 rows upcast per step, so the float copy stays in cache
+    QUANT_MODES = ("int8", "binary")
+
+    def __init__(self, matrix_path: Path, map_path: Path, dtype: str = "float32", quant: str = "none"):
+        self.matrix_path = matrix_path
+        self.map_path = map_path
+        self.dtype = np.dtype(dtype)
+        self.quant = quant
+        self._meta = None
+        self._matrix = None
+        self._writable = False
+        self._row_ids = None
+        self._codes = {}  # mode -> (memmap, ...)
+        self.log_path = map_path.with_suffix(".log")
+        self._log = []          # row-map ops not yet appended to log_path
+        self._rewrite = False   # the snapshot itself must be rewritten
+        self._log_offset = 0    # bytes of log_path already applied
+        self._log_lines = 0
+        self._snapshot = None   # file_signature() of map_path when loaded
+        self._version = None    # STORE_LOCK version the in-memory state reflects
+        self._depth = 0         # nesting of writing()
+        self.generation = 0     # bumped whenever the rows change behind our back
+
+    @staticmethod
+    def item_id(layer: str, key: str) -> str:
+        return f"{layer}/{key}"
+
+    @property
+    def meta(self) -> dict:
+        if self._meta is None:
+            with STORE_LOCK.shared():
+                self._load()
+        return self._meta
+
+    def _load(self):
+        self._version = STORE_LOCK.version()
+        self._snapshot = file_signature(self.map_path)
+        if self._snapshot is not None:
+            with open(self.map_path, encoding='utf-8') as f:
+                self._meta = json.load(f)
+            self.dtype = np.dtype(self._meta.get("dtype", self.dtype.name))
+        else:
+            self._meta = {"dim": None, "dtype": self.dtype.name,
+                          "capacity": 0, "next_row": 0, "rows": {}, "free": []}
+        self._meta.setdefault("hashes", {})
+        self._meta.setdefault("quant", [])  # modes whose codes exist and are kept current
+        self._log_offset = self._log_lines = 0
+        self._replay_log()
+
+    def sync(self) -> bool:
+        """Catch up with other processes' writes (STORE_LOCK held). True if the rows changed."""
+        if self._meta is None or STORE_LOCK.version() == self._version:
+            return False
+        self._version = STORE_LOCK.version()
+        size = self.log_path.stat().st_size if self.log_path.exists() else 0
+        if file_signature(self.map_path) == self._snapshot and size >= self._log_offset:
+            if size == self._log_offset:
+                return False
+            self._replay_log()
+        else:
+            self._load()
+        tally("vector_syncs")
+        self._matrix = None  # may have been replaced by a bigger one
+        self._codes.clear()
+        self._row_ids = None
+        self.generation += 1
+        return True
+
+    @contextmanager
+    def reading(self):
+        """Shared-lock scope for a consistent view of the rows."""
+        with STORE_LOCK.shared():
+            self.sync()
+            yield self
+
+    @contextmanager
+    def writing(self):
+        """
+        Exclusive-lock scope for changing the store. Nested scopes join the
+        outer one, which flushes once and bumps the version; an exception
+        drops the unflushed changes.
+        """
+        with STORE_LOCK.exclusive():
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield self
+                finally:
+                    self._depth -= 1
+                return
+            self.sync()
+            self._depth = 1
+            try:
+                yield self
+            except BaseException:
+                self._meta, self._matrix, self._row_ids = None, None, None
+                self._codes.clear()
+                self._log, self._rewrite = [], False
+                raise
+            finally:
+                self._depth = 0
+            if self.flush():
+                self._version = STORE_LOCK.bump()
+
+    def _replay_log(self):
+        """Apply the row-map ops appended to the log since `_log_offset`."""
+        if not self.log_path.exists():
+            return
+        ops = []
+        with open(self.log_path, 'rb') as f:
+            f.seek(self._log_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # torn tail of an interrupted append
+                try:
+                    ops.append(json.loads(line))
+                except ValueError:
+                    break
+                self._log_offset += len(line)
+        if not ops:
+            return
+        meta = self._meta
+        rows, hashes, free = meta["rows"], meta["hashes"], set(meta["free"])
+        for op in ops:
+            item_id = op.get("set") or op.get("del")
+            old = rows.pop(item_id, None)
+            if "del" in op:
+                hashes.pop(item_id, None)
+                if old is not None:
+                    free.add(old)
+                continue
+            row = op["row"]
+            if old is not None and old != row:
+                free.add(old)
+            rows[item_id] = row  # re-inserted at the end: the log also records recency
+            if op.get("hash"):
+                hashes[item_id] = op["hash"]
+            else:
+                hashes.pop(item_id, None)
+            free.discard(row)
+            if row >= meta["next_row"]:
+                free.update(range(meta["next_row"], row))
+                meta["next_row"] = row + 1
+        meta["free"] = sorted(free)
+        self._log_lines += len(ops)
+        self._row_ids = None
+
+    @property
+    def rows(self) -> dict:
+        return self.meta["rows"]
+
+    @property
+    def hashes(self) -> dict:
+        """item id -> content_hash() of the text its vector was computed from."""
+        return self.meta["hashes"]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, item_id: str):
+        return item_id in self.rows
+
+    def matrix(self, writable: bool = False):
+        """Return the (capacity, dim) memmap, or None if nothing is stored yet."""
+        if not self.matrix_path.exists():
+            return None
+        if self._matrix is None or (writable and not self._writable):
+            self._matrix = np.load(self.matrix_path, mmap_mode='r+' if writable else 'r')
+            self._writable = writable
+        return self._matrix
+
+    def get(self, layer: str, key: str):
+        row = self.rows.get(self.item_id(layer, key))
+        if row is None:
+            return None
+        return np.asarray(self.matrix()[row], dtype=np.float32)
+
+    def set(self, layer: str, key: str, vector, text_hash: str = None):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+
+        meta = self.meta
+        if meta["dim"] is not None and meta["dim"] != vector.shape[0]:
+            print(f"[Warning] Embedding dimension changed ({meta['dim']} -> {vector.shape[0]}). "
+                  "Dropping stored vectors; run --reindex.")
+            self.clear()
+            meta = self.meta
+        if meta["dim"] is None:
+            meta["dim"] = vector.shape[0]
+            self._rewrite = True
+
+        item_id = self.item_id(layer, key)
+        row = meta["rows"].get(item_id)
+        if row is None:
+            if meta["free"]:
+                row = meta["free"].pop()
+            else:
+                row = meta["next_row"]
+                meta["next_row"] += 1
+        if row >= meta["capacity"]:
+            self._grow(row + 1)
+        self.matrix(writable=True)[row] = vector.astype(self.dtype)
+        for mode in meta["quant"]:
+            for array, value in zip(self.codes(mode, writable=True), self.quantize(mode, vector[None], meta)):
+                array[row] = value[0]
+        meta["rows"][item_id] = row
+        if text_hash:
+            meta["hashes"][item_id] = text_hash
+        else:
+            meta["hashes"].pop(item_id, None)
+        self._log.append({"set": item_id, "row": int(row), "hash": text_hash})
+        self._row_ids = None
+
+    def delete(self, layer: str, key: str) -> bool:
+        row = self.rows.pop(self.item_id(layer, key), None)
+        self.hashes.pop(self.item_id(layer, key), None)
+        if row is None:
+            return False
+        self.meta["free"].append(row)
+        self._log.append({"del": self.item_id(layer, key)})
+        self._row_ids = None
+        return True
+
+    def touch(self, layer: str, key: str):
+        """Move an entry to the end of the map (the EmbeddingCache LRU order); logged like a set."""
+        item_id = self.item_id(layer, key)
+        row = self.rows.pop(item_id)
+        self.rows[item_id] = row
+        self._log.append({"set": item_id, "row": int(row), "hash": self.hashes.get(item_id)})
+
+    def row_ids(self):
+        """Array mapping row -> item id ("" for free rows), cached until the next change."""
+        if self._row_ids is None:
+            row_ids = np.full(self.meta["next_row"], "", dtype=object)
+            for item_id, row in self.rows.items():
+                row_ids[row] = item_id
+            self._row_ids = row_ids
+        return self._row_ids
+
+    def scores(self, query_vector, rows=None):
+        """Cosine similarity of `query_vector` against every row (or just `rows`)."""
+        query = np.asarray(query_vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        matrix = self.matrix()
+        if rows is not None:
+            tally("vectors_scored", len(rows))
+            return np.asarray(matrix[rows], dtype=np.float32) @ query
+        n = self.meta["next_row"]
+        tally("vectors_scored", n)
+        out = np.empty(n, dtype=np.float32)
+        # Blocked so float16 stores are upcast a slice at a time
+        for start in range(0, n, self.SCAN_BLOCK):
+            end = min(start + self.SCAN_BLOCK, n)
+            out[start:end] = np.asarray(matrix[start:end], dtype=np.float32) @ query
+        return out
+
+    def search(self, query_vector, top_k: int = 5, item_ids=None) -> list:
+        """
+        Top-k (score, item_id) pairs by cosine similarity, best first. With
+        `item_ids`, only those rows are scored (e.g. a metadata-filtered subset).
+        """
+        if not self.rows or self.matrix() is None:
+            return []
+        if self.meta["dim"] != np.size(query_vector):
+            print(f"[Warning] Query dimension {np.size(query_vector)} does not match "
+                  f"stored vectors ({self.meta['dim']}). Run --reindex.")
+            return []
+        rows = None
+        if item_ids is not None:
+            rows = np.sort(np.fromiter((self.rows[i] for i in item_ids if i in self.rows), dtype=np.int64))
+        if self.quant in self.QUANT_MODES:
+            return self.shortlist_search(query_vector, top_k, self.quant, QUANT_RERANK, rows)
+        if rows is not None:
+            return self._top_k(self.scores(query_vector, rows), rows, top_k)
+        scores = self.scores(query_vector)
+        if self.meta["free"]:
+            scores[self.meta["free"]] = -np.inf
+        return self._top_k(scores, np.arange(len(scores)), top_k)
+
+    # ---- quantized codes ----
+    def code_paths(self, mode: str) -> list:
+        stem = self.matrix_path.with_suffix("")
+        names = {"int8": [".int8.npy", ".scale.npy"], "binary": [".bits.npy"]}[mode]
+        return [stem.with_name(stem.name + suffix) for suffix in names]
+
+    @staticmethod
+    def quantize(mode: str, vectors, meta: dict) -> tuple:
+        """Codes for (n, dim) unit vectors: (int8 rows, per-row scales) or (packed sign bits,)."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if mode == "int8":
+            scale = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+            return np.round(vectors / scale[:, None]).astype(np.int8), scale.astype(np.float32)
+        # Embeddings share a common direction; centering makes the sign bits informative
+        return (np.packbits(vectors > np.asarray(meta.get("center") or 0.0, dtype=np.float32), axis=1),)
+
+    def codes(self, mode: str, writable: bool = False):
+        """The memmapped codes for `mode`, built from the full-precision rows if missing."""
+        if mode not in self.meta["quant"] or not all(p.exists() for p in self.code_paths(mode)):
+            self.build_codes(mode)
+        cached = self._codes.get(mode)
+        if cached is None or (writable and not cached[0]):
+            arrays = tuple(np.load(p, mmap_mode='r+' if writable else 'r') for p in self.code_paths(mode))
+            self._codes[mode] = cached = (writable, arrays)
+        return cached[1]
+
+    def build_codes(self, mode: str):
+        with self.writing():
+            if mode not in self.meta["quant"] or not all(p.exists() for p in self.code_paths(mode)):
+                self._build_codes(mode)
+
+    def _build_codes(self, mode: str):
+        meta = self.meta
+        print(f"[Quant] Building {mode} codes for {len(self.rows)} vectors...")
+        matrix = self.matrix()
+        if mode == "binary":
+            live = np.fromiter(self.rows.values(), dtype=np.int64, count=len(self.rows))
+            sample = np.sort(np.random.default_rng(0).choice(live, min(len(live), 10000), replace=False))
+            meta["center"] = np.asarray(matrix[sample], dtype=np.float32).mean(axis=0).tolist()
+        sample = self.quantize(mode, np.zeros((1, meta["dim"]), dtype=np.float32), meta)
+        paths = self.code_paths(mode)
+        tmps = [temp_path(p, ".tmp.npy") for p in paths]
+        arrays = [np.lib.format.open_memmap(tmp, mode='w+', dtype=a.dtype, shape=(meta["capacity"],) + a.shape[1:])
+                  for tmp, a in zip(tmps, sample)]
+        for start in range(0, meta["next_row"], self.SCAN_BLOCK):
+            end = min(start + self.SCAN_BLOCK, meta["next_row"])
+            for array, value in zip(arrays, self.quantize(mode, matrix[start:end], meta)):
+                array[start:end] = value
+        for array in arrays:
+            array.flush()
+        del arrays
+        for tmp, path in zip(tmps, paths):
+            os.replace(tmp, path)
+        self._codes.pop(mode, None)
+        if mode not in meta["quant"]:
+            meta["quant"].append(mode)
+        self._rewrite = True
+
+    def approx_scores(self, query, mode: str, rows=None):
+        """Similarity of every row (or `rows`) to `query` estimated from codes; higher is closer."""
+        codes = self.codes(mode)
+        n = self.meta["next_row"] if rows is None else len(rows)
+        tally("codes_scanned", n)
+        out = np.empty(n, dtype=np.float32)
+        if mode == "binary":
+            query_bits = self.quantize(mode, query[None], self.meta)[0][0]
+        step = self.CODE_BLOCK if mode == "int8" else self.SCAN_BLOCK
+        for start in range(0, n, step):
+            end = min(start + step, n)
+            block = slice(start, end) if rows is None else rows[start:end]
+            if mode == "int8":
+                out[start:end] = (codes[0][block].astype(np.float32) @ query) * codes[1][block]
+            else:
+                out[start:end] = -popcount_rows(np.bitwise_xor(codes[0][block], query_bits))
+        return out
+
+    def shortlist_search(self, query_vector, top_k: int, mode: str, factor: int, rows=None) -> list:
+        """Top-k by full-precision rescoring of the factor * top_k best rows by `mode` codes."""
+        query = np.asarray(query_vector, dtype=np.float32).ravel()
+        query = query / max(np.linalg.norm(query), 1e-12)
+        approx = self.approx_scores(query, mode, rows)
+        if rows is None:
+            rows = np.arange(len(approx))
+            if self.meta["free"]:
+                approx[self.meta["free"]] = -np.inf
+        n = min(len(approx), max(top_k, factor * top_k))
+        if n <= 0:
+            return []
+        shortlist = np.sort(rows[np.argpartition(-approx, n - 1)[:n]])
+        return self._top_k(self.scores(query, shortlist), shortlist, top_k)
+
+    def _top_k(self, scores, rows, top_k: int) -> list:
+        k = min(top_k, len(self.rows), len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        row_ids = self.row_ids()
+        return [(float(scores[i]), row_ids[rows[i]]) for i in top if row_ids[rows[i]]]
+
+    def _grow(self, min_rows: int):
+        meta = self.meta
+        capacity = max(min_rows, meta["capacity"] * 2, self.GROWTH)
+        tmp = temp_path(self.matrix_path, ".tmp.npy")
+        new = np.lib.format.open_memmap(tmp, mode='w+', dtype=self.dtype,
+                                        shape=(capacity, meta["dim"]))
+        old = self.matrix()
+        if old is not None and meta["capacity"]:
+            new[:meta["capacity"]] = old[:meta["capacity"]]
+        new.flush()
+        del new
+        self._matrix = None
+        os.replace(tmp, self.matrix_path)
+        for mode in meta["quant"]:
+            for path in self.code_paths(mode):
+                old = np.load(path, mmap_mode='r')
+                tmp = temp_path(path, ".tmp.npy")
+                new = np.lib.format.open_memmap(tmp, mode='w+', dtype=old.dtype, shape=(capacity,) + old.shape[1:])
+                new[:len(old)] = old
+                new.flush()
+                del new, old
+                os.replace(tmp, path)
+        self._codes.clear()
+        meta["capacity"] = capacity
+        self._rewrite = True
+
+    def flush(self) -> bool:
+        """
+        Write pending changes (exclusive lock held): matrix rows in place, then
+        the row-map ops. Returns False if there were none.
+        """
+        if self._meta is None:
+            return False
+        if self._matrix is not None and self._writable:
+            self._matrix.flush()
+        for writable, arrays in self._codes.values():
+            if writable:
+                for array in arrays:
+                    array.flush()
+        if not self._rewrite and not self._log:
+            return False
+        ensure_dir()
+        if self._rewrite or self._log_lines + len(self._log) > max(1024, len(self.rows) // 4):
+            with timed("vector_map_save"):
+                atomic_write_json(self.map_path, self._meta)
+            if self.log_path.exists():
+                self.log_path.unlink()
+            self._snapshot = file_signature(self.map_path)
+            self._log_offset = self._log_lines = 0
+        else:
+            payload = "".join(json.dumps(op, ensure_ascii=False) + "\n" for op in self._log).encode('utf-8')
+            with open(self.log_path, 'ab') as f:
+                f.write(payload)
+            self._log_offset += len(payload)
+            self._log_lines += len(self._log)
+        self._log = []
+        self._rewrite = False
+        return True
+
+    def clear(self):
+        with STORE_LOCK.exclusive():
+            self._clear()
+            self._version = STORE_LOCK.bump()
+
+    def _clear(self):
+        self._matrix = None
+        self._meta = None
+        self._row_ids = None
+        self._codes.clear()
+        self._log, self._rewrite = [], False
+        self.generation += 1
+        for path in [self.matrix_path, self.map_path, self.log_path] + [p for mode in self.QUANT_MODES
+                                                                        for p in self.code_paths(mode)]:
+            if path.exists():
+                path.unlink()
+
+
+_vector_store = None
+
+if hasattr(np, "bitwise_count"):
+    def popcount_rows(bits):
+        """Set bits per row of a packed (n, bytes) uint8 array."""
+        if bits.shape[1] % 8 == 0:
+            bits = bits.view(np.uint64)
+        return np.bitwise_count(bits).sum(axis=1, dtype=np.int32)
+else:  # NumPy < 2.0
+    _POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount_rows(bits):
+        return _POPCOUNT[bits].sum(axis=1, dtype=np.int32)
+
+
+def content_hash(text: str) -> str:
+    """Hash of (model, text) used to tell whether a stored vector is still current."""
+    return hashlib.sha1(f"{MODEL_NAME}\0{text}".encode('utf-8')).hexdigest()[:20]
+
+
+def get_vector_store() -> VectorStore:
+    global _vector_store
+    if _vector_store is None:
+        _vector_store = VectorStore(VECTOR_FILE, VECTOR_MAP_FILE, VECTOR_DTYPE, VECTOR_QUANT)
+    return _vector_store
+
+
+def evaluate_quantization(queries: int = 200, top_k: int = 5) -> list:
+    """
+    Measure the recall quantized search gives up on this bank. Stored vectors
+    serve as queries (their own memory excluded from the results); recall@k
+    is the share of the exact top-k that each mode finds, with a shortlist
+    of top_k (codes alone) and of QUANT_RERANK * top_k (the search default).
+    """
+    store = get_vector_store()
+    if len(store) <= top_k:
+        print(f"[Quant] Need more than {top_k} stored vectors (have {len(store)}); run --reindex")
+        return []
+    rng = np.random.default_rng(0)
+    live = np.fromiter(store.rows.values(), dtype=np.int64, count=len(store))
+    sample = np.sort(rng.choice(live, min(queries, len(live)), replace=False))
+    vectors = np.asarray(store.matrix()[sample], dtype=np.float32)
+    row_ids = store.row_ids()
+    for mode in store.QUANT_MODES:
+        store.codes(mode)  # build before timing
+
+    def run(search):
+        found, start = [], time.perf_counter()
+        for row, vector in zip(sample, vectors):
+            found.append([item_id for _, item_id in search(vector, top_k + 1) if item_id != row_ids[row]][:top_k])
+        return found, (time.perf_counter() - start) * 1000 / len(sample)
+
+    quant, store.quant = store.quant, "none"
+    try:
+        exact, exact_ms = run(store.search)
+    finally:
+        store.quant = quant
+    dim = store.meta["dim"]
+    report = [{"mode": store.dtype.name, "bytes": dim * store.dtype.itemsize, "shortlist": None,
+               "recall": 1.0, "ms": exact_ms}]
+    for mode, size in (("int8", dim + 4), ("binary", (dim + 7) // 8)):
+        for factor in sorted({1, QUANT_RERANK}):
+            found, ms = run(lambda vector, k: store.shortlist_search(vector, k, mode, factor))
+            recall = np.mean([len(set(a) & set(e)) / max(1, len(e)) for a, e in zip(found, exact)])
+            report.append({"mode": mode, "bytes": size, "shortlist": factor * top_k,
+                           "recall": float(recall), "ms": ms})
+
+    print(f"[Quant] recall@{top_k} against exact search: {len(sample)} queries, "
+          f"{len(store)} vectors of dim {dim}")
+    print(f"  {'mode':<8} {'bytes/vec':>9} {'shortlist':>9} {f'recall@{top_k}':>10} {'ms/query':>9}")
+    for r in report:
+        print(f"  {r['mode']:<8} {r['bytes']:>9} {r['shortlist'] or '-':>9} {r['recall']:>10.3f} {r['ms']:>9.2f}")
+    return report
+
+
+# ==================== ANN INDEX ====================
+class IVFIndex:
+    """
+    Inverted-file approximate nearest-neighbour index over VectorStore rows.
+
+    Spherical k-means centroids partition the rows into lists; a query only
+    scores the rows in its `nprobe` closest lists. Raising nprobe trades
+    latency for recall (nprobe == number of lists is an exact search).
+
+    Changes are made and saved inside the store's writing() scope (see
+    vector_writes()); `signature` tells when another process replaced the
+    file, and `generation` when the store's rows moved on without it.
+    """
+
+    TRAIN_SAMPLES_PER_LIST = 64
+    KMEANS_ITERS = 10
+
+    def __init__(self, path: Path, store: VectorStore):
+        self.path = path
+        self.store = store
+        self.centroids = None
+        self.assign = np.full(0, -1, dtype=np.int32)
+        self.trained_size = 0
+        self._lists = None
+        self.signature = None
+        self.generation = store.generation
+        self.dirty = False
+
+    def load(self) -> bool:
+        with STORE_LOCK.shared():
+            self.signature = file_signature(self.path)
+            if self.signature is None:
+                return False
+            with np.load(self.path) as data:
+                self.centroids = data["centroids"]
+                self.assign = data["assign"]
+                self.trained_size = int(data["trained_size"])
+            self.store.sync()
+            if self.drop_if_dim_changed():
+                return False
+            self._catch_up()
+        return True
+
+    def drop_if_dim_changed(self) -> bool:
+        """Delete an index trained on vectors of another dimension (the model changed). True if so."""
+        dim = self.store.meta["dim"]
+        if self.centroids is None or dim is None or self.centroids.shape[1] == dim:
+            return False
+        print(f"[ANN] Stored vectors are now {dim}-dimensional; dropping the index "
+              f"trained on {self.centroids.shape[1]}")
+        self.clear()
+        return True
+
+    def save(self):
+        """Write the index (exclusive lock held, within the store's writing())."""
+        tmp = temp_path(self.path, ".tmp.npz")
+        np.savez(tmp, centroids=self.centroids, assign=self.assign,
+                 trained_size=np.int64(self.trained_size))
+        os.replace(tmp, self.path)
+        self.signature = file_signature(self.path)
+        self.dirty = False
+
+    def clear(self):
+        self.centroids = None
+        self.assign = np.full(0, -1, dtype=np.int32)
+        self._lists = None
+        with STORE_LOCK.exclusive():
+            if self.path.exists():
+                self.path.unlink()
+        self.signature = None
+        self.dirty = False
+
+    def build(self):
+        """Train centroids on a sample of stored vectors and assign every row."""
+        store = self.store
+        live = np.fromiter(store.rows.values(), dtype=np.int64, count=len(store))
+        n_lists = int(min(4096, max(16, np.sqrt(len(live)))))
+        n_lists = min(n_lists, len(live))
+        rng = np.random.default_rng(0)
+        sample_size = min(len(live), n_lists * self.TRAIN_SAMPLES_PER_LIST)
+        sample = np.sort(rng.choice(live, sample_size, replace=False))
+        data = np.asarray(store.matrix()[sample], dtype=np.float32)
+
+        centroids = data[rng.choice(len(data), n_lists, replace=False)].copy()
+        for _ in range(self.KMEANS_ITERS):
+            labels = np.argmax(data @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, data)
+            counts = np.bincount(labels, minlength=n_lists)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty]
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        self.centroids = centroids
+        self.assign = np.full(store.meta["next_row"], -1, dtype=np.int32)
+        for start in range(0, len(live), VectorStore.SCAN_BLOCK):
+            rows = live[start:start + VectorStore.SCAN_BLOCK]
+            self.assign[rows] = self._nearest(np.asarray(store.matrix()[rows], dtype=np.float32))
+        self.trained_size = len(live)
+        self._lists = None
+        self.generation = store.generation
+        self.dirty = True
+
+    def _nearest(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def _catch_up(self):
+        """Assign rows written by processes that did not update the index."""
+        store = self.store
+        if len(self.assign) < store.meta["next_row"]:
+            extra = np.full(store.meta["next_row"] - len(self.assign), -1, dtype=np.int32)
+            self.assign = np.concatenate([self.assign, extra])
+        live = np.fromiter(store.rows.values(), dtype=np.int64, count=len(store))
+        missing = live[self.assign[live] < 0]
+        if len(missing):
+            self.assign[missing] = self._nearest(np.asarray(store.matrix()[missing], dtype=np.float32))
+            self._lists = None
+        self.generation = store.generation
+
+    def add(self, row: int):
+        if self.centroids is None or self.drop_if_dim_changed():
+            return
+        if row >= len(self.assign):
+            extra = np.full(row + 1 - len(self.assign), -1, dtype=np.int32)
+            self.assign = np.concatenate([self.assign, extra])
+        vector = np.asarray(self.store.matrix()[row], dtype=np.float32)
+        self.assign[row] = self._nearest(vector[None, :])[0]
+        self._lists = None
+        self.dirty = True
+
+    def remove(self, row: int):
+        if row < len(self.assign):
+            self.assign[row] = -1
+            self._lists = None
+            self.dirty = True
+
+    @property
+    def stale(self) -> bool:
+        return self.centroids is None or len(self.store) > 2 * max(self.trained_size, 1)
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            order = np.argsort(self.assign, kind='stable').astype(np.int64)
+            bounds = np.searchsorted(self.assign[order], np.arange(len(self.centroids) + 1))
+            self._lists = (order, bounds)
+        return self._lists
+
+    def search(self, query_vector, top_k: int = 5, nprobe: int = ANN_NPROBE) -> list:
+        query = np.asarray(query_vector, dtype=np.float32).ravel()
+        if query.shape[0] != self.centroids.shape[1]:
+            print(f"[Warning] Query dimension {query.shape[0]} does not match the ANN index "
+                  f"({self.centroids.shape[1]}). Run --reindex.")
+            return []
+        nprobe = max(1, min(nprobe, len(self.centroids)))
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        order, bounds = self._inverted_lists()
+        rows = np.concatenate([order[bounds[c]:bounds[c + 1]] for c in probe])
+        if not len(rows):
+            return []
+        return self.store._top_k(self.store.scores(query, rows), rows, top_k)
+
+
+_ann_index = None
+
 
+def get_ann_index(build: bool = False):
+    """Loaded ANN index, or None. With build=True, (re)train it if missing or stale."""
+    with _state_lock:
+        return _get_ann_index(build)
 
-# ==================== LIGHTWEIGHT STORAGE ====================
-def ensure_dir():
-    MEMORY_DIR.mkdir(parents=True, exist_ok=True)
 
+def _get_ann_index(build: bool):
+    global _ann_index
+    store = get_vector_store()
+    if _ann_index is not None and not _ann_index.dirty and _ann_index.signature != file_signature(ANN_FILE):
+        _ann_index = None  # rebuilt, updated or removed by another process
+    if _ann_index is None:
+        index = IVFIndex(ANN_FILE, store)
+        if index.load() or build:
+            _ann_index = index
+    elif _ann_index.drop_if_dim_changed():
+        _ann_index = IVFIndex(ANN_FILE, store) if build else None
+    elif _ann_index.generation != store.generation:
+        _ann_index._catch_up()
+    if _ann_index is not None and build and _ann_index.stale and len(store):
+        with store.writing():
+            print(f"[ANN] Building index over {len(store)} vectors...")
+            _ann_index.build()
+            _ann_index.save()
+    return _ann_index
 
-def load_memories() -> dict:
-    ensure_dir()
-    if MEMORY_FILE.exists():
-        try:
-            with open(MEMORY_FILE, encoding='utf-8') as f:
+
+@contextmanager
+def vector_writes():
+    """
+    store.writing() for changes to the vectors and the ANN index together:
+    yields (store, ann index or None) and saves the index before the store
+    flushes, so other processes never see one without the other. Nested
+    scopes leave the save to the outermost.
+    """
+    store = get_vector_store()
+    with store.writing():
+        ann = get_ann_index()
+        yield store, ann
+        if ann is not None and ann.dirty and store._depth == 1:
+            ann.save()
+
+
+# ==================== EMBEDDING CACHE ====================
+class EmbeddingCache:
+    """
+    Two-level LRU cache of embeddings keyed by content_hash() of the
+    whitespace-normalized text (the hash includes the model name).
+
+    A small in-memory OrderedDict sits in front of an on-disk VectorStore
+    (one per model) holding at most `capacity` vectors; the least recently
+    used entries are evicted first. Hit/miss counters accumulate in stats.json.
+    Nothing is written until flush(): at checkpoints of bulk writes, from the
+    daemon's idle timer and at exit, so a query never pays for a disk write.
+    New vectors and LRU moves wait in memory and are applied to the disk
+    store inside its writing() scope, counters under the same lock.
+    """
+
+    LAYER = "e"
+
+    def __init__(self, directory: Path, model_name: str, capacity: int, memory_capacity: int = 1024):
+        slug = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+        self.directory = directory
+        self.disk = VectorStore(directory / f"{slug}.npy", directory / f"{slug}.json")
+        self.capacity = capacity
+        self.memory = OrderedDict()
+        self.memory_capacity = memory_capacity
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._new = OrderedDict()      # key -> vector not yet on disk
+        self._touched = OrderedDict()  # disk keys hit since the last flush, oldest first
+
+    @staticmethod
+    def key(text: str) -> str:
+        return content_hash(" ".join(text.split()))
+
+    def _remember(self, key: str, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_capacity:
+            self.memory.popitem(last=False)
+
+    def get(self, key: str):
+        """Cached vector or None (call inside disk.reading())."""
+        vector = self.memory.get(key)
+        if vector is None:
+            vector = self._new.get(key)
+        if vector is not None:
+            self._remember(key, vector)
+            self.stats["memory_hits"] += 1
+            return vector
+        if self.disk.item_id(self.LAYER, key) in self.disk:
+            vector = self.disk.get(self.LAYER, key)
+            self._touched[key] = None  # mark most recently used at the next flush
+            self._touched.move_to_end(key)
+            self._remember(key, vector)
+            self.stats["disk_hits"] += 1
+            return vector
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key: str, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        self._remember(key, vector)
+        self._new[key] = vector
+        return vector
+
+    def flush(self):
+        if self._new or self._touched:
+            with self.disk.writing():
+                for key in self._touched:
+                    if self.disk.item_id(self.LAYER, key) in self.disk:
+                        self.disk.touch(self.LAYER, key)
+                for key, vector in self._new.items():
+                    self.disk.set(self.LAYER, key, vector)
+                while len(self.disk) > self.capacity:
+                    oldest = next(iter(self.disk.rows))
+                    self.disk.delete(*oldest.split("/", 1))
+            self._new.clear()
+            self._touched.clear()
+        if any(self.stats.values()):
+            with STORE_LOCK.exclusive():
+                self.directory.mkdir(parents=True, exist_ok=True)
+                totals = self.load_stats()
+                for name, count in self.stats.items():
+                    totals[name] = totals.get(name, 0) + count
+                atomic_write_json(self.directory / "stats.json", totals)
+            self.stats = dict.fromkeys(self.stats, 0)
+
+    def load_stats(self) -> dict:
+        path = self.directory / "stats.json"
+        if path.exists():
+            with open(path, encoding='utf-8') as f:
                 return json.load(f)
-        except json.JSONDecodeError:
-            print(f"[Error] Corrupted memory file: {MEMORY_FILE}")
-            # Backup corrupted file
-            backup_path = str(MEMORY_FILE) + ".bak"
+        return {}
+
+
+_embedding_cache = None
+
+
+def get_embedding_cache():
+    """The embedding cache for MODEL_NAME, or None when disabled (size 0)."""
+    global _embedding_cache
+    if _embedding_cache is None and EMBED_CACHE_SIZE > 0:
+        _embedding_cache = EmbeddingCache(EMBED_CACHE_DIR, MODEL_NAME, EMBED_CACHE_SIZE)
+        atexit.register(flush_embedding_cache)
+    return _embedding_cache
+
+
+def encode_texts(texts: list, batch_size: int = 32, flush: bool = False):
+    """
+    Embed `texts` as an (n, dim) array of unit vectors, serving repeats from the
+    embedding cache and encoding each distinct uncached text once. New cache
+    entries are written by flush_embedding_cache() (or flush=True).
+    """
+    tally("texts_encoded", len(texts))
+    cache = get_embedding_cache()
+    if cache is None:
+        with timed("encode"):
+            vectors = np.asarray(model.encode(list(texts), batch_size=batch_size), dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    with _state_lock:
+        return _encode_cached(cache, texts, batch_size, flush)
+
+
+def _encode_cached(cache: EmbeddingCache, texts: list, batch_size: int, flush: bool = False):
+    keys = [cache.key(text) for text in texts]
+    with cache.disk.reading():
+        out = [cache.get(key) for key in keys]
+    todo = {}
+    for i, vector in enumerate(out):
+        if vector is None:
+            todo.setdefault(keys[i], i)
+    tally("embed_cache_misses", len(todo))
+    if todo:
+        with timed("encode"):
+            vectors = model.encode([texts[i] for i in todo.values()], batch_size=batch_size)
+        fresh = {key: cache.put(key, vector) for key, vector in zip(todo, vectors)}
+        out = [fresh[key] if vector is None else vector for key, vector in zip(keys, out)]
+    if flush:
+        cache.flush()
+    return np.vstack(out)
+
+
+def flush_embedding_cache():
+    cache = get_embedding_cache()
+    if cache is not None:
+        with _state_lock:
+            cache.flush()
+
+
+def print_cache_stats():
+    cache = get_embedding_cache()
+    if cache is None:
+        print("[Cache] Embedding cache disabled (CLAUDE_MEMORY_EMBED_CACHE_SIZE=0)")
+        return
+    stats = cache.load_stats()
+    hits = stats.get("memory_hits", 0) + stats.get("disk_hits", 0)
+    lookups = hits + stats.get("misses", 0)
+    rate = hits / lookups * 100 if lookups else 0.0
+    print(f"[Cache] {MODEL_NAME}: {len(cache.disk)}/{cache.capacity} embeddings cached")
+    print(f"[Cache] hits {hits} (memory {stats.get('memory_hits', 0)}, disk {stats.get('disk_hits', 0)}), "
+          f"misses {stats.get('misses', 0)}, hit rate {rate:.1f}%")
+
+
+def migrate_embeddings(memories: dict) -> bool:
+    """Move inline "embedding" lists into the vector store. True if any were found."""
+    found = [(layer, key, data.pop("embedding")) for layer, items in memories.items()
+             for key, data in items.items() if "embedding" in data]
+    if not found:
+        return False
+    moved = 0
+    with get_vector_store().writing() as store:
+        for layer, key, embedding in found:
             try:
-                shutil.copy(MEMORY_FILE, backup_path)
-                print(f"[Error] Backed up to {backup_path}")
+                store.set(layer, key, embedding)
+                moved += 1
             except Exception as e:
-                print(f"[Error] Could not backup: {e}")
-            
-            print("[Error] Exiting to prevent data loss. Please fix the file manually.")
-            sys.exit(1)
+                print(f"[Warning] Could not migrate embedding for {key}: {e}")
+    print(f"[Migrate] Moved {moved} embeddings to {VECTOR_FILE.name}")
+    return True
+
+
+# ==================== SESSION API ====================
+# MemoryStore is the programmatic interface (the CLI functions below are thin
+# wrappers that print its results). Every write method runs in a transaction;
+# wrap several calls in `with store.transaction():` to commit them together:
+#
+#     store = MemoryStore()
+#     store.prepare(notes)  # embed outside the lock the transaction holds
+#     with store.transaction():
+#         for note in notes:
+#             store.add(note, "contextual", tags=["meeting"])
+#     for hit in store.search("budget", top_k=3):
+#         print(hit.score, hit.memory.key, hit.memory.content)
+MEMORY_FIELDS = ("content", "tags", "source", "created", "updated", "accessed")
+
+
+@dataclass
+class Memory:
+    """One stored memory. `extra` holds the optional fields (summary, compressed, last_accessed, ...)."""
+    layer: str
+    key: str
+    content: str = ""
+    tags: list = field(default_factory=list)
+    source: str = ""
+    created: str = None
+    updated: str = None
+    accessed: int = 0
+    extra: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_record(cls, layer: str, key: str, data: dict) -> "Memory":
+        extra = {k: v for k, v in data.items() if k not in MEMORY_FIELDS and k != "layer"}
+        return cls(layer, key, **{k: data[k] for k in MEMORY_FIELDS if k in data}, extra=extra)
+
+    @property
+    def item_id(self) -> str:
+        return f"{self.layer}/{self.key}"
+
+    def record(self) -> dict:
+        """The stored dict form."""
+        return {"content": self.content, "layer": self.layer, "tags": self.tags, "source": self.source,
+                "created": self.created, "updated": self.updated, "accessed": self.accessed, **self.extra}
+
+
+@dataclass
+class SearchResult:
+    """A ranked hit with its score breakdown (see fuse_results); dense/lexical are None if not found that way."""
+    memory: Memory
+    rank: int
+    score: float
+    rrf: float
+    layer_weight: float
+    recency: float
+    activity: float
+    boost: float
+    dense: float = None
+    dense_rank: int = None
+    lexical: float = None
+    lexical_rank: int = None
+
+
+class MemoryStore:
+    """
+    Session over the configured backend.
+
+    Texts are embedded before the store's write lock is taken (add, insert
+    and update call prepare(); callers opening a transaction around several
+    writes should prepare their texts first). The transaction then holds the
+    lock only to check keys and duplicates, commit the records in one journal
+    append (one SQLite transaction) and flush the vector files once, so no
+    process sees records without their vectors and nobody waits on the model.
+    Cosine deduplication only compares against memories committed before the
+    transaction, while MinHash also catches repeats within it.
+    """
+
+    def __init__(self):
+        self.backend = get_backend()
+        self._pending = None
+        self._encoded = {}  # content -> vector, embedded by prepare() for the next commit
+
+    def prepare(self, texts: list):
+        """Embed `texts` now, outside the store lock, for the next transaction to reuse."""
+        texts = [text for text in dict.fromkeys(texts) if text and text not in self._encoded]
+        if not texts or get_model() is None:
+            return
+        try:
+            vectors = encode_texts(texts)
         except Exception as e:
-            print(f"[Error] Failed to load memory file: {e}")
-            return {}
-    return {}
+            print(f"[Warning] Failed to generate embedding: {e}")
+            return
+        self._encoded.update(zip(texts, vectors))
+
+    @contextmanager
+    def transaction(self):
+        """Group the operations made inside into one commit; an exception rolls them back."""
+        if self._pending is not None:
+            yield self
+            return
+        self._pending = pending = {"added": [], "embed": [], "drop": [], "cold": [], "vectors": self._encoded}
+        self._encoded = {}
+        with STORE_LOCK.exclusive():  # 向量写入与记录提交在同一把锁内，模型推理在锁外
+            try:
+                with self.backend.transaction():
+                    yield self
+                    auto_forget(pending["added"], store=self)  # evictions join the same commit
+            except BaseException:
+                for layer, key, _ in pending["added"]:
+                    if _dedup_index is not None:
+                        _dedup_index.remove(f"{layer}/{key}")
+                get_forget_engine().reset()
+                raise
+            finally:
+                self._pending = None
+            self._apply(pending)
 
+    def _apply(self, pending: dict):
+        """After the records are committed: vectors, eviction heaps, dedup index, cold files."""
+        engine = get_forget_engine()
+        if pending["drop"]:
+            with vector_writes():  # one flush for all the drops
+                for layer, key, data in pending["drop"]:
+                    unembed_memory(layer, key)
+        for layer, key, data in pending["drop"]:
+            engine.drop(layer, key)
+            if _dedup_index is not None:
+                _dedup_index.remove(f"{layer}/{key}")
+            drop_cold(data)
+        for data in pending["cold"]:
+            drop_cold(data)
+        if pending["embed"]:
+            embed_memories(pending["embed"], vectors=pending["vectors"])
+        save_dedup_index()
 
-def save_memories(memories: dict):
-    ensure_dir()
-    with open(MEMORY_FILE, 'w', encoding='utf-8') as f:
-        json.dump(memories, f, ensure_ascii=False, indent=2)
+    def add(self, content: str, layer: str = "cognitive", key: str = None, tags: list = None,
+            source: str = None):
+        """Store a new memory. Returns it, or None if it was merged into a near-duplicate."""
+        self.prepare([content])
+        with self.transaction():
+            if key is None:
+                # 加纳秒后缀确保唯一性，避免同一分钟内多次调用覆盖
+                key = f"mem_{datetime.now().strftime('%m%d_%H%M_%S%f')}"
+            # 如果 key 已存在，自动加后缀
+            while self.backend.get(layer, key) is not None:
+                key = f"{key}_1"
+            data = new_memory(content, layer, tags, source)
+            if not self._dedupe([(layer, key, data)]):
+                return None
+            self.backend.put(layer, key, data)
+            self._pending["added"].append((layer, key, data))
+            self._pending["embed"].append((layer, key, content))
+        return Memory.from_record(layer, key, data)
+
+    def ingest(self, file_path: str, layer: str = "cognitive", min_memories: int = None,
+               max_memories: int = 10) -> list:
+        """Extract and split a file into memories (see prepare_file). Returns the new Memory list."""
+        chunks, log = prepare_file(file_path, min_memories, max_memories)
+        for line in log:
+            print(line)
+        return self.insert(file_memories(file_path, chunks, layer, set()))
+
+    def insert(self, items: list) -> list:
+        """Store new [(layer, key, data)] records, merging near-duplicates. Returns the stored Memory list."""
+        self.prepare([data["content"] for _, _, data in items])
+        with self.transaction():
+            items = self._dedupe(items)
+            self.backend.put_many(items)
+            self._pending["added"].extend(items)
+            self._pending["embed"].extend((l, k, data["content"]) for l, k, data in items)
+        return [Memory.from_record(*item) for item in items]
+
+    def _dedupe(self, items: list) -> list:
+        return dedupe_items(items, embed=self._pending["embed"], vectors=self._pending["vectors"])
+
+    def find_layers(self, key: str) -> list:
+        return self.backend.find_layers(key)
+
+    def get(self, key: str, layer: str = None, touch: bool = True):
+        """The memory (first layer holding `key` if none is given), or None. `touch` counts the access."""
+        layer = layer or next(iter(self.backend.find_layers(key)), None)
+        if layer is None:
+            return None
+        if not touch:
+            data = self.backend.get(layer, key)
+        else:
+            with self.transaction():
+                data = self.backend.update(layer, key, lambda data: {
+                    "accessed": data.get("accessed", 0) + 1,
+                    "last_accessed": datetime.now().isoformat(),
+                })
+            if data is not None:
+                get_forget_engine().touch(layer, key, data)
+        return Memory.from_record(layer, key, data) if data is not None else None
+
+    def memories(self, layer: str = None) -> list:
+        return [Memory.from_record(l, k, data) for l, k, data in self.backend.items(layer)]
+
+    def counts(self) -> dict:
+        """{layer: number of memories}"""
+        return self.backend.layer_counts()
+
+    def search(self, query: str, top_k: int = 5, exact: bool = False, nprobe: int = ANN_NPROBE,
+               filters: dict = None) -> list:
+        """Hybrid search (see search_memories) as SearchResults, best first."""
+        return self._search(query, top_k, exact, nprobe, filters)[0]
+
+    def _search(self, query: str, top_k: int, exact: bool, nprobe: int, filters: dict):
+        depth = max(SEARCH_DEPTH, 4 * top_k)
+        item_ids = None
+        if filters and any(filters.values()):
+            with timed("filter"):
+                item_ids = self.backend.filter_ids(filters)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            dense_future = pool.submit(dense_search, query, depth, exact, nprobe, item_ids)
+            lexical_future = pool.submit(self.backend.keyword_search, query, depth, item_ids)
+            dense, mode = dense_future.result()
+            with timed("lexical"):
+                lexical = lexical_future.result()
+        with timed("fuse"):
+            fused = fuse_results(dense, lexical, top_k)
+        tally("results", len(fused))
+        fields = ("score", "rrf", "layer_weight", "recency", "activity", "boost",
+                  "dense", "dense_rank", "lexical", "lexical_rank")
+        results = [SearchResult(Memory.from_record(r["layer"], r["key"], r["data"]), rank,
+                                **{name: r[name] for name in fields if name in r})
+                   for rank, r in enumerate(fused, 1)]
+        return results, f"{mode} + BM25" if mode else "BM25"
+
+    def tag(self, key: str, layer: str, tags: list):
+        """Add `tags` to a memory. Returns it, or None if it does not exist."""
+        new_tags = set(tags)
+        with self.transaction():
+            data = self.backend.update(layer, key, lambda data: {
+                "tags": list(set(data.get("tags", [])) | new_tags),
+                "updated": datetime.now().isoformat(),
+                "accessed": data.get("accessed", 0) + 1,
+            })
+        if data is None:
+            return None
+        get_forget_engine().touch(layer, key, data)
+        return Memory.from_record(layer, key, data)
+
+    def update(self, key: str, layer: str, content: str):
+        """Replace a memory's content (and its embedding). Returns it, or None if it does not exist."""
+        if len(content.strip()) < 20:
+            raise ValueError("Content too short (<20 chars)")
+        self.prepare([content])
+        with self.transaction():
+            data = self.backend.get(layer, key)
+            if data is None:
+                return None
+            fields = {"content": content, "updated": datetime.now().isoformat(), "accessed": 0}
+            data = {**data, **fields}
+            if data.get("compressed"):
+                # New content supersedes the archived original (deleted once this commits)
+                self._pending["cold"].append(dict(data))
+                del data["compressed"]
+                self.backend.put(layer, key, data)
+            else:
+                self.backend.patch(layer, key, fields)
+            get_forget_engine().touch(layer, key, data)
+            self._pending["embed"].append((layer, key, content))
+        return Memory.from_record(layer, key, data)
+
+    def delete(self, key: str, layer: str = None) -> bool:
+        """Delete a memory with its vector and cold-storage file. Without `layer`, `key` must be in one layer."""
+        if layer is None:
+            layers = self.backend.find_layers(key)
+            if len(layers) > 1:
+                raise ValueError(f"Ambiguous key '{key}' found in layers: {layers}")
+            if not layers:
+                return False
+            layer = layers[0]
+        with self.transaction():
+            data = self.backend.get(layer, key)
+            if data is None or not self.backend.delete(layer, key):
+                return False
+            pending = self._pending
+            pending["added"] = [item for item in pending["added"] if item[:2] != (layer, key)]
+            pending["embed"] = [item for item in pending["embed"] if item[:2] != (layer, key)]
+            pending["drop"].append((layer, key, data))
+        return True
+
+    def clear(self):
+        """Delete every memory, vector, eviction heap and cold-storage file."""
+        global _ann_index
+        with STORE_LOCK.exclusive():
+            self.backend.clear()
+            get_vector_store().clear()
+            get_forget_engine().reset()
+            shutil.rmtree(COLD_DIR, ignore_errors=True)
+            IVFIndex(ANN_FILE, get_vector_store()).clear()
+            _ann_index = None  # the loaded index still maps the old rows
 
 
 # ==================== SIMPLE OPERATIONS ====================
 def add_memory(content: str, layer: str, key: str = None, tags: list = None, source: str = None):
     """Add memory to layer (delegates to LLM for processing)."""
-    memories = load_memories()
-    if layer not in memories:
-        memories[layer] = {}
-
-    # 生成唯一 key，避免同一分钟内多次调用覆盖
-    base_key = f"mem_{datetime.now().strftime('%m%d_%H%M')}"
-    if key is None:
-        # 加纳秒后缀确保唯一性
-        key = f"{base_key}_{datetime.now().strftime('%S%f')}"
-    # 如果 key 已存在，自动加后缀
-    while key in memories[layer]:
-        key = f"{key}_1"
-    now = datetime.now().isoformat()
+    memory = MemoryStore().add(content, layer, key, tags, source)
+    if memory is not None:
+        print(f"[{layer[:3].upper()}] {memory.key}")
+    return memory
+
 
-    memories[layer][key] = {
+def new_memory(content: str, layer: str, tags: list = None, source: str = None) -> dict:
+    """A fresh memory record."""
+    now = datetime.now().isoformat()
+    return {
         "content": content,
         "layer": layer,
         "tags": tags or [],
@@ -108,125 +2516,221 @@ def add_memory(content: str, layer: str, key: str = None, tags: list = None, sou
         "accessed": 0,
     }
 
-    if HAS_SEMANTIC:
+
+def embed_memories(items: list, batch_size: int = 32, vectors: dict = None):
+    """
+    Encode [(layer, key, content)] in batches, then store all the vectors in
+    one vector_writes() scope (no-op without a model). `vectors` holds
+    {content: vector} already encoded (MemoryStore.prepare, dedupe_items).
+    """
+    if _dedup_index is not None:
+        for layer, key, content in items:
+            _dedup_index.add(f"{layer}/{key}", content)
+    if get_model() is None or not items:
+        return
+    vectors = vectors or {}
+    encoded = [(item, vectors[item[2]]) for item in items if item[2] in vectors]
+    todo = [item for item in items if item[2] not in vectors]
+    for i in range(0, len(todo), batch_size):
+        batch = todo[i:i + batch_size]
         try:
-            embedding = model.encode(content).tolist()
-            memories[layer][key]["embedding"] = embedding
+            fresh = encode_texts([content for _, _, content in batch], batch_size=batch_size)
         except Exception as e:
             print(f"[Warning] Failed to generate embedding: {e}")
+            continue
+        encoded.extend(zip(batch, fresh))
+    with vector_writes() as (store, ann):
+        for (layer, key, content), vector in encoded:
+            store.set(layer, key, vector, content_hash(content))
+            if ann is not None:
+                ann.add(store.rows[store.item_id(layer, key)])
 
 
-    save_memories(memories)
-    print(f"[{layer[:3].upper()}] {key}")
+def unembed_memory(layer: str, key: str):
+    """Drop a memory's vector (and its ANN entry)."""
+    with vector_writes() as (store, ann):
+        row = store.rows.get(store.item_id(layer, key))
+        if row is None:
+            return
+        if ann is not None:
+            ann.remove(row)
+        store.delete(layer, key)
 
 
 def get_memory(key: str = None, layer: str = None) -> dict:
-    """Get memory."""
-    memories = load_memories()
-    
-    if not layer and key:
-        # Search all layers for key
-        for l, items in memories.items():
-            if key in items:
-                layer = l
-                break
-    
-    if layer and key and layer in memories and key in memories[layer]:
-        memories[layer][key]["accessed"] += 1
-        save_memories(memories)
-        return memories[layer][key]
-    return {}
+    """Get memory (its record, or {} if not found)."""
+    memory = MemoryStore().get(key, layer) if key else None
+    return memory.record() if memory is not None else {}
 
 
 def list_memories(layer: str = None):
     """List memories."""
-    memories = load_memories()
+    backend = get_backend()
     if layer:
-        items = memories.get(layer, {})
+        items = list(backend.items(layer))
         print(f"\n[{layer.upper()}] {len(items)} items")
-        for k, v in items.items():
+        for _, k, v in items:
             print(f"  - {k}: {v.get('content','')[:50]}...")
     else:
         print("\n" + "=" * 50)
         print("    MEMORY SYSTEM")
         print("=" * 50)
-        for layer, items in memories.items():
-            print(f"  {layer:12} | {len(items):3} items")
+        for layer, count in backend.layer_counts().items():
+            print(f"  {layer:12} | {count:3} items")
         print("=" * 50)
 
 
-def search_memories(query: str, top_k: int = 5):
-    """Search memories (Hybrid: Semantic + Keyword)."""
-    memories = load_memories()
+def dense_search(query: str, depth: int, exact: bool = False, nprobe: int = ANN_NPROBE,
+                 item_ids=None):
+    """
+    Nearest embeddings as ([(cosine, item_id)], mode), or ([], None) without a
+    model. A filtered subset (`item_ids`) is scored exactly, skipping the ANN index.
+    """
+    if get_model() is None:
+        return [], None
+    with timed("dense"):
+        query_embedding = encode_texts([query])[0]
+        if item_ids is not None:
+            store = prepare_vector_scan(use_ann=False)
+            with store.reading():
+                return store.search(query_embedding, depth, item_ids), f"Filtered {len(item_ids)}"
+        return nearest_vectors(query_embedding, depth, exact, nprobe)
+
+
+def vector_builds_pending() -> bool:
+    """True if a search could build the ANN index or quantized codes (i.e. write files)."""
+    if not HAS_SEMANTIC:
+        return False
+    store = get_vector_store()
+    if not len(store):
+        return False
+    if store.quant in store.QUANT_MODES and (store.quant not in store.meta["quant"] or
+                                              not all(p.exists() for p in store.code_paths(store.quant))):
+        return True
+    if len(store) >= ANN_THRESHOLD or ANN_FILE.exists():
+        ann = get_ann_index()
+        return ann is None or ann.stale
+    return False
+
+
+def prepare_vector_scan(use_ann: bool) -> VectorStore:
+    """
+    Build whatever the scan needs and is missing (ANN index, quantized codes)
+    up front, under the exclusive lock, so the scan itself only reads.
+    """
+    store = get_vector_store()
+    if use_ann:
+        get_ann_index(build=True)
+    if store.quant in store.QUANT_MODES and len(store):
+        store.codes(store.quant)  # also for ANN searches, so an exact or filtered one never builds
+    return store
+
+
+def nearest_vectors(vector, depth: int, exact: bool = False, nprobe: int = ANN_NPROBE):
+    """([(cosine, item_id)], mode) for a unit vector: through the ANN index on large stores."""
+    store = get_vector_store()
+    if store.meta["dim"] not in (None, np.size(vector)):
+        return store.search(vector, depth), "Semantic"  # warns that the model changed; no ANN build
+    use_ann = not exact and (len(store) >= ANN_THRESHOLD or ANN_FILE.exists())
+    prepare_vector_scan(use_ann)
+    with store.reading():
+        ann = get_ann_index() if use_ann else None
+        if ann is not None:
+            return ann.search(vector, depth, nprobe), f"ANN nprobe={nprobe}"
+        return store.search(vector, depth), "Semantic"
+
+
+def rank_boost(layer: str, data: dict, now: datetime) -> dict:
+    """Layer, recency (updated) and activity (accessed) multipliers for one memory."""
+    recency = 0.0
+    try:
+        age_days = (now - datetime.fromisoformat(data.get("updated") or data.get("created"))).total_seconds() / 86400
+        recency = 0.5 ** (max(age_days, 0.0) / RECENCY_HALF_LIFE_DAYS)
+    except (TypeError, ValueError):
+        pass
+    activity = min(1.0, np.log1p(data.get("accessed", 0)) / np.log1p(100))
+    return {"layer_weight": LAYER_WEIGHTS.get(layer, 1.0),
+            "recency": float(recency), "activity": float(activity),
+            "boost": float(1.0 + RECENCY_WEIGHT * recency + ACTIVITY_WEIGHT * activity)}
+
+
+def fuse_results(dense: list, lexical: list, top_k: int) -> list:
+    """
+    Reciprocal-rank fusion: rrf = sum(1 / (RRF_K + rank)) over the lists an
+    item appears in, then score = rrf * layer weight * (1 + recency + activity).
+    Ranks rather than raw scores are fused, so cosine and BM25 need no common scale.
+    """
+    backend = get_backend()
+    fused = {}
+    for rank, (score, item_id) in enumerate(dense, 1):
+        layer, key = item_id.split("/", 1)
+        fused[(layer, key)] = {"layer": layer, "key": key, "data": None,
+                               "dense": score, "dense_rank": rank, "rrf": 1.0 / (RRF_K + rank)}
+    for rank, (score, layer, key, data) in enumerate(lexical, 1):
+        entry = fused.setdefault((layer, key), {"layer": layer, "key": key, "data": None, "rrf": 0.0})
+        entry.update(data=data, lexical=score, lexical_rank=rank)
+        entry["rrf"] += 1.0 / (RRF_K + rank)
+
+    now = datetime.now()
     results = []
-    
-    # 1. Semantic Search
-    # 1. Semantic Search
-    if HAS_SEMANTIC:
-        # Encode query to tensor directly
-        query_embedding = model.encode(query, convert_to_tensor=True)
-        candidates = []
-        
-        for layer, items in memories.items():
-            for key, data in items.items():
-                if "embedding" in data:
-                    try:
-                        # Convert stored list to tensor, ensuring float32 to match query
-                        stored_emb = model.tokenizer.backend_tokenizer.normalizer = None # Hack for some models, but safe here
-                        # Actually just util.cos_sim handles tensors well
-                        emb_tensor = util.cos_sim(query_embedding, data["embedding"])
-                        score = emb_tensor.item()
-                        candidates.append((score, layer, key, data))
-                    except Exception as e:
-                         # Fallback if dimension mismatch
-                        pass
-                elif query.lower() in data.get("content", "").lower():
-                    # Fallback for old memories without embeddings
-                    candidates.append((0.5, layer, key, data))
-        
-        # Sort by score descending
-        candidates.sort(key=lambda x: x[0], reverse=True)
-        results = [(c[1], c[2], c[3]) for c in candidates]
-        
-        print(f"\n[Search] '{query}' (Semantic): {len(results)} results")
-        for i, (score, layer, key, data) in enumerate(candidates[:top_k], 1):
-            print(f"  {i}. [{layer}] {key} (Score: {score:.2f})")
-            print(f"     {data.get('content','')[:80]}...")
-            
-    # 2. Keyword Fallback
-    else:
-        query_lower = query.lower()
-        for layer, items in memories.items():
-            for key, data in items.items():
-                content = data.get("content", "").lower()
-                if query_lower in content or query_lower in key.lower():
-                    results.append((layer, key, data))
+    for entry in fused.values():
+        if entry["data"] is None:
+            entry["data"] = backend.get(entry["layer"], entry["key"])
+            if entry["data"] is None:
+                continue
+        boost = rank_boost(entry["layer"], entry["data"], now)
+        entry.update(boost)
+        entry["score"] = entry["rrf"] * boost["layer_weight"] * boost["boost"]
+        results.append(entry)
+    results.sort(key=lambda r: r["score"], reverse=True)
+    return results[:top_k]
+
+
+def search_memories(query: str, top_k: int = 5, exact: bool = False, nprobe: int = ANN_NPROBE,
+                    explain: bool = False, filters: dict = None) -> list:
+    """
+    Hybrid search: dense and BM25 retrieval run concurrently, fused by rank.
+
+    `filters` (see matches_filters) are resolved to a candidate id set through
+    the backend's layer/tag/date indexes first, so only that subset is scored.
 
-        print(f"\n[Search] '{query}' (Keyword): {len(results)} results")
-        for i, (layer, key, data) in enumerate(results[:top_k], 1):
-            print(f"  {i}. [{layer}] {key}")
-            print(f"     {data.get('content','')[:80]}...")
+    Prints and returns up to top_k SearchResults (best first) with the memory,
+    the final score and its breakdown: dense/dense_rank, lexical/lexical_rank
+    (when the item was found that way), rrf, and the layer/recency/activity boosts.
+    """
+    results, mode = MemoryStore()._search(query, top_k, exact, nprobe, filters)
+    with timed("print"):
+        print(f"\n[Search] '{query}' ({mode}): {len(results)} results")
+        for r in results:
+            print(f"  {r.rank}. [{r.memory.layer}] {r.memory.key} (Score: {r.score:.4f})")
+            if explain:
+                parts = []
+                if r.dense_rank is not None:
+                    parts.append(f"cos {r.dense:.2f} #{r.dense_rank}")
+                if r.lexical_rank is not None:
+                    parts.append(f"bm25 {r.lexical:.2f} #{r.lexical_rank}")
+                print(f"     rrf {r.rrf:.4f} x layer {r.layer_weight:.2f} x boost {r.boost:.2f}"
+                      f" (recency {r.recency:.2f}, activity {r.activity:.2f}); {', '.join(parts)}")
+            print(f"     {r.memory.content[:80]}...")
+    return results
 
 
 def delete_memory(key: str = None, layer: str = None, remove_all: bool = False):
     """Delete memories."""
-    memories = load_memories()
+    store = MemoryStore()
 
     if remove_all:
         confirm = input("DELETE ALL? Type 'yes': ")
         if confirm != "yes":
             print("Cancelled")
             return
-        save_memories({})
+        store.clear()
         print("[Delete] All memories deleted")
         return
 
     if not layer:
         # Try to find key in any layer
-        found_layers = []
-        for l, items in memories.items():
-            if key in items:
-                found_layers.append(l)
+        found_layers = store.find_layers(key)
         
         if not found_layers:
             print(f"[Delete] Memory '{key}' not found in any layer")
@@ -238,94 +2742,851 @@ def delete_memory(key: str = None, layer: str = None, remove_all: bool = False):
             
         layer = found_layers[0]
 
-    if layer in memories and key in memories[layer]:
-        del memories[layer][key]
-        save_memories(memories)
-        print(f"[Delete] {key} (from {layer})")
-    else:
-        print(f"[Delete] Memory '{key}' not found in layer '{layer}'")
+    if store.delete(key, layer):
+        print(f"[Delete] {key} (from {layer})")
+    else:
+        print(f"[Delete] Memory '{key}' not found in layer '{layer}'")
+
+
+# ==================== FORGETTING ====================
+def _last_used(data: dict) -> float:
+    """Seconds since the epoch of the later of `updated` and `last_accessed`."""
+    stamps = [data.get("updated") or data.get("created"), data.get("last_accessed")]
+    times = []
+    for stamp in stamps:
+        try:
+            times.append(datetime.fromisoformat(stamp).timestamp())
+        except (TypeError, ValueError):
+            pass
+    return max(times, default=0.0)
+
+
+# Priority functions: lower = forgotten first. None of them depend on "now",
+# so heap entries stay valid until the memory itself changes.
+FORGET_POLICIES = {
+    # least recently used / updated
+    "lru": lambda data: (_last_used(data),),
+    # least frequently used, older first among equals
+    "lfu": lambda data: (data.get("accessed", 0), _last_used(data)),
+    # (1 + accessed) * 0.5 ** (age / half-life), in log form so it is time-invariant
+    "decay": lambda data: (np.log2(1 + data.get("accessed", 0))
+                           + _last_used(data) / (RECENCY_HALF_LIFE_DAYS * 86400),),
+}
+
+
+class ForgetEngine:
+    """
+    Per-layer min-heaps of eviction priority.
+
+    A layer's heap is built once (heapify, no sort) the first time it is
+    needed and then kept current through touch()/drop(). Superseded heap
+    entries are skipped lazily when popped, and the heap is rebuilt from the
+    live entries once the stale ones outnumber them.
+    """
+
+    def __init__(self, policy: str):
+        self.policy = policy
+        self.priority = FORGET_POLICIES[policy]
+        self.heaps = {}    # layer -> [(priority, key)]
+        self.entries = {}  # layer -> {key: priority}
+
+    def _load(self, layer: str):
+        if layer not in self.heaps:
+            entries = {key: self.priority(data) for _, key, data in get_backend().items(layer)}
+            heap = [(priority, key) for key, priority in entries.items()]
+            heapq.heapify(heap)
+            self.heaps[layer], self.entries[layer] = heap, entries
+        return self.heaps[layer], self.entries[layer]
+
+    def touch(self, layer: str, key: str, data: dict):
+        """Record a new or changed memory (no-op for layers not loaded yet)."""
+        if layer in self.heaps:
+            priority = self.priority(data)
+            self.entries[layer][key] = priority
+            heapq.heappush(self.heaps[layer], (priority, key))
+
+    def reset(self):
+        self.heaps.clear()
+        self.entries.clear()
+
+    def drop(self, layer: str, key: str):
+        if layer in self.heaps:
+            self.entries[layer].pop(key, None)
+
+    def size(self, layer: str) -> int:
+        return len(self._load(layer)[1])
+
+    def victims(self, layer: str, count: int, protect=()) -> list:
+        """The `count` lowest-priority keys of `layer` (not removed from the heap)."""
+        heap, entries = self._load(layer)
+        picked, kept = [], []
+        while heap and len(picked) < count:
+            priority, key = heapq.heappop(heap)
+            if entries.get(key) != priority or key in picked:
+                continue
+            kept.append((priority, key))
+            if key not in protect:
+                picked.append(key)
+        for item in kept:
+            heapq.heappush(heap, item)
+        if len(heap) > 2 * len(entries) + 64:
+            self.heaps[layer] = [(priority, key) for key, priority in entries.items()]
+            heapq.heapify(self.heaps[layer])
+        return picked
+
+
+_forget_engine = None
+
+
+def get_forget_engine(policy: str = None) -> ForgetEngine:
+    global _forget_engine
+    policy = policy or FORGET_POLICY
+    with _state_lock:
+        if _forget_engine is None or _forget_engine.policy != policy:
+            _forget_engine = ForgetEngine(policy)
+        return _forget_engine
+
+
+def forget_memories(layer: str = None, policy: str = None, dry_run: bool = False, protect=(),
+                    report: bool = True, limit: int = None, store: "MemoryStore" = None) -> list:
+    """
+    Evict the lowest-priority memories from each layer over its capacity
+    (LAYER_CAPACITY), at most `limit` in all. Keys in `protect`, e.g. the
+    ones just added, are kept. Deletions go through `store` (a new
+    MemoryStore by default) in one transaction, so vectors and cold files
+    are only removed once the deletions are committed.
+    Returns [(layer, key)] evicted, or that would be with dry_run.
+    """
+    engine = get_forget_engine(policy)
+    store = store or MemoryStore()
+    evicted, synced = [], {}
+    with store.transaction():
+        counts = store.backend.layer_counts()
+        for name in [layer] if layer else list(LAYER_CAPACITY):
+            capacity = LAYER_CAPACITY.get(name)
+            if capacity is None or counts.get(name, 0) <= capacity:
+                continue
+            excess = engine.size(name) - capacity
+            if limit is not None:
+                excess = min(excess, limit - len(evicted))
+            victims = engine.victims(name, excess, protect) if excess > 0 else []
+            for key in victims:
+                if dry_run:
+                    print(f"[Forget] would evict [{name}] {key} ({engine.policy})")
+                    continue
+                data = store.backend.get(name, key)
+                store.delete(key, name)
+                for source in (data or {}).get("source", "").split("; "):
+                    if source:  # merged memories list every source
+                        synced.setdefault(source, set()).add((name, key))
+                print(f"[Forget] evicted [{name}] {key} ({engine.policy})")
+            evicted.extend((name, key) for key in victims)
+        if synced:
+            forget_synced(synced)
+    if report or evicted:
+        print(f"[Forget] {len(evicted)} memories {'to evict' if dry_run else 'evicted'} ({engine.policy})")
+    return evicted
+
+
+def auto_forget(items: list, store: "MemoryStore" = None):
+    """
+    After adding [(layer, key, data)]: track them and, with AUTO_FORGET,
+    enforce capacities (sparing them), evicting at most AUTO_FORGET_MAX.
+    """
+    engine = get_forget_engine()
+    for layer, key, data in items:
+        engine.touch(layer, key, data)
+    if not AUTO_FORGET:
+        return
+    budget = AUTO_FORGET_MAX
+    for layer in sorted({layer for layer, _, _ in items}):
+        if budget <= 0:
+            break
+        budget -= len(forget_memories(layer, protect={key for l, key, _ in items if l == layer},
+                                      report=False, limit=budget, store=store))
+
+
+# ==================== COMPRESSION ====================
+# Cold or long memories keep an extractive summary as their content (which is
+# what gets embedded and searched); the full text is compressed into COLD_DIR
+# and restored with --restore.
+_SENTENCE_RE = re.compile(r"[^。！？!?.\n]+(?:[。！？!?.]+|\n+|$)")
+
+
+def extractive_summary(text: str, max_chars: int) -> str:
+    """
+    Pick the sentences with the densest frequent words (the first sentence
+    gets a bonus, repeats are skipped), up to max_chars, and return them in
+    their original order.
+    """
+    sentences = [s.strip() for s in _SENTENCE_RE.findall(text) if s.strip()]
+    if len(sentences) <= 1:
+        return text[:max_chars]
+    freq = {}
+    for token in tokenize(text):
+        freq[token] = freq.get(token, 0) + 1
+    scored = []
+    for i, sentence in enumerate(sentences):
+        tokens = tokenize(sentence)
+        score = sum(freq[t] for t in tokens) / (len(tokens) + 1) + (1.0 if i == 0 else 0.0)
+        scored.append((score, i))
+    picked, used, seen = [], 0, set()
+    for _, i in sorted(scored, reverse=True):
+        if sentences[i] in seen or (picked and used + len(sentences[i]) > max_chars):
+            continue
+        seen.add(sentences[i])
+        picked.append(i)
+        used += len(sentences[i]) + 1
+    return " ".join(sentences[i] for i in sorted(picked))[:max_chars]
+
+
+SUMMARIZERS = {"extractive": extractive_summary}
+
+
+def cold_codec():
+    """(name, compress, decompress): zstd when `zstandard` is installed, else zlib."""
+    if COLD_CODEC == "zstd" and importlib.util.find_spec("zstandard") is not None:
+        import zstandard
+        return ("zst", zstandard.ZstdCompressor(level=10).compress,
+                lambda data: zstandard.ZstdDecompressor().decompress(data))
+    return "zz", lambda data: zlib.compress(data, 9), zlib.decompress
+
+
+def cold_path(layer: str, key: str, codec: str) -> Path:
+    name = hashlib.sha1(f"{layer}/{key}".encode('utf-8')).hexdigest()[:20]
+    return COLD_DIR / f"{name}.{codec}"
+
+
+def is_compressible(data: dict, now: float) -> bool:
+    """Long enough to be worth it, and either cold (unused for a while) or very long."""
+    if data.get("compressed"):
+        return False
+    length = len(data.get("content", ""))
+    cold = now - _last_used(data) > COMPRESS_COLD_DAYS * 86400
+    return length >= COMPRESS_MIN_CHARS and (cold or length >= COMPRESS_LONG_CHARS)
+
+
+def compress_memories(key: str = None, layer: str = None, dry_run: bool = False,
+                      summarizer: str = None) -> int:
+    """
+    Summarize `key` (or every cold/long memory) and move the full text to cold
+    storage. The summaries are embedded first, then committed with their new
+    vectors in one transaction; a memory changed in the meantime is skipped.
+    """
+    store = MemoryStore()
+    backend = store.backend
+    summarize = SUMMARIZERS[summarizer or SUMMARIZER]
+    if key:
+        layers = [layer] if layer else backend.find_layers(key)
+        targets = [(l, key, backend.get(l, key)) for l in layers]
+        targets = [(l, k, d) for l, k, d in targets if d is not None and not d.get("compressed")]
+    else:
+        now = time.time()
+        targets = [(l, k, d) for l, k, d in backend.items(layer) if is_compressible(d, now)]
+
+    codec, compress, _ = cold_codec()
+    saved = 0
+    summaries = []
+    for l, k, data in targets:
+        content = data.get("content", "")
+        summary = summarize(content, max(COMPRESS_SUMMARY_CHARS, len(content) // 10))
+        if len(summary) >= len(content):
+            continue
+        if dry_run:
+            saved += len(content) - len(summary)
+            print(f"[Compress] would compress [{l}] {k}: {len(content)} -> {len(summary)} chars")
+            continue
+        summaries.append((l, k, content, summary, compress(content.encode('utf-8'))))
+
+    done = 0
+    if summaries:
+        store.prepare([summary for _, _, _, summary, _ in summaries])
+        with store.transaction():
+            engine = get_forget_engine()
+            for l, k, content, summary, blob in summaries:
+                data = backend.get(l, k)
+                if data is None or data.get("compressed") or data.get("content") != content:
+                    continue
+                path = cold_path(l, k, codec)
+                ensure_dir()
+                COLD_DIR.mkdir(exist_ok=True)
+                tmp = path.with_name(path.name + ".tmp")
+                tmp.write_bytes(blob)
+                os.replace(tmp, path)
+                fields = {"content": summary, "compressed": {
+                    "file": path.name, "chars": len(content), "bytes": len(blob)}}
+                backend.patch(l, k, fields)
+                engine.touch(l, k, {**data, **fields})
+                store._pending["embed"].append((l, k, summary))
+                saved += len(content) - len(summary)
+                done += 1
+                print(f"[Compress] compressed [{l}] {k}: {len(content)} -> {len(summary)} chars")
+    print(f"[Compress] {len(targets)} candidates, {saved} chars {'to save' if dry_run else 'saved'}")
+    return done
+
+
+def read_cold(data: dict) -> str:
+    """Full original text of a compressed memory."""
+    info = data["compressed"]
+    path = COLD_DIR / info["file"]
+    if path.suffix == ".zst":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(path.read_bytes()).decode('utf-8')
+    return zlib.decompress(path.read_bytes()).decode('utf-8')
+
+
+def drop_cold(data: dict):
+    if data and data.get("compressed"):
+        (COLD_DIR / data["compressed"]["file"]).unlink(missing_ok=True)
+
+
+def restore_memory(key: str, layer: str = None) -> bool:
+    """
+    Put a compressed memory's full text back and re-embed it, in one
+    transaction; the cold file is deleted once that commits.
+    """
+    store = MemoryStore()
+    backend = store.backend
+    layers = [layer] if layer else backend.find_layers(key)
+    for l in layers:
+        data = backend.get(l, key)
+        if not (data and data.get("compressed")):
+            continue
+        content = read_cold(data)
+        store.prepare([content])
+        with store.transaction():
+            current = backend.get(l, key)
+            if current is None or current.get("compressed") != data["compressed"]:
+                break  # restored, edited or deleted meanwhile
+            full = dict(current, content=content)
+            del full["compressed"]
+            backend.put(l, key, full)
+            get_forget_engine().touch(l, key, full)
+            store._pending["embed"].append((l, key, content))
+            store._pending["cold"].append(current)
+        print(f"[Restore] {key}: {len(content)} chars restored")
+        return True
+    print(f"[Restore] No compressed memory '{key}'")
+    return False
+
+
+# ==================== DEDUPLICATION ====================
+# New memories are checked against the store before they are written. MinHash
+# signatures with an LSH band index find near-identical text; nearest
+# embeddings catch reformatted copies. A duplicate is folded into the memory it
+# repeats (tags and sources united, access counts summed) instead of stored.
+_MINHASH_PRIME = (1 << 31) - 1
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+class DedupIndex:
+    """
+    MinHash signatures of every memory, with an LSH index over them.
+
+    Signatures (PERMS minima of word-trigram hashes) are cut into BANDS bands;
+    memories sharing a band are candidates, so a Jaccard similarity of s is
+    caught with probability 1 - (1 - s**ROWS)**BANDS (0.9998 at 0.8, 0.2 at
+    0.4). Band hashes are binary-searched in per-band sorted arrays; rows added
+    since the last sort sit in a short tail that is scanned.
+
+    dedup_index.npz keeps the signatures with a digest of their text, and
+    later changes are appended to dedup_index.log until it is worth
+    rewriting the snapshot. Loading only hashes memories missing from both.
+    """
+
+    PERMS = 64
+    BANDS = 16
+    ROWS = PERMS // BANDS
+    TAIL = 1024
+    _rng = np.random.default_rng(0x5EED)
+    A = _rng.integers(1, _MINHASH_PRIME, PERMS).astype(np.uint64)
+    B = _rng.integers(0, _MINHASH_PRIME, PERMS).astype(np.uint64)
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.ids = []      # row -> item id, None once removed
+        self.digests = []  # row -> text_digest of the text it was computed from
+        self.rows = {}     # item id -> row
+        self.sigs = np.zeros((0, self.PERMS), dtype=np.uint32)
+        self.keys = np.zeros((0, self.BANDS), dtype=np.uint64)
+        self.sorted = []   # per band: (rows, their band hashes sorted) for rows < self.indexed
+        self.indexed = 0
+        self.log_path = path.with_suffix(".log")
+        self.unsaved = []  # ops not yet in the snapshot or log
+        self.logged = 0    # ops in the log
+
+    @classmethod
+    def signature(cls, text: str):
+        tokens = tokenize(text)
+        shingles = {" ".join(tokens[i:i + 3]) for i in range(max(1, len(tokens) - 2))}
+        hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        return ((cls.A[:, None] * hashes + cls.B[:, None]) % _MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+    @classmethod
+    def band_keys(cls, sigs):
+        """(n, PERMS) signatures -> (n, BANDS) 64-bit band hashes."""
+        bands = sigs.reshape(len(sigs), cls.BANDS, cls.ROWS).astype(np.uint64)
+        keys = bands[..., 0]
+        for r in range(1, cls.ROWS):
+            keys = keys * np.uint64(0x9E3779B97F4A7C15) ^ bands[..., r]  # wraps mod 2**64
+        return keys
+
+    def similarity(self, item_id: str, sig) -> float:
+        """Estimated Jaccard similarity of `sig` with a stored memory's text."""
+        return float(np.mean(self.sigs[self.rows[item_id]] == sig))
+
+    def add(self, item_id: str, text: str):
+        digest = text_digest(text)
+        row = self.rows.get(item_id)
+        if row is not None and self.digests[row] == digest:
+            return
+        self.remove(item_id)
+        self._append(item_id, digest, self.signature(text))
+
+    def _append(self, item_id: str, digest: str, sig):
+        row = len(self.ids)
+        if row >= len(self.sigs):
+            capacity = max(256, 2 * len(self.sigs))
+            self.sigs = np.resize(self.sigs, (capacity, self.PERMS))
+            self.keys = np.resize(self.keys, (capacity, self.BANDS))
+        self.sigs[row] = sig
+        self.keys[row] = self.band_keys(sig[None])[0]
+        self.ids.append(item_id)
+        self.digests.append(digest)
+        self.rows[item_id] = row
+        self.unsaved.append([item_id, digest, sig.tolist()])
+        if row + 1 - self.indexed > self.TAIL:
+            self._sort()
+
+    def _sort(self):
+        n = len(self.ids)
+        self.sorted = []
+        for band in range(self.BANDS):
+            order = np.argsort(self.keys[:n, band])
+            self.sorted.append((order, self.keys[order, band]))
+        self.indexed = n
+
+    def remove(self, item_id: str):
+        row = self.rows.pop(item_id, None)
+        if row is not None:
+            self.ids[row] = None
+            self.unsaved.append([item_id])
+
+    def candidates(self, sig) -> list:
+        """[(estimated Jaccard, item_id)] of memories sharing a band with `sig`, best first."""
+        query = self.band_keys(sig[None])[0]
+        rows = set()
+        for band, (order, keys) in enumerate(self.sorted):
+            lo, hi = np.searchsorted(keys, query[band], 'left'), np.searchsorted(keys, query[band], 'right')
+            rows.update(order[lo:hi].tolist())
+        tail = self.keys[self.indexed:len(self.ids)]
+        rows.update((np.nonzero((tail == query).any(axis=1))[0] + self.indexed).tolist())
+        rows = [row for row in rows if self.ids[row] is not None]
+        tally("dedup_candidates", len(rows))
+        if not rows:
+            return []
+        scores = (self.sigs[rows] == sig).mean(axis=1)
+        return sorted(((float(score), self.ids[row]) for score, row in zip(scores, rows)), reverse=True)
+
+    def load(self, items):
+        """Load saved signatures for the memories in `items` and compute the missing ones."""
+        ids, digests, sigs = [], [], np.zeros((0, self.PERMS), dtype=np.uint32)
+        if self.path.exists():
+            try:
+                with np.load(self.path) as f:
+                    ids, digests, sigs = f["ids"].tolist(), f["digests"].tolist(), f["sigs"]
+            except (OSError, ValueError, KeyError):
+                pass
+        changed = {}  # item id -> (digest, sig), or None once removed
+        if self.log_path.exists():
+            with open(self.log_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        break  # torn last line
+                    changed[op[0]] = (op[1], np.array(op[2], dtype=np.uint32)) if len(op) > 1 else None
+                    self.logged += 1
+
+        texts = {f"{layer}/{key}": data.get("content", "") for layer, key, data in items}
+        keep = [row for row, item_id in enumerate(ids) if item_id in texts and item_id not in changed]
+        self.ids = [ids[row] for row in keep]
+        self.digests = [digests[row] for row in keep]
+        self.rows = {item_id: row for row, item_id in enumerate(self.ids)}
+        self.sigs = sigs[keep]
+        self.keys = self.band_keys(self.sigs)
+        self._sort()
+        for item_id, entry in changed.items():
+            if entry is not None and item_id in texts:
+                self._append(item_id, *entry)
+        self.unsaved = []  # already in the log; stale entries drop out at the next rewrite
+        for item_id, text in texts.items():
+            if item_id not in self.rows:
+                self._append(item_id, text_digest(text), self.signature(text))
+        if len(ids) - len(keep) > len(self.ids) // 4:
+            self.unsaved.append(None)  # force a rewrite
+
+    def save(self):
+        """Append unsaved changes to the log, or rewrite the snapshot once the log is long."""
+        if not self.unsaved:
+            return
+        if None not in self.unsaved and self.logged + len(self.unsaved) <= max(256, len(self.rows) // 8):
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write("".join(json.dumps(op) + "\n" for op in self.unsaved))
+            self.logged += len(self.unsaved)
+            self.unsaved = []
+            return
+        live = [row for row in range(len(self.ids)) if self.ids[row] is not None]
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(f, ids=np.array([self.ids[row] for row in live], dtype=str),
+                     digests=np.array([self.digests[row] for row in live], dtype=str),
+                     sigs=self.sigs[live])
+        os.replace(tmp, self.path)
+        if self.log_path.exists():
+            self.log_path.unlink()
+        self.logged = 0
+        self.unsaved = []
+
+
+_dedup_index = None
+
+
+def get_dedup_index() -> DedupIndex:
+    global _dedup_index
+    with _state_lock:
+        if _dedup_index is None:
+            index = DedupIndex(DEDUP_INDEX_FILE)
+            with timed("dedup_index_load"):
+                index.load(get_backend().items())
+            _dedup_index = index
+        return _dedup_index
+
+
+def save_dedup_index():
+    if _dedup_index is not None:
+        ensure_dir()
+        _dedup_index.save()
+
+
+def find_duplicate(content: str, layer: str, vector=None, accept=None, pending: dict = None):
+    """
+    The memory of `layer` that `content` nearly repeats, as (item_id, score,
+    method), or None: the best MinHash candidate with estimated Jaccard of at
+    least DEDUP_JACCARD, else (for texts of DEDUP_MIN_CHARS or more) the
+    nearest embedding with cosine of at least DEDUP_COSINE. `vector` saves
+    encoding `content`, `accept(item_id)` narrows the candidates and `pending`
+    holds not-yet-stored memories by id.
+    """
+    index = get_dedup_index()
+    backend = get_backend()
+    ok = lambda item_id: item_id.startswith(layer + "/") and (accept is None or accept(item_id))
+    with timed("dedup"):
+        sig = index.signature(content)
+        for score, item_id in index.candidates(sig):
+            if score < DEDUP_JACCARD:
+                break
+            if not ok(item_id):
+                continue
+            # The index may predate edits made elsewhere: check against the current text
+            data = (pending or {}).get(item_id) or backend.get(*item_id.split("/", 1))
+            if data is None:
+                index.remove(item_id)
+                continue
+            index.add(item_id, data.get("content", ""))
+            score = index.similarity(item_id, sig)
+            if score >= DEDUP_JACCARD:
+                return item_id, score, "minhash"
+
+        if len(content) < DEDUP_MIN_CHARS or get_model() is None:
+            return None
+        if vector is None:
+            vector = encode_texts([content])[0]
+        for score, item_id in nearest_vectors(vector, 8)[0]:
+            if score < DEDUP_COSINE:
+                break
+            # Vectors of memories deleted in an open transaction are only dropped when it commits
+            if ok(item_id) and (item_id in (pending or {}) or backend.get(*item_id.split("/", 1)) is not None):
+                return item_id, score, "cosine"
+    return None
+
+
+def merged_fields(survivor: dict, duplicate: dict) -> dict:
+    """
+    `duplicate` folded into `survivor`: tags and sources united, counts
+    summed, and the text of whichever is newer kept (a compressed survivor
+    keeps its summary).
+    """
+    sources = [s for data in (survivor, duplicate) for s in (data.get("source") or "").split("; ") if s]
+    fields = {
+        "tags": list(dict.fromkeys(survivor.get("tags", []) + duplicate.get("tags", []))),
+        "source": "; ".join(dict.fromkeys(sources)),
+        "accessed": survivor.get("accessed", 0) + duplicate.get("accessed", 0),
+    }
+    for field, pick in (("created", min), ("updated", max), ("last_accessed", max)):
+        stamps = [data[field] for data in (survivor, duplicate) if data.get(field)]
+        if stamps:
+            fields[field] = pick(stamps)
+    age = lambda data: data.get("updated") or data.get("created") or ""
+    if (age(duplicate) > age(survivor) and not survivor.get("compressed")
+            and duplicate.get("content") and duplicate["content"] != survivor.get("content")):
+        fields["content"] = duplicate["content"]
+    return fields
+
+
+def merge_into(item_id: str, duplicate: dict, pending: dict = None, embed: list = None):
+    """
+    Merge `duplicate` into the memory `item_id` (stored or in `pending`).
+    A stored survivor whose text changed is queued on `embed` as
+    (layer, key, content) for re-embedding.
+    """
+    if pending and item_id in pending:
+        pending[item_id].update(merged_fields(pending[item_id], duplicate))
+        return
+    layer, key = item_id.split("/", 1)
+    fields = {}
+
+    def change(data):
+        fields.update(merged_fields(data, duplicate))
+        return fields
+
+    survivor = get_backend().update(layer, key, change)
+    if survivor is not None:
+        get_forget_engine().touch(layer, key, survivor)
+        if "content" in fields and embed is not None:
+            embed.append((layer, key, fields["content"]))
+
+
+def dedupe_items(items: list, pending: dict = None, embed: list = None, vectors: dict = None) -> list:
+    """
+    Drop the [(layer, key, data)] about to be added that nearly repeat an
+    existing memory, or an earlier item (also tracked in `pending`, which
+    batches share across calls), merging each into the memory it repeats.
+    Survivors that took a newer text go on `embed` (see merge_into). The
+    cosine check reads embeddings from `vectors` ({content: vector}, see
+    MemoryStore.prepare) and adds the ones it has to encode, for
+    embed_memories to reuse. Returns the items to store.
+    """
+    if not DEDUP_ON_INGEST or not items:
+        return items
+    pending = {} if pending is None else pending
+    index = get_dedup_index()
+    kept = []
+    for layer, key, data in items:
+        content = data["content"]
+        vector = None
+        if vectors is not None and len(content) >= DEDUP_MIN_CHARS and get_model() is not None:
+            vector = vectors.get(content)
+            if vector is None:
+                vector = vectors[content] = encode_texts([content])[0]
+        match = find_duplicate(content, layer, vector=vector, pending=pending)
+        if match:
+            item_id, score, method = match
+            merge_into(item_id, data, pending, embed)
+            print(f"[Dedup] {key} merged into {item_id} ({method} {score:.2f})")
+            continue
+        pending[f"{layer}/{key}"] = data
+        index.add(f"{layer}/{key}", content)
+        kept.append((layer, key, data))
+    return kept
+
+
+def dedupe_memories(layer: str = None, dry_run: bool = False) -> list:
+    """
+    Offline pass over an existing bank: memories are visited oldest first, and
+    each one that nearly repeats an older memory of its layer is merged into
+    it and deleted. Compressed memories are left alone (their content is only
+    a summary). Returns [(duplicate id, survivor id)].
+    """
+    session = MemoryStore()
+    store = get_vector_store() if get_model() is not None else None
+    items = sorted(session.backend.items(layer), key=lambda item: item[2].get("created") or "")
+    order = {f"{l}/{k}": i for i, (l, k, _) in enumerate(items)}
+    merged, gone = [], set()
+    for i, (l, key, data) in enumerate(items):
+        if data.get("compressed"):
+            continue
+        accept = lambda other: order.get(other, i) < i and other not in gone
+        vector = store.get(l, key) if store is not None else None
+        match = find_duplicate(data.get("content", ""), l, vector=vector, accept=accept)
+        if not match:
+            continue
+        survivor, score, method = match
+        if dry_run:
+            print(f"[Dedup] would merge {l}/{key} into {survivor} ({method} {score:.2f})")
+        else:
+            session.prepare([data.get("content", "")])
+            with session.transaction():
+                merge_into(survivor, data, embed=session._pending["embed"])
+                session.delete(key, l)
+            print(f"[Dedup] merged {l}/{key} into {survivor} ({method} {score:.2f})")
+        gone.add(f"{l}/{key}")
+        merged.append((f"{l}/{key}", survivor))
+    save_dedup_index()
+    print(f"[Dedup] {len(merged)} duplicates {'to merge' if dry_run else 'merged'}")
+    return merged
 
 
 # ==================== INDEXING & UPDATING ====================
+_BULLET_RE = re.compile(r'^[\s]*[-*•\d]+\.?\s')
+_HEADER_RE = re.compile(r'^#{1,6}\s|^[A-Z][^.!?\n]{5,60}$')
+_CONCEPT_RE = re.compile(r'\b[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*\b')
+_EST_TOKEN_RE = re.compile(f"[{_CJK}]|[^\\W{_CJK}]+|[^\\w\\s]")
+
+
 def index_memory(key: str, layer: str, tags: list):
     """Add tags to existing memory."""
-    memories = load_memories()
+    store = MemoryStore()
 
-    if layer not in memories:
+    if layer not in store.counts():
         print(f"[Error] Layer '{layer}' not found")
         return
 
-    if key not in memories[layer]:
+    if store.tag(key, layer, tags) is None:
         print(f"[Error] Memory '{key}' not found")
         return
-
-    memory = memories[layer][key]
-    existing = set(memory.get("tags", []))
-    new_tags = set(tags)
-    memory["tags"] = list(existing | new_tags)
-    memory["updated"] = datetime.now().isoformat()
-    memory["accessed"] = memory.get("accessed", 0) + 1
-
-    save_memories(memories)
-    print(f"[Index] {key}: added {len(new_tags)} tags")
+    print(f"[Index] {key}: added {len(set(tags))} tags")
 
 
 def update_memory(key: str, layer: str, new_content: str):
     """Update memory content."""
-    memories = load_memories()
+    store = MemoryStore()
 
-    if layer not in memories:
+    if layer not in store.counts():
         print(f"[Error] Layer '{layer}' not found")
         return
 
-    if key not in memories[layer]:
+    try:
+        memory = store.update(key, layer, new_content)
+    except ValueError as e:
+        print(f"[Error] {e}")
+        return
+    if memory is None:
         print(f"[Error] Memory '{key}' not found")
         return
+    print(f"[Update] {key}: content updated")
 
-    if len(new_content.strip()) < 20:
-        print("[Error] Content too short (<20 chars)")
+
+def reindex_memories(batch_size: int = 32, force: bool = False):
+    """
+    Backfill embeddings for all memories.
+
+    Items are encoded in batches (longest first, so each batch pads to similar
+    lengths); each batch is committed to the vector store under the lock as
+    soon as it is encoded, and the embedding cache is flushed every
+    REINDEX_CHECKPOINT_EVERY items. Memories whose content hash and model are
+    unchanged since they were last embedded are skipped, which also makes an
+    interrupted reindex resume where it stopped.
+    """
+    if get_model() is None:
+        print("[Error] Embedding model unavailable. Cannot reindex.")
         return
 
-    memory = memories[layer][key]
-    memory["content"] = new_content
-    memory["updated"] = datetime.now().isoformat()
-    memory["accessed"] = 0
+    backend = get_backend()
+    store = get_vector_store()
+    total = 0
+    todo = []
+    live = set()
+    for layer, key, data in backend.items():
+        total += 1
+        live.add(store.item_id(layer, key))
+        content = data.get("content", "")
+        if not content.strip():
+            continue
+        if force or store.hashes.get(store.item_id(layer, key)) != content_hash(content):
+            todo.append((layer, key, content))
 
-    save_memories(memories)
-    print(f"[Update] {key}: content updated")
+    # Drop vectors whose memory no longer exists
+    with store.writing():
+        for item_id in [item_id for item_id in store.rows if item_id not in live]:
+            store.delete(*item_id.split("/", 1))
 
+    print(f"[Reindex] {len(todo)}/{total} memories need embeddings "
+          f"({total - len(todo)} unchanged, batch size {batch_size})")
+    todo.sort(key=lambda item: len(item[2]), reverse=True)
 
-    save_memories(memories)
-    print(f"[Update] {key}: content updated")
+    count = 0
+    since_checkpoint = 0
+    start = time.perf_counter()
+    for i in range(0, len(todo), batch_size):
+        batch = todo[i:i + batch_size]
+        try:
+            vectors = encode_texts([content for _, _, content in batch], batch_size=batch_size)
+        except Exception as e:
+            print(f"\n  [Error] Failed to encode batch at item {i}: {e}")
+            continue
+        with store.writing():
+            for (layer, key, content), vector in zip(batch, vectors):
+                store.set(layer, key, vector, content_hash(content))
+        count += len(batch)
+        since_checkpoint += len(batch)
+        if since_checkpoint >= REINDEX_CHECKPOINT_EVERY:
+            flush_embedding_cache()
+            since_checkpoint = 0
+        rate = count / max(time.perf_counter() - start, 1e-9)
+        print(f"  Processed {count}/{len(todo)} items ({rate:.1f} items/s)...", end='\r')
 
+    flush_embedding_cache()
+    if ANN_FILE.exists() and len(store):
+        with store.writing():
+            # None when load() dropped an index built for another dimension
+            ann = get_ann_index() or IVFIndex(ANN_FILE, store)
+            ann.build()
+            ann.save()
+    get_dedup_index()  # computes signatures for memories the saved index lacks
+    save_dedup_index()
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print(f"\n[Reindex] Complete. Updated {count}/{total} memories "
+          f"in {elapsed:.1f}s ({rate:.1f} items/s).")
+
+
+def content_stats(lines) -> dict:
+    """
+    One streaming pass over `lines` collecting what analyze_content_richness
+    needs: characters, estimated tokens, paragraphs, bullets, headers and
+    (up to 20) distinct capitalized concepts.
+    """
+    stats = {"chars": 0, "tokens": 0, "paragraphs": 0, "bullets": 0, "headers": 0}
+    concepts = set()
+    for line in lines:
+        stats["chars"] += len(line)
+        stats["tokens"] += count_tokens(line)
+        if not line.strip():
+            continue
+        # Count paragraphs (non-empty lines)
+        stats["paragraphs"] += 1
+        # Count bullet points (lines starting with -, *, •, or numbered lists)
+        if _BULLET_RE.match(line):
+            stats["bullets"] += 1
+        # Count headers (lines that look like titles/headers)
+        if _HEADER_RE.match(line.rstrip('\n')):
+            stats["headers"] += 1
+        # Count distinct concepts (capitalized terms); only 20 matter for the score
+        if len(concepts) < 20:
+            concepts.update(_CONCEPT_RE.findall(line))
+    stats["concepts"] = len(concepts)
+    return stats
+
+
+def richness_score(stats: dict) -> int:
+    """Weighted 1-10 score from content_stats()."""
+    if not stats["chars"]:
+        return 1
+    richness = (
+        min(3, stats["chars"] // 500) +
+        min(2, stats["paragraphs"] // 5) +
+        min(2, stats["bullets"] // 5) +
+        min(2, stats["headers"] // 3) +
+        min(1, stats["concepts"] // 20)
+    )
+    return max(1, min(10, richness))
 
-def reindex_memories():
-    """Backfill embeddings for all memories."""
-    if not HAS_SEMANTIC:
-        print("[Error] sentence-transformers not installed. Cannot reindex.")
-        return
 
-    memories = load_memories()
-    count = 0
-    total = 0
-    
-    print("[Reindex] Generating embeddings for existing memories...")
-    for layer, items in memories.items():
-        for key, data in items.items():
-            total += 1
-            if "content" in data and data["content"].strip():
-                try:
-                    # Always regenerate to ensure latest model compatibility
-                    embedding = model.encode(data["content"]).tolist()
-                    data["embedding"] = embedding
-                    count += 1
-                    if count % 10 == 0:
-                        print(f"  Processed {count} items...", end='\r')
-                except Exception as e:
-                    print(f"  [Error] Failed to encode {key}: {e}")
-                    
-    save_memories(memories)
-    print(f"\n[Reindex] Complete. Updated {count}/{total} memories.")
 def analyze_content_richness(content: str) -> int:
     """
     Analyze content richness and return a score from 1-10.
@@ -337,204 +3598,904 @@ def analyze_content_richness(content: str) -> int:
     """
     if not content or not content.strip():
         return 1
+    return richness_score(content_stats(io.StringIO(content)))
 
-    # Count paragraphs (non-empty lines)
-    paragraphs = [p for p in content.split('\n') if p.strip()]
-    para_count = len(paragraphs)
 
-    # Count bullet points (lines starting with -, *, •, or numbered lists)
-    bullet_pattern = r'^[\s]*[-*•\d]+\.?\s'
-    bullet_count = len(re.findall(bullet_pattern, content, re.MULTILINE))
+def count_tokens(text: str) -> int:
+    """Rough token count: words, punctuation marks and CJK characters."""
+    return len(_EST_TOKEN_RE.findall(text))
 
-    # Count headers (lines that look like titles/headers)
-    header_pattern = r'^#{1,6}\s|^[A-Z][^.!?\n]{5,60}$'
-    header_count = len(re.findall(header_pattern, content, re.MULTILINE))
 
-    # Count distinct concepts (look for key terms - nouns/capitalized words)
-    concept_pattern = r'\b[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*\b'
-    concept_count = len(set(re.findall(concept_pattern, content)))
+def read_lines(f, limit: int = 1 << 16):
+    """Lines of an open text file, with very long lines cut into `limit`-char pieces."""
+    return iter(lambda: f.readline(limit), "")
 
-    # Character count (logarithmic scale contribution)
-    char_count = len(content)
-    char_score = min(10, char_count // 500)
 
-    # Weighted scoring
-    richness = (
-        min(3, char_score) +
-        min(2, para_count // 5) +
-        min(2, bullet_count // 5) +
-        min(2, header_count // 3) +
-        min(1, concept_count // 20)
-    )
+def iter_blocks(lines):
+    """
+    Group lines into blocks: paragraphs split at blank lines, with headers
+    starting a new block and fenced code kept together. Yields (text, is_header).
+    """
+    block, is_header, in_code = [], False, False
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            in_code = not in_code
+        elif not in_code:
+            if not stripped:
+                if block:
+                    yield "".join(block).strip(), is_header
+                block, is_header = [], False
+                continue
+            if re.match(r'#{1,6}\s', line):
+                if block:
+                    yield "".join(block).strip(), is_header
+                block, is_header = [], True
+        block.append(line)
+    if block and "".join(block).strip():
+        yield "".join(block).strip(), is_header
 
-    return max(1, min(10, richness))
+
+def split_block(text: str, max_tokens: int):
+    """Cut an oversized block at sentence ends (or hard, as a last resort)."""
+    piece, size = [], 0
+    for sentence in _SENTENCE_RE.findall(text):
+        tokens = count_tokens(sentence)
+        if tokens > max_tokens:
+            if piece:
+                yield "".join(piece).strip()
+                piece, size = [], 0
+            words = _EST_TOKEN_RE.findall(sentence)
+            for start in range(0, len(words), max_tokens):
+                yield " ".join(words[start:start + max_tokens])
+            continue
+        if piece and size + tokens > max_tokens:
+            yield "".join(piece).strip()
+            piece, size = [], 0
+        piece.append(sentence)
+        size += tokens
+    if piece and "".join(piece).strip():
+        yield "".join(piece).strip()
+
+
+def overlap_tail(text: str, overlap: int) -> str:
+    """The trailing sentences of `text` that fit in `overlap` tokens."""
+    tail, size = [], 0
+    for sentence in reversed(_SENTENCE_RE.findall(text)):
+        size += count_tokens(sentence)
+        if size > overlap:
+            break
+        tail.append(sentence)
+    return "".join(reversed(tail)).strip()
+
+
+def iter_chunks(lines, target_tokens: int = None, overlap: int = None):
+    """
+    Stream token-bounded chunks from `lines` (any iterable of text lines).
+
+    Blocks are packed until the next one would pass `target_tokens`; headers
+    start a new chunk once the current one is half full. Each chunk after the
+    first starts with the last sentences (up to `overlap` tokens) of the
+    previous one. Only one chunk is held at a time, nothing is dropped, and a
+    short tail is merged into the last chunk when the result still fits
+    CHUNK_MAX_TOKENS (otherwise it stays a short final chunk).
+    """
+    target_tokens = target_tokens or CHUNK_MAX_TOKENS
+    overlap = CHUNK_OVERLAP_TOKENS if overlap is None else overlap
+    parts, size, fresh = [], 0, 0  # `fresh` = tokens not carried over from the previous chunk
+    carried = False
+    pending = None
+
+    # Leave room for the carried-over tail so no chunk passes target_tokens
+    block_limit = max(target_tokens - overlap, target_tokens // 2)
+
+    def blocks():
+        for text, is_header in iter_blocks(lines):
+            tokens = count_tokens(text)
+            if tokens > block_limit:
+                for piece in split_block(text, block_limit):
+                    yield piece, False, count_tokens(piece)
+            else:
+                yield text, is_header, tokens
+
+    for text, is_header, tokens in blocks():
+        if fresh and (size + tokens > target_tokens or (is_header and size >= target_tokens // 2)):
+            if pending is not None:
+                yield pending
+            pending = "\n\n".join(parts)
+            tail = overlap_tail(parts[-1], overlap) if overlap else ""
+            carried = bool(tail)
+            parts, size, fresh = ([tail], count_tokens(tail), 0) if tail else ([], 0, 0)
+        parts.append(text)
+        size += tokens
+        fresh += tokens
+
+    if fresh:
+        merged = None
+        if pending is not None and fresh < CHUNK_MIN_TOKENS:
+            merged = pending + "\n\n" + "\n\n".join(parts[1:] if carried else parts)
+            if count_tokens(merged) > max(target_tokens, CHUNK_MAX_TOKENS):
+                merged = None
+        if merged is not None:
+            pending = merged
+        else:
+            if pending is not None:
+                yield pending
+            pending = "\n\n".join(parts)
+    if pending is not None:
+        yield pending
 
 
 def split_into_memories(content: str, min_memories: int = 1, max_memories: int = 10) -> list:
     """
     Split content into multiple independent memories based on structure.
     Returns a list of memory contents.
+
+    Aims for about `richness` (clamped to min/max) chunks, but never lets a
+    chunk pass CHUNK_MAX_TOKENS and never drops content: long documents get
+    as many chunks as they need.
     """
     if not content or not content.strip():
         return []
+    stats = content_stats(io.StringIO(content))
+    return list(iter_chunks(io.StringIO(content), chunk_target(stats, min_memories, max_memories)))
 
-    # Estimate number of memories based on richness
-    richness = analyze_content_richness(content)
-    estimated_count = max(min_memories, min(max_memories, richness))
-
-    # Strategy 1: Split by headers (most common structure)
-    header_pattern = r'(?=^#{1,6}\s|^[A-Z][^.!?\n]{5,60}$)'
 
-    # Split by major sections (double newline + header or numbered sections)
-    section_pattern = r'(?=\n\s*\n#{1,6}\s|\n\s*\d+\.\s|\n\s*[-•]\s*[-•\s])'
+def chunk_target(stats: dict, min_memories: int, max_memories: int) -> int:
+    """Tokens per chunk that yield about the richness-based memory count."""
+    count = max(min_memories or 1, min(max_memories, richness_score(stats)))
+    return max(CHUNK_MIN_TOKENS, min(CHUNK_MAX_TOKENS, -(-stats["tokens"] // count)))
 
-    # Alternative: split by numbered sections
-    numbered_pattern = r'(?=\n\s*\d+\.\s|\n#{1,6}\s)'
 
-    # Extract potential memory sections
-    sections = []
-    current_section = ""
+def file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
 
-    lines = content.split('\n')
-    in_code_block = False
 
-    for line in lines:
-        # Handle code blocks
-        if '```' in line:
-            in_code_block = not in_code_block
-
-        if not in_code_block:
-            # Check for new section start
-            is_new_section = (
-                line.startswith('# ') or
-                line.startswith('## ') or
-                line.startswith('### ') or
-                re.match(r'^\d+\.\s', line) or
-                (line.strip() and not line.startswith(' ') and not line.startswith('\t'))
-            )
-            if is_new_section and current_section.strip():
-                sections.append(current_section.strip())
-                current_section = line
-            else:
-                current_section += '\n' + line
-        else:
-            current_section += '\n' + line
-
-    if current_section.strip():
-        sections.append(current_section.strip())
-
-    # If we have good sections, use them
-    if len(sections) >= 2:
-        # Filter out very short sections
-        meaningful_sections = [s for s in sections if len(s) > 50]
-        if len(meaningful_sections) >= min_memories:
-            return meaningful_sections[:max_memories]
+def read_extract_cache(digest: str) -> dict:
+    path = EXTRACT_CACHE_DIR / f"{digest}.json"
+    if path.exists():
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return {}
 
-    # Strategy 2: Split by paragraphs if content is long
-    paragraphs = [p.strip() for p in content.split('\n\n') if p.strip() and len(p.strip()) > 30]
 
-    if len(paragraphs) >= min_memories:
-        # Group paragraphs into memories
-        target_count = estimated_count
-        paragraph_per_memory = max(1, len(paragraphs) // target_count)
+def write_extract_cache(digest: str, entry: dict):
+    try:
+        EXTRACT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        atomic_write_json(EXTRACT_CACHE_DIR / f"{digest}.json", entry)
+    except OSError as e:
+        print(f"[Warning] Could not write extraction cache: {e}")
 
-        memories = []
-        current_memory = ""
 
-        for i, para in enumerate(paragraphs):
-            current_memory += para + "\n\n"
-            if (i + 1) % paragraph_per_memory == 0 or i == len(paragraphs) - 1:
-                if current_memory.strip():
-                    memories.append(current_memory.strip())
-                current_memory = ""
+_markitdown = None
 
-        return memories[:max_memories]
 
-    # Strategy 3: If content is short, return as single memory
-    return [content.strip()] if len(content.strip()) > 20 else []
+def convert_in_process(path: Path) -> str:
+    """Convert with a process-wide MarkItDown instance (import paid once)."""
+    global _markitdown
+    if _markitdown is None:
+        from markitdown import MarkItDown
+        _markitdown = MarkItDown()
+    return _markitdown.convert(str(path)).text_content
 
 
-def extract_file_content(file_path: str) -> str:
+def convert_subprocess(path: Path, out_path: Path) -> bool:
     """
-    Extract text content from file using markitdown.
-    Supports: pptx, pdf, docx, xlsx, html, markdown, etc.
+    Convert in a separate interpreter, streaming its stdout into `out_path`;
+    isolates crashes and hangs in converters.
     """
-    path = Path(file_path)
-    if not path.exists():
-        print(f"[Error] File not found: {file_path}")
-        return None
-
     try:
         # Use markitdown for extraction
-        result = subprocess.run(
-            [sys.executable, "-m", "markitdown", str(path)],
-            capture_output=True,
-            text=True,
-            timeout=120
-        )
+        with open(out_path, 'w', encoding='utf-8') as out:
+            result = subprocess.run(
+                [sys.executable, "-m", "markitdown", str(path)],
+                stdout=out,
+                stderr=subprocess.PIPE,
+                text=True,
+                timeout=120
+            )
 
         if result.returncode == 0:
-            return result.stdout
+            return True
         else:
             print(f"[Error] markitdown failed: {result.stderr}")
-            return None
+            return False
 
     except FileNotFoundError:
         print("[Error] markitdown not found. Install: pip install markitdown")
-        return None
+        return False
     except subprocess.TimeoutExpired:
-        print(f"[Error] Timeout extracting: {file_path}")
-        return None
+        print(f"[Error] Timeout extracting: {path}")
+        return False
     except Exception as e:
         print(f"[Error] Extraction failed: {e}")
+        return False
+
+
+def extract_to_cache(file_path: str, digest: str = None) -> Path:
+    """
+    Extract text content from file using markitdown into
+    extract_cache/<sha256>.md and return that path (None on failure).
+    Supports: pptx, pdf, docx, xlsx, html, markdown, etc.
+
+    Runs markitdown in-process (falling back to a subprocess on failure, or
+    always with CLAUDE_MEMORY_EXTRACT_ISOLATED=1). The subprocess output is
+    streamed to disk, so it is never held in memory as one string.
+    """
+    path = Path(file_path)
+    if not path.exists():
+        print(f"[Error] File not found: {file_path}")
         return None
 
+    digest = digest or file_digest(path)
+    md_path = EXTRACT_CACHE_DIR / f"{digest}.md"
+    if md_path.exists():
+        return md_path
+    EXTRACT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = md_path.with_name(f"{md_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
 
-def process_file(file_path: str, layer: str = "cognitive", min_memories: int = None, max_memories: int = 10):
+    cached = read_extract_cache(digest)
+    if "markdown" in cached:
+        # Cache entry from before markdown moved out of the JSON
+        tmp.write_text(cached["markdown"], encoding='utf-8')
+        os.replace(tmp, md_path)
+        return md_path
+
+    ok = False
+    if not EXTRACT_ISOLATED:
+        try:
+            tmp.write_text(convert_in_process(path) or "", encoding='utf-8')
+            ok = True
+        except ImportError:
+            pass
+        except Exception as e:
+            print(f"[Warning] In-process extraction failed ({e}); retrying in subprocess")
+    if not ok:
+        ok = convert_subprocess(path, tmp)
+
+    if not ok or tmp.stat().st_size == 0:
+        tmp.unlink(missing_ok=True)
+        return None
+    os.replace(tmp, md_path)
+    write_extract_cache(digest, {"source": str(path), "chunks": {}})
+    return md_path
+
+
+def extract_file_content(file_path: str, digest: str = None) -> str:
+    """Extracted markdown of a file as one string (see extract_to_cache)."""
+    md_path = extract_to_cache(file_path, digest)
+    return md_path.read_text(encoding='utf-8') if md_path else None
+
+
+def prepare_file(file_path: str, min_memories: int = None, max_memories: int = 10, digest: str = None) -> tuple:
     """
-    Process a file and create multiple memories based on content richness.
-    Automatically determines memory count (1-10) based on content analysis.
+    Extract and split one file. Returns (chunks, log_lines).
+    Runs in batch worker processes, so it only computes and never writes.
+    Chunks are cached alongside the extracted markdown, keyed by the split
+    parameters, so an unchanged file is neither re-extracted nor re-split.
+    The markdown is streamed from the cache file twice (stats, then chunks),
+    so memory stays bounded however large the document is.
     """
-    print(f"[Process] Reading: {file_path}")
+    log = [f"[Process] Reading: {file_path}"]
+    path = Path(file_path)
+    if not path.exists():
+        print(f"[Error] File not found: {file_path}")
+        return [], log
+
+    digest = digest or file_digest(path)
+    params = (f"v{SPLIT_VERSION}:min={min_memories}:max={max_memories}"
+              f":tokens={CHUNK_MAX_TOKENS}:overlap={CHUNK_OVERLAP_TOKENS}")
+    cached = read_extract_cache(digest)
+    if params in cached.get("chunks", {}):
+        chunks = cached["chunks"][params]
+        log.append(f"[Process] Unchanged since last extraction, {len(chunks)} cached chunks")
+        return chunks, log
 
     # Extract content
-    content = extract_file_content(file_path)
-    if not content:
-        return 0
+    md_path = extract_to_cache(file_path, digest)
+    if md_path is None:
+        return [], log
 
     # Analyze richness to determine memory count
-    richness = analyze_content_richness(content)
+    with open(md_path, encoding='utf-8') as f:
+        stats = content_stats(read_lines(f))
+    richness = richness_score(stats)
     auto_min = max(1, richness - 2)
     auto_max = min(10, richness + 2)
     effective_min = min_memories if min_memories is not None else auto_min
+    target = chunk_target(stats, effective_min, max_memories or auto_max)
 
-    print(f"[Process] Content richness: {richness}/10, creating {effective_min}-{auto_max} memories")
+    log.append(f"[Process] Content richness: {richness}/10, ~{stats['tokens']} tokens, "
+               f"chunks of <= {target} tokens")
 
     # Split into memories
-    memories = split_into_memories(content, min_memories=effective_min, max_memories=max(10, auto_max))
+    with timed("split"), open(md_path, encoding='utf-8') as f:
+        chunks = [chunk for chunk in iter_chunks(read_lines(f), target) if len(chunk) > 20]
+    tally("chunks", len(chunks))
+    if not chunks:
+        log.append("[Process] No meaningful content extracted")
+
+    cached = read_extract_cache(digest)
+    cached.pop("markdown", None)
+    cached.setdefault("chunks", {})[params] = chunks
+    write_extract_cache(digest, cached)
+    return chunks, log
+
 
+def file_memories(file_path: str, chunks: list, layer: str, taken: set) -> list:
+    """Build (layer, key, data) records for a file's chunks with unique keys."""
+    backend = get_backend()
+    file_stem = Path(file_path).stem
+    items = []
+    for i, chunk in enumerate(chunks):
+        key = f"{file_stem}_{i+1:02d}"
+        while (layer, key) in taken or backend.get(layer, key) is not None:
+            key = f"{key}_1"
+        taken.add((layer, key))
+        items.append((layer, key, new_memory(chunk, layer, tags=[file_stem], source=file_path)))
+    return items
+
+
+def process_file(file_path: str, layer: str = "cognitive", min_memories: int = None, max_memories: int = 10):
+    """
+    Process a file and create multiple memories based on content richness.
+    Automatically determines memory count (1-10) based on content analysis.
+    """
+    memories = MemoryStore().ingest(file_path, layer, min_memories, max_memories)
     if not memories:
-        print("[Process] No meaningful content extracted")
         return 0
+    for memory in memories:
+        print(f"[{layer[:3].upper()}] {memory.key}")
+    print(f"[Process] Created {len(memories)} memories from {file_path}")
+    return len(memories)
 
-    # Create memories
-    file_stem = Path(file_path).stem
-    created = 0
 
-    for i, mem_content in enumerate(memories):
-        # Store full content
-        display_content = mem_content
+def expand_inputs(specs: list) -> list:
+    """Resolve files, directories (recursively) and glob patterns to a file list."""
+    files = []
+    for spec in specs:
+        path = Path(spec).expanduser()
+        if path.is_dir():
+            files.extend(sorted(str(p) for p in path.rglob("*") if p.is_file() and not p.name.startswith(".")))
+        elif any(ch in spec for ch in "*?["):
+            files.extend(sorted(p for p in glob.glob(os.path.expanduser(spec), recursive=True)
+                                if os.path.isfile(p)))
+        else:
+            files.append(spec)
+    return list(dict.fromkeys(files))
 
-        key = f"{file_stem}_{i+1:02d}"
-        add_memory(display_content, layer, key=key, tags=[file_stem], source=file_path)
-        created += 1
 
-    print(f"[Process] Created {created} memories from {file_path}")
-    return created
+def iter_prepared(files: list, min_memories: int = None, max_memories: int = 10, workers: int = 1,
+                  digests: dict = None):
+    """
+    prepare_file() each of `files` (in a process pool for workers > 1),
+    yielding (file_path, chunks, log) in order of completion.
+    """
+    digests = digests or {}
+    if workers <= 1:
+        for f in files:
+            yield (f, *prepare_file(f, min_memories, max_memories, digests.get(f)))
+        return
+    # Forking a threaded daemon can deadlock; spawn fresh workers there instead
+    context = multiprocessing.get_context("spawn") if IN_DAEMON else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {pool.submit(prepare_file, f, min_memories, max_memories, digests.get(f)): f for f in files}
+        for future in as_completed(futures):
+            try:
+                yield (futures[future], *future.result())
+            except Exception as e:
+                print(f"[Error] Failed to process {futures[future]}: {e}")
+
+
+def batch_process(specs: list, layer: str = "cognitive", min_memories: int = None,
+                  max_memories: int = 10, workers: int = None, batch_size: int = 32) -> int:
+    """
+    Ingest many files at once.
+
+    Files are extracted and split in a process pool; finished chunks are fed
+    to the embedding model (warming the embedding cache) in batches while
+    other files are still extracting, then all new memories go through
+    MemoryStore.insert: deduplicated, committed and embedded in one
+    transaction.
+    """
+    files = expand_inputs(specs)
+    if not files:
+        print("[Batch] No input files")
+        return 0
+    workers = max(1, min(workers or min(4, os.cpu_count() or 1), len(files)))
+    print(f"[Batch] {len(files)} files, {workers} workers")
+
+    items = []
+    pending = []
+    taken = set()
+    warm = get_embedding_cache() is not None and get_model() is not None
+
+    def encode_pending(force=False):
+        while pending and (force or len(pending) >= batch_size):
+            encode_texts(pending[:batch_size], batch_size=batch_size)
+            del pending[:batch_size]
+
+    for file_path, chunks, log in iter_prepared(files, min_memories, max_memories, workers):
+        for line in log:
+            print(line)
+        new_items = file_memories(file_path, chunks, layer, taken)
+        items.extend(new_items)
+        if warm:
+            pending.extend(data["content"] for _, _, data in new_items)
+            encode_pending()
+    encode_pending(force=True)
+
+    stored = MemoryStore().insert(items)
+    for source, count in Counter(memory.source for memory in stored).items():
+        print(f"[Process] {count} memories from {source}")
+    flush_embedding_cache()
+    print(f"[Batch] Total: {len(stored)} memories from {len(files)} files")
+    return len(stored)
+
+
+# ==================== FOLDER SYNC ====================
+# `--sync DIR` keeps the memories of a folder in step with its files.
+# sync_manifest.json records, per file, the size/mtime and content digest it
+# was last synced at and the [chunk digest, key] of each of its chunks. A pass
+# stats every file, hashes only those whose size or mtime moved, re-splits
+# only those whose digest changed (extraction is cached by digest too), and
+# then stores just the chunks that are new and deletes the ones that are gone.
+# Memories of files that disappeared are retired. Chunks evicted by
+# forget_memories are marked in the manifest (forget_synced) and stay
+# forgotten until their text changes.
+def load_sync_manifest() -> dict:
+    if not SYNC_MANIFEST_FILE.exists():
+        return {}
+    try:
+        with open(SYNC_MANIFEST_FILE, encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError:
+        print(f"[Warning] Unreadable {SYNC_MANIFEST_FILE.name}; resyncing from scratch")
+        return {}
+
+
+def scan_folder(root: Path) -> dict:
+    """{path: (size, mtime_ns)} of the files under `root`, skipping hidden files and directories."""
+    found = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for name in sorted(filenames):
+            if name.startswith("."):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            found[path] = (st.st_size, st.st_mtime_ns)
+    return found
+
+
+def sync_chunks(store: MemoryStore, file_path: str, layer: str, chunks: list, old: list) -> tuple:
+    """
+    Make `file_path`'s memories match `chunks`, given the [digest, key] pairs
+    of its previous sync: unchanged chunks keep their memory, stale ones are
+    deleted and new ones added. Returns (new [digest, key] pairs, added, deleted, kept).
+    """
+    previous = {}
+    for digest, key in old:
+        previous.setdefault(digest, []).append(key)
+    pairs, fresh = [None] * len(chunks), []
+    for i, chunk in enumerate(chunks):
+        digest = text_digest(chunk)
+        keys = previous.get(digest)
+        if keys:
+            key = keys.pop(0)
+            # A null key marks a chunk that was merged into a near-duplicate
+            if key is None or store.backend.get(layer, key) is not None:
+                pairs[i] = [digest, key]
+                continue
+        fresh.append((i, digest, chunk))
+    deleted = sum(store.delete(key, layer) for keys in previous.values() for key in keys if key)
+
+    stem, items = Path(file_path).stem, []
+    taken = {pair[1] for pair in pairs if pair and pair[1]}
+    for i, digest, chunk in fresh:
+        key = f"{stem}_{i+1:02d}"
+        while key in taken or store.backend.get(layer, key) is not None:
+            key = f"{key}_1"
+        taken.add(key)
+        items.append((layer, key, new_memory(chunk, layer, tags=[stem], source=file_path)))
+        pairs[i] = [digest, key]
+    stored = {memory.key for memory in store.insert(items)}
+    for (_, key, _), (i, _, _) in zip(items, fresh):
+        if key not in stored:
+            pairs[i][1] = None
+    return pairs, len(stored), deleted, len(chunks) - len(fresh)
+
+
+def sync_folder(directory: str, layer: str = "cognitive", min_memories: int = None,
+                max_memories: int = 10, workers: int = None, quiet: bool = False) -> dict:
+    """
+    One sync pass over `directory` (see above). Returns counts of files
+    (new/changed/unchanged/removed) and chunks (added/deleted/kept). With
+    `quiet`, nothing is printed unless something changed.
+    """
+    root = Path(directory).expanduser().resolve()
+    if not root.is_dir():
+        print(f"[Error] Not a directory: {directory}")
+        return {}
+    manifest = load_sync_manifest()
+    files = scan_folder(root)
+    counts = dict.fromkeys(("new", "changed", "unchanged", "removed", "added", "deleted", "kept"), 0)
+    todo, digests, touched = [], {}, {}
+    with timed("sync_scan"):
+        for path, (size, mtime_ns) in files.items():
+            entry = manifest.get(path)
+            if entry and entry["layer"] == layer and (entry["size"], entry["mtime_ns"]) == (size, mtime_ns):
+                counts["unchanged"] += 1
+                continue
+            try:
+                digest = file_digest(Path(path))
+            except OSError:
+                continue
+            if entry and entry["layer"] == layer and entry["digest"] == digest:
+                touched[path] = (size, mtime_ns)  # touched, not edited
+                counts["unchanged"] += 1
+                continue
+            counts["changed" if entry else "new"] += 1
+            todo.append(path)
+            digests[path] = digest
+    gone = [path for path in manifest if path.startswith(str(root) + os.sep) and path not in files]
+
+    prepared = []
+    if todo:
+        workers = max(1, min(workers or min(4, os.cpu_count() or 1), len(todo)))
+        for file_path, chunks, log in iter_prepared(todo, min_memories, max_memories, workers, digests):
+            for line in log:
+                print(line)
+            prepared.append((file_path, chunks))
+
+    store = MemoryStore()
+    fresh = []
+    for path, chunks in prepared:
+        entry = manifest.get(path)
+        known = {digest for digest, _ in entry["chunks"]} if entry and entry["layer"] == layer else set()
+        fresh.extend(chunk for chunk in chunks if text_digest(chunk) not in known)
+    store.prepare(fresh)  # embed the new chunks before taking the store lock
+    with store.transaction():
+        if todo or gone or touched:
+            # Re-read under the lock: forget_memories may have marked evicted chunks since
+            manifest = load_sync_manifest()
+        for path, (size, mtime_ns) in touched.items():
+            if path in manifest:
+                manifest[path].update(size=size, mtime_ns=mtime_ns)
+        for path in gone:
+            entry = manifest.pop(path, None)
+            if entry is None:
+                continue
+            counts["removed"] += 1
+            counts["deleted"] += sum(store.delete(key, entry["layer"]) for _, key in entry["chunks"] if key)
+            print(f"[Sync] Removed: {path}")
+        for path, chunks in prepared:
+            entry = manifest.get(path)
+            old = entry["chunks"] if entry else []
+            if entry and entry["layer"] != layer:
+                counts["deleted"] += sum(store.delete(key, entry["layer"]) for _, key in old if key)
+                old = []
+            if not chunks and entry:
+                pairs = old  # extraction failed or found nothing: keep what we had
+            else:
+                pairs, added, deleted, kept = sync_chunks(store, path, layer, chunks, old)
+                counts["added"] += added
+                counts["deleted"] += deleted
+                counts["kept"] += kept
+            size, mtime_ns = files[path]
+            manifest[path] = {"size": size, "mtime_ns": mtime_ns, "digest": digests[path],
+                              "layer": layer, "chunks": pairs}
+        if todo or gone or touched:
+            ensure_dir()
+            atomic_write_json(SYNC_MANIFEST_FILE, manifest)
+
+    if not quiet or todo or gone:
+        print(f"[Sync] {root}: {counts['new']} new, {counts['changed']} changed, "
+              f"{counts['unchanged']} unchanged, {counts['removed']} removed files; "
+              f"chunks +{counts['added']} -{counts['deleted']} ={counts['kept']}")
+    return counts
+
+
+def forget_synced(evicted: dict):
+    """
+    Null the manifest keys of synced chunks that were forgotten ({source path:
+    {(layer, key)}}), so --sync treats them like merged chunks and does not
+    store them again while their text is unchanged. Call under STORE_LOCK.
+    """
+    manifest = load_sync_manifest()
+    changed = False
+    for path, keys in evicted.items():
+        entry = manifest.get(path)
+        for pair in entry["chunks"] if entry else []:
+            if (entry["layer"], pair[1]) in keys:
+                pair[1] = None
+                changed = True
+    if changed:
+        atomic_write_json(SYNC_MANIFEST_FILE, manifest)
+
+
+def watch_folder(directory: str, layer: str = "cognitive", min_memories: int = None,
+                 max_memories: int = 10, workers: int = None, interval: float = SYNC_INTERVAL):
+    """Sync `directory`, then poll it every `interval` seconds until interrupted."""
+    sync_folder(directory, layer, min_memories, max_memories, workers)
+    print(f"[Sync] Watching {directory} every {interval:g}s (Ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(interval)
+            sync_folder(directory, layer, min_memories, max_memories, workers, quiet=True)
+    except KeyboardInterrupt:
+        print("[Sync] Stopped")
+
+
+# ==================== DAEMON ====================
+# `memory.py --serve` keeps the model, vector matrix and metadata loaded and
+# answers CLI invocations over a Unix socket in MEMORY_DIR. A normal CLI call
+# forwards its argv to the daemon when one is running; otherwise it starts one
+# in the background and runs the command itself this time. The client's
+# CLAUDE_MEMORY_* environment travels with the request: profiling/timing
+# variables apply to that request, and any other difference from the
+# daemon's own (backend, model, --no-semantic, weights...) makes the client
+# run the command locally instead.
+LOCAL_ONLY_FLAGS = {"--serve", "--stop-daemon", "--no-daemon", "--delete-all", "--watch",
+                    "--no-semantic", "-h", "--help"}
+READ_ONLY_COMMANDS = ("search", "list", "cache_stats", "export")
+REQUEST_ENV = ("CLAUDE_MEMORY_PROFILE", "CLAUDE_MEMORY_PROFILE_FORMAT", "CLAUDE_MEMORY_CPROFILE",
+               "CLAUDE_MEMORY_TIMING")  # honoured per request; any other difference runs locally
+DAEMON_ENV = ("CLAUDE_MEMORY_DAEMON", "CLAUDE_MEMORY_DAEMON_IDLE")
+
+
+def memory_env(environ=None) -> dict:
+    return {name: value for name, value in (os.environ if environ is None else environ).items()
+            if name.startswith("CLAUDE_MEMORY_")}
+
+
+def config_env(env: dict) -> dict:
+    """The part of a CLAUDE_MEMORY_* environment the daemon's loaded state depends on."""
+    return {name: value for name, value in env.items() if name not in REQUEST_ENV + DAEMON_ENV}
+
+
+class ReadWriteLock:
+    """Many concurrent readers or one writer."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class ThreadLocalStream:
+    """sys.stdout/stderr proxy that lets each daemon thread capture its own output."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        target = getattr(self.local, "buffer", None) or self.stream
+        return target.write(text)
+
+    def flush(self):
+        target = getattr(self.local, "buffer", None) or self.stream
+        target.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def daemon_available() -> bool:
+    return DAEMON_ENABLED and hasattr(socket, "AF_UNIX")
+
+
+def store_signature() -> tuple:
+    """Stat of the files other processes may change behind the daemon's back."""
+    sig = []
+    for path in (MEMORY_FILE, JOURNAL_FILE, SQLITE_FILE, SQLITE_FILE.with_name(SQLITE_FILE.name + "-wal"),
+                 VECTOR_MAP_FILE, VECTOR_LOG_FILE, ANN_FILE):
+        try:
+            st = path.stat()
+            sig.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append(None)
+    return tuple(sig)
+
+
+def reset_caches():
+    """
+    Forget loaded state so the next access re-reads it from disk. A replaced
+    SQLite connection is not closed (another thread may still be using it);
+    it closes once the last reference goes.
+    """
+    global _backend, _vector_store, _ann_index, _forget_engine, _dedup_index
+    _backend = None
+    _dedup_index = None
+    _vector_store = None
+    _ann_index = None
+    _forget_engine = None
+
+
+def daemon_request(argv: list, timeout: float = None):
+    """
+    Send argv (with the cwd and CLAUDE_MEMORY_* environment) to the daemon.
+    Returns its response dict, or None if none is running. A response with
+    "local" set means the daemon was started with a different configuration
+    and the command should run in this process.
+    """
+    request = {"argv": argv, "cwd": os.getcwd(), "env": memory_env()}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(SOCKET_FILE))
+            sock.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+            data = b"".join(iter(lambda: sock.recv(1 << 16), b""))
+        return json.loads(data)
+    except (OSError, ValueError):
+        return None
+
+
+def start_daemon():
+    """Launch `memory.py --serve` detached from this process."""
+    ensure_dir()
+    with open(MEMORY_DIR / "daemon.log", 'a') as log:
+        subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "--serve"],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                         start_new_session=True)
+
+
+def resolve_paths(args, cwd: str):
+    """Make the client's relative file arguments absolute for the daemon."""
+    if args.process:
+        args.process = os.path.join(cwd, os.path.expanduser(args.process))
+    if args.batch:
+        args.batch = " ".join(os.path.join(cwd, os.path.expanduser(spec)) for spec in args.batch.split())
+    if args.sync:
+        args.sync = os.path.join(cwd, os.path.expanduser(args.sync))
+    if args.export:
+        args.export = os.path.join(cwd, os.path.expanduser(args.export))
+    if args.import_file:
+        args.import_file = os.path.join(cwd, os.path.expanduser(args.import_file))
+    if args.profile and args.profile != "1":
+        args.profile = os.path.join(cwd, os.path.expanduser(args.profile))
+    if args.cprofile:
+        args.cprofile = os.path.join(cwd, os.path.expanduser(args.cprofile))
+
+
+def serve():
+    """Run the daemon until idle for DAEMON_IDLE_TIMEOUT seconds or asked to stop."""
+    global IN_DAEMON
+    ensure_dir()
+    if daemon_request(["--ping"], timeout=2) is not None:
+        print(f"[Daemon] Already running on {SOCKET_FILE}")
+        return
+    if SOCKET_FILE.exists():
+        SOCKET_FILE.unlink()
+
+    IN_DAEMON = True
+    sys.stdout = ThreadLocalStream(sys.stdout)
+    sys.stderr = ThreadLocalStream(sys.stderr)
+    lock = ReadWriteLock()
+    state = {"signature": store_signature(), "last_active": time.monotonic()}
+    config = config_env(memory_env())
+
+    def handle(request: dict) -> dict:
+        buffer = io.StringIO()
+        sys.stdout.local.buffer = buffer
+        sys.stderr.local.buffer = buffer
+        code = 0
+        try:
+            parser = build_parser()
+            args = parser.parse_args(request["argv"])
+            if args.ping:
+                return {"output": "", "code": 0}
+            if args.stop_daemon:
+                threading.Thread(target=server.shutdown, daemon=True).start()
+                return {"output": "[Daemon] Stopping\n", "code": 0}
+            env = request.get("env", {})
+            if config_env(env) != config:
+                return {"output": "", "code": 0, "local": True}
+            cwd = request.get("cwd", os.getcwd())
+            resolve_paths(args, cwd)
+            for name in ("CLAUDE_MEMORY_PROFILE", "CLAUDE_MEMORY_CPROFILE"):
+                if env.get(name) and env[name] != "1":
+                    env[name] = os.path.join(cwd, os.path.expanduser(env[name]))
+            read_only = any(getattr(args, name) for name in READ_ONLY_COMMANDS)
+            while True:
+                with (lock.read() if read_only else lock.write()):
+                    if store_signature() != state["signature"]:
+                        if read_only:
+                            read_only = False  # 缓存要重置，不能和其他读线程并发
+                            continue
+                        reset_caches()
+                        state["signature"] = store_signature()
+                    if read_only and args.search and vector_builds_pending():
+                        read_only = False  # 这次搜索会建 ANN 索引或量化码，需要写锁
+                        continue
+                    execute(args, parser, env)
+                    if not read_only:
+                        state["signature"] = store_signature()
+                break
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print(f"[Error] {type(e).__name__}: {e}")
+            code = 1
+        finally:
+            sys.stdout.local.buffer = None
+            sys.stderr.local.buffer = None
+            state["last_active"] = time.monotonic()
+        return {"output": buffer.getvalue(), "code": code}
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+            except ValueError:
+                return
+            self.wfile.write(json.dumps(handle(request), ensure_ascii=False).encode('utf-8'))
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+        request_queue_size = 64  # the default 5 refuses bursts of concurrent clients
+
+    server = Server(str(SOCKET_FILE), Handler)
+
+    def watch_idle():
+        while True:
+            time.sleep(min(30, DAEMON_IDLE_TIMEOUT))
+            flush_embedding_cache()  # 查询路径不落盘，这里批量写
+            if time.monotonic() - state["last_active"] > DAEMON_IDLE_TIMEOUT:
+                server.shutdown()
+                return
+
+    threading.Thread(target=watch_idle, daemon=True).start()
+    print(f"[Daemon] Serving on {SOCKET_FILE} (pid {os.getpid()})", file=sys.stdout.stream, flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        flush_embedding_cache()
+        server.server_close()
+        if SOCKET_FILE.exists():
+            SOCKET_FILE.unlink()
 
 
 # ==================== MAIN ====================
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(
         description="Multi-Layer Memory System - Minimal Wrapper",
         formatter_class=argparse.RawTextHelpFormatter,
@@ -547,6 +4508,7 @@ OPERATIONS:
   --delete "key" -l layer     Delete memory
   --delete-all                Delete all
   --process "file"            Process file → 1-10 memories
+  --sync "dir" [--watch]      Keep a folder's memories in sync with its files
 
 LAYERS:
   core, cognitive, behavioral, contextual, state
@@ -566,27 +4528,226 @@ Full docs: See SKILL.md
     parser.add_argument("--tags", nargs="+", help="Tags for memory")
     parser.add_argument("--source", help="Source file/path")
     parser.add_argument("--min", type=int, help="Minimum memories to create (default: auto)")
-    parser.add_argument("--max", type=int, default=10, help="Maximum memories to create (default: 10)")
-    parser.add_argument("--batch", metavar="FILES", help="Process multiple files (space-separated)")
+    parser.add_argument("--max", type=int, default=10,
+                        help="Target memories for short files (default: 10); long files get as many "
+                             "chunks as needed")
+    parser.add_argument("--batch", metavar="FILES",
+                        help="Process multiple files, directories or globs (space-separated)")
+    parser.add_argument("--workers", type=int,
+                        help="Parallel extraction workers for --batch/--sync (default: min(4, CPUs))")
+    parser.add_argument("--sync", metavar="DIR",
+                        help="Ingest new/changed files of DIR, replacing only changed chunks, "
+                             "and retire memories of deleted files")
+    parser.add_argument("--watch", action="store_true",
+                        help=f"With --sync: keep polling DIR for changes (every {SYNC_INTERVAL:g}s)")
     parser.add_argument("--index", metavar="KEY", help="Index memory with tags")
     parser.add_argument("--update", metavar="KEY", help="Update memory content")
     parser.add_argument("--content", help="New content for update")
     parser.add_argument("--reindex", action="store_true", help="Regenerate embeddings for all memories")
+    parser.add_argument("--batch-size", type=int, default=32,
+                        help="Embedding batch size for --reindex/--batch (default: 32)")
+    parser.add_argument("--force", action="store_true",
+                        help="With --reindex: re-embed even unchanged memories")
+    parser.add_argument("--cache-stats", action="store_true", help="Show embedding cache statistics")
+    parser.add_argument("--compact", action="store_true",
+                        help="Fold the change journal into memories.json (VACUUM for sqlite)")
+    parser.add_argument("--export", metavar="FILE", help="Export all memories as memories.json-style JSON")
+    parser.add_argument("--import", dest="import_file", metavar="FILE",
+                        help="Import memories from a memories.json-style file")
+    parser.add_argument("--build-ann", action="store_true",
+                        help="Build/refresh the approximate nearest-neighbour index")
+    parser.add_argument("--quant-eval", nargs="?", type=int, const=200, metavar="QUERIES",
+                        help="Report the recall of int8/binary quantized search against exact "
+                             "search on this bank (default: 200 queries, recall@--top-k)")
+    parser.add_argument("--exact", action="store_true",
+                        help="Brute-force search even when an ANN index exists")
+    parser.add_argument("--nprobe", type=int, default=ANN_NPROBE,
+                        help=f"ANN lists probed per query; higher = better recall (default: {ANN_NPROBE})")
+    parser.add_argument("--forget", action="store_true",
+                        help="Evict low-priority memories from layers over capacity (-l for one layer)")
+    parser.add_argument("--policy", choices=sorted(FORGET_POLICIES),
+                        help=f"Eviction policy for --forget (default: {FORGET_POLICY})")
+    parser.add_argument("--compress", nargs="?", const="", metavar="KEY",
+                        help="Summarize KEY, or all cold/long memories, keeping the full text in cold storage")
+    parser.add_argument("--restore", metavar="KEY", help="Restore a compressed memory's full text")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="Merge near-duplicate memories already in the store (-l for one layer)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="With --forget/--compress/--dedupe: only report what would change")
+    parser.add_argument("--since", metavar="DATE", help="With --search: created on/after DATE (YYYY-MM-DD[THH:MM])")
+    parser.add_argument("--until", metavar="DATE", help="With --search: created on/before DATE")
+    parser.add_argument("--updated-since", metavar="DATE", help="With --search: updated on/after DATE")
+    parser.add_argument("--updated-until", metavar="DATE", help="With --search: updated on/before DATE")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of search results (default: 5)")
+    parser.add_argument("--explain", action="store_true",
+                        help="With --search: show each result's score breakdown")
+    parser.add_argument("--no-semantic", action="store_true",
+                        help="Skip the embedding model (keyword search only)")
+    parser.add_argument("--timing", action="store_true",
+                        help="Print a startup/command timing breakdown")
+    parser.add_argument("--profile", nargs="?", const="1", metavar="FILE",
+                        help="Append stage timings, counts and peak memory to FILE "
+                             "(default: profile.jsonl in the memory dir)")
+    parser.add_argument("--profile-format", choices=["jsonl", "prom"],
+                        help=f"--profile output: JSON lines or Prometheus text (default: {PROFILE_FORMAT})")
+    parser.add_argument("--cprofile", metavar="FILE", help="Dump cProfile stats of the command to FILE")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run the background daemon that keeps the model and store loaded")
+    parser.add_argument("--stop-daemon", action="store_true", help="Stop a running daemon")
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="Run in this process; do not use or start the daemon")
+    parser.add_argument("--ping", action="store_true", help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv: list = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and daemon_available() and not LOCAL_ONLY_FLAGS.intersection(argv):
+        response = daemon_request(argv)
+        if response is None:
+            start_daemon()
+        elif not response.get("local"):
+            sys.stdout.write(response["output"])
+            sys.exit(response["code"])
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    TIMINGS["startup"] = time.perf_counter() - _T0
+    if args.serve:
+        serve()
+        return
+    if args.stop_daemon:
+        response = daemon_request(argv, timeout=5)
+        print(response["output"].strip() if response else "[Daemon] Not running")
+        return
+    if args.no_semantic:
+        disable_semantic()
+    execute(args, parser)
+
+
+def execute(args, parser, env: dict = None):
+    """Run one parsed command. `env`: a daemon client's CLAUDE_MEMORY_* variables (default: ours)."""
+    global PROFILING
+    env = memory_env() if env is None else env
+    startup = None if IN_DAEMON else TIMINGS.get("startup")
+    reset_stats()
+    if startup is not None:
+        TIMINGS["startup"], CALLS["startup"] = startup, 1
+    profile = args.profile or env.get("CLAUDE_MEMORY_PROFILE")
+    fmt = args.profile_format or env.get("CLAUDE_MEMORY_PROFILE_FORMAT", "jsonl")
+    PROFILING = bool(profile)
+    cprofile_file = args.cprofile or env.get("CLAUDE_MEMORY_CPROFILE")
+    profiler = None
+    if cprofile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    with timed("command"):
+        if profiler is not None:
+            profiler.enable()
+        try:
+            run_command(args, parser)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(cprofile_file)
+                print(f"[Profile] cProfile stats -> {cprofile_file} (python -m pstats {cprofile_file})")
+
+    if args.timing or env.get("CLAUDE_MEMORY_TIMING"):
+        print_timings()
+    if profile:
+        path = MEMORY_DIR / f"profile.{fmt}" if profile == "1" else Path(profile)
+        write_profile(path, fmt, command_name(args))
 
-    args = parser.parse_args()
 
+COMMANDS = ("add", "get", "list", "search", "delete", "delete_all", "process", "batch", "sync", "index",
+            "update", "reindex", "cache_stats", "compact", "export", "import_file", "build_ann",
+            "compress", "restore", "forget", "dedupe", "quant_eval")
+
+
+def command_name(args) -> str:
+    for name in COMMANDS:
+        value = getattr(args, name, None)
+        if value or (name == "compress" and value is not None):
+            return name
+    return "help"
+
+
+PROMETHEUS_METRICS = {
+    "remember_command_seconds": "Wall time of the last run of each command",
+    "remember_stage_seconds": "Time spent in each stage during the last run",
+    "remember_stage_calls": "Times each stage ran during the last run",
+    "remember_count": "Event counters from the last run",
+    "remember_peak_rss_bytes": "Peak resident memory of the process after the last run",
+}
+
+
+def write_profile(path: Path, fmt: str, command: str):
+    """
+    Record this run's stats: one JSON object per line appended to `path`, or
+    (fmt="prom") Prometheus text holding the latest run of each command, e.g.
+    for node_exporter's textfile collector.
+    """
+    record = {
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "command": command,
+        "pid": os.getpid(),
+        "daemon": IN_DAEMON,
+        "backend": STORAGE_BACKEND,
+        "total_ms": round(TIMINGS.get("command", 0.0) * 1000, 3),
+        "stages": {stage: {"ms": round(secs * 1000, 3), "calls": CALLS.get(stage, 0),
+                           **({"peak_rss_mb": round(PEAK_RSS[stage] / 2**20, 1)} if stage in PEAK_RSS else {})}
+                   for stage, secs in TIMINGS.items()},
+        "counts": dict(COUNTS),
+        "peak_rss_mb": round(peak_rss() / 2**20, 1),
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if fmt != "prom":
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+        return
+
+    label = f'command="{command}"'
+    samples = [f"remember_command_seconds{{{label}}} {record['total_ms'] / 1000:.6f}",
+               f"remember_peak_rss_bytes{{{label}}} {peak_rss()}"]
+    for stage, info in record["stages"].items():
+        samples.append(f'remember_stage_seconds{{{label},stage="{stage}"}} {info["ms"] / 1000:.6f}')
+        samples.append(f'remember_stage_calls{{{label},stage="{stage}"}} {info["calls"]}')
+    for name, n in COUNTS.items():
+        samples.append(f'remember_count{{{label},name="{name}"}} {n}')
+    if path.exists():
+        # Keep the other commands' samples from earlier runs
+        samples += [line for line in path.read_text(encoding='utf-8').splitlines()
+                    if line and not line.startswith("#") and f"{{{label}" not in line]
+    lines = []
+    for metric, help_text in PROMETHEUS_METRICS.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+        lines += sorted(line for line in samples if line.startswith(metric + "{"))
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text("\n".join(lines) + "\n", encoding='utf-8')
+    os.replace(tmp, path)
+
+
+def run_command(args, parser):
     if args.add:
         add_memory(" ".join(args.add), args.layer or "cognitive", key=None, tags=args.tags, source=args.source)
     elif args.get:
         result = get_memory(args.get, args.layer)
         if result:
             print(result.get("content", ""))
+            if result.get("compressed"):
+                print(f"[Compressed] Summary of {result['compressed']['chars']} chars; "
+                      f"--restore {args.get} for the full text")
         else:
             print("Not found")
     elif args.list:
         list_memories(args.layer)
     elif args.search:
-        search_memories(args.search)
+        filters = {"layer": args.layer, "tags": args.tags, "source": args.source,
+                   "created_since": args.since, "created_until": args.until,
+                   "updated_since": args.updated_since, "updated_until": args.updated_until}
+        search_memories(args.search, top_k=args.top_k, exact=args.exact, nprobe=args.nprobe,
+                        explain=args.explain, filters=filters)
     elif args.delete:
         delete_memory(args.delete, args.layer)
     elif args.delete_all:
@@ -594,12 +4755,13 @@ Full docs: See SKILL.md
     elif args.process:
         process_file(args.process, args.layer or "cognitive", args.min, args.max)
     elif args.batch:
-        files = args.batch.split()
-        total = 0
-        for f in files:
-            count = process_file(f, args.layer or "cognitive", args.min, args.max)
-            total += count
-        print(f"[Batch] Total: {total} memories from {len(files)} files")
+        batch_process(args.batch.split(), args.layer or "cognitive", args.min, args.max,
+                      workers=args.workers, batch_size=args.batch_size)
+    elif args.sync:
+        if args.watch:
+            watch_folder(args.sync, args.layer or "cognitive", args.min, args.max, args.workers)
+        else:
+            sync_folder(args.sync, args.layer or "cognitive", args.min, args.max, args.workers)
     elif args.index:
         if not args.tags:
             print("[Error] --tags required for --index")
@@ -611,7 +4773,31 @@ Full docs: See SKILL.md
         else:
             update_memory(args.update, args.layer or "cognitive", args.content)
     elif args.reindex:
-        reindex_memories()
+        reindex_memories(batch_size=args.batch_size, force=args.force)
+    elif args.cache_stats:
+        print_cache_stats()
+    elif args.compact:
+        get_backend().compact()
+        print(f"[Compact] {get_backend().name} store compacted")
+    elif args.export:
+        export_memories(args.export)
+    elif args.import_file:
+        import_memories(args.import_file)
+    elif args.compress is not None:
+        compress_memories(args.compress or None, args.layer, dry_run=args.dry_run)
+    elif args.restore:
+        restore_memory(args.restore, args.layer)
+    elif args.forget:
+        forget_memories(args.layer, policy=args.policy, dry_run=args.dry_run)
+    elif args.dedupe:
+        dedupe_memories(args.layer, dry_run=args.dry_run)
+    elif args.quant_eval:
+        evaluate_quantization(args.quant_eval, args.top_k)
+    elif args.build_ann:
+        if get_ann_index(build=True) is None or not len(get_vector_store()):
+            print("[ANN] No embeddings to index. Run --reindex first.")
+        else:
+            print(f"[ANN] Index ready: {len(get_ann_index().centroids)} lists")
     else:
         parser.print_help()
 